@@ -0,0 +1,385 @@
+# benchmarks/funnel_load.py
+"""
+对话引导流程的端到端压测。
+
+模拟大量用户并发走完整个流程：/start → 需要服务 → 新玩家 → 注册完成 → 9位ID → 点击策略按钮。
+更新通过 ChatOrderedUpdateProcessor 分发给真实的处理函数，Telegram 调用由记录调用的假 Bot 承担，
+AI 使用本地桩实现。数据库默认使用配置里的数据库（请指向本地的测试库，压测会写入大量用户数据），
+也可以用 --db-backend sqlite 在本地 SQLite 文件上运行，方便对比不同数据库的延迟。
+
+用法（在项目根目录执行）：
+    python -m benchmarks.funnel_load --users 2000 --concurrency 500 --api-latency 0.05
+    python -m benchmarks.funnel_load --users 2000 --db-backend sqlite
+"""
+
+import argparse
+import asyncio
+import itertools
+import logging
+import math
+import random
+import time
+from collections import defaultdict
+from types import SimpleNamespace
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from telegram import Update
+
+from telegram_bot.update_processor import ChatOrderedUpdateProcessor
+from services import ai_service, db_service
+from services.ai_backends import StubBackend
+from services.ai_governor import AIGovernor
+from services.media_assets import media_registry
+from services.storage import create_storage
+from utils import metrics, tracing
+from handlers import command_handler, message_handler, callback_handler, handler_utils
+
+logger = logging.getLogger(__name__)
+
+# 规则无法判断、必须交给 AI 的闲聊消息
+SMALL_TALK_MESSAGES = [
+    "hmm tell me more about it first",
+    "what is this game about?",
+    "is it safe?",
+    "kya yeh free hai?",
+]
+
+
+class FakeBot:
+    """
+    假的 Telegram Bot：不访问网络，按配置的延迟模拟每次 API 调用，并记录调用次数。
+    没有显式定义的方法也会被当作一次 API 调用处理。
+    """
+
+    defaults = None
+
+    def __init__(self, latency: float = 0.05, jitter: float = 0.02, seed: Optional[int] = None):
+        self.latency = latency
+        self.jitter = jitter
+        self._random = random.Random(seed)
+        self.calls: Dict[str, int] = defaultdict(int)
+
+    async def _call(self, method: str, **kwargs) -> None:
+        self.calls[method] += 1
+        delay = self.latency + self._random.uniform(-self.jitter, self.jitter)
+        # 和线上的 InstrumentedHTTPXRequest 一样，把调用耗时算进追踪里以方法名命名的阶段
+        with tracing.span(method):
+            if delay > 0:
+                await asyncio.sleep(delay)
+
+    async def send_message(self, chat_id=None, text=None, **kwargs):
+        await self._call('send_message', chat_id=chat_id, text=text, **kwargs)
+
+    async def send_photo(self, chat_id=None, photo=None, **kwargs):
+        await self._call('send_photo', chat_id=chat_id, photo=photo, **kwargs)
+
+    async def send_media_group(self, chat_id=None, media=None, **kwargs):
+        # 返回带 file_id 的假消息，素材缓存和线上一样只在第一次发送时“上传”
+        await self._call('send_media_group', chat_id=chat_id, media=media, **kwargs)
+        return tuple(SimpleNamespace(photo=[SimpleNamespace(file_id=f"fake-file-{i}")]) for i in range(len(media)))
+
+    async def send_chat_action(self, chat_id=None, action=None, **kwargs):
+        await self._call('send_chat_action', chat_id=chat_id, action=action, **kwargs)
+
+    async def answer_callback_query(self, callback_query_id=None, **kwargs):
+        await self._call('answer_callback_query', callback_query_id=callback_query_id, **kwargs)
+
+    async def edit_message_text(self, text=None, **kwargs):
+        await self._call('edit_message_text', text=text, **kwargs)
+
+    async def delete_message(self, chat_id=None, message_id=None, **kwargs):
+        await self._call('delete_message', chat_id=chat_id, message_id=message_id, **kwargs)
+        return True
+
+    def __getattr__(self, name: str) -> Callable:
+        if name.startswith('_'):
+            raise AttributeError(name)
+
+        async def method(*args, **kwargs):
+            await self._call(name, **kwargs)
+        return method
+
+
+class FakeJobQueue:
+    """只记录被安排的任务，不真正执行（压测只关心处理函数本身）"""
+
+    def __init__(self):
+        self.scheduled: Dict[str, int] = defaultdict(int)
+
+    def run_once(self, callback, when, **kwargs):
+        self.scheduled[getattr(callback, '__name__', str(callback))] += 1
+
+    def run_repeating(self, callback, interval, **kwargs):
+        self.scheduled[getattr(callback, '__name__', str(callback))] += 1
+
+    def get_jobs_by_name(self, name: str) -> List[Any]:
+        return []
+
+
+class FakeApplication:
+    """处理函数只用到 create_task 和 update_processor，这里记录创建的后台任务，方便压测结束时等待"""
+
+    def __init__(self, update_processor: ChatOrderedUpdateProcessor):
+        self.update_processor = update_processor
+        self.tasks: set = set()
+
+    def create_task(self, coroutine, update=None, name=None):
+        task = asyncio.get_running_loop().create_task(coroutine, name=name)
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+        return task
+
+
+class FakeContext:
+    def __init__(self, bot: FakeBot, application: FakeApplication, job_queue: FakeJobQueue):
+        self.bot = bot
+        self.application = application
+        self.job_queue = job_queue
+        self.job = None
+
+
+class LatencyRecorder:
+    """按标签记录耗时，输出吞吐量和 p50/p95/p99"""
+
+    def __init__(self):
+        self.samples: Dict[str, List[float]] = defaultdict(list)
+        self.errors: Dict[str, int] = defaultdict(int)
+
+    def record(self, label: str, seconds: float):
+        self.samples[label].append(seconds)
+
+    @staticmethod
+    def percentile(values: List[float], q: float) -> float:
+        if not values:
+            return 0.0
+        # 最近秩法
+        ordered = sorted(values)
+        index = max(0, math.ceil(q / 100 * len(ordered)) - 1)
+        return ordered[index]
+
+    def report(self, title: str, labels: List[str]) -> str:
+        lines = [title, f"  {'':<40}{'count':>8}{'errors':>8}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'max ms':>10}"]
+        for label in labels:
+            values = self.samples.get(label, [])
+            lines.append(
+                f"  {label:<40}{len(values):>8}{self.errors.get(label, 0):>8}"
+                f"{self.percentile(values, 50) * 1000:>10.1f}{self.percentile(values, 95) * 1000:>10.1f}"
+                f"{self.percentile(values, 99) * 1000:>10.1f}{max(values, default=0) * 1000:>10.1f}")
+        return "\n".join(lines)
+
+
+class FunnelLoadTest:
+    """驱动模拟用户走完引导流程，并统计每个处理函数、每个状态的耗时"""
+
+    def __init__(self, users: int, concurrency: int, user_id_base: int, think_time: float,
+                 small_talk_share: float, bot: FakeBot, processor: ChatOrderedUpdateProcessor,
+                 seed: Optional[int] = None):
+        self.users = users
+        self.concurrency = concurrency
+        self.user_id_base = user_id_base
+        self.think_time = think_time
+        self.small_talk_share = small_talk_share
+        self.bot = bot
+        self.processor = processor
+        self.job_queue = FakeJobQueue()
+        self.application = FakeApplication(processor)
+        self._random = random.Random(seed)
+        self._update_ids = itertools.count(1)
+        self._message_ids = itertools.count(1)
+        self.by_handler = LatencyRecorder()
+        self.by_state = LatencyRecorder()
+        self.completed_users = 0
+        self.updates = 0
+
+    # --- 构造合成的 Update ---
+
+    def _user_dict(self, user_id: int) -> Dict[str, Any]:
+        return {"id": user_id, "is_bot": False, "first_name": "Load", "username": f"load{user_id}",
+                "language_code": "en"}
+
+    def _message_dict(self, user_id: int, text: str) -> Dict[str, Any]:
+        message = {
+            "message_id": next(self._message_ids),
+            "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private"},
+            "from": self._user_dict(user_id),
+            "text": text,
+        }
+        if text.startswith('/'):
+            message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+        return message
+
+    def text_update(self, user_id: int, text: str) -> Update:
+        data = {"update_id": next(self._update_ids), "message": self._message_dict(user_id, text)}
+        return Update.de_json(data, self.bot)
+
+    def callback_update(self, user_id: int, callback_data: str) -> Update:
+        message = self._message_dict(user_id, "请选择你的策略：")
+        message["from"] = {"id": 1, "is_bot": True, "first_name": "Bot"}
+        data = {
+            "update_id": next(self._update_ids),
+            "callback_query": {
+                "id": str(next(self._update_ids)),
+                "from": self._user_dict(user_id),
+                "chat_instance": str(user_id),
+                "data": callback_data,
+                "message": message,
+            },
+        }
+        return Update.de_json(data, self.bot)
+
+    # --- 一个模拟用户的完整流程 ---
+
+    def script(self) -> List[Tuple[str, str, str]]:
+        """返回 (处理函数, 此时用户所处的状态, 消息内容) 组成的步骤"""
+        steps = [('start_command', 'new', '/start')]
+        funnel = [
+            ('awaiting_service_confirmation', 'yes'),
+            ('awaiting_experience_confirmation', 'no i am new'),
+            ('awaiting_registration_confirmation', 'done'),
+            ('awaiting_user_id', str(self._random.randint(100000000, 999999999))),
+        ]
+        for state, text in funnel:
+            if state != 'awaiting_user_id' and self._random.random() < self.small_talk_share:
+                # 先闲聊一句（交给 AI），状态不变，然后再给出正确的回答
+                steps.append(('text_message_handler', state, self._random.choice(SMALL_TALK_MESSAGES)))
+            steps.append(('text_message_handler', state, text))
+        steps.append(('button_handler', 'completed', 'strategy_1'))
+        return steps
+
+    async def dispatch(self, handler_name: str, state: str, update: Update):
+        """像 Application 一样把更新交给处理器，记录从提交到处理完成的耗时"""
+        handler = {
+            'start_command': command_handler.start_command,
+            'text_message_handler': message_handler.text_message_handler,
+            'button_handler': callback_handler.button_handler,
+        }[handler_name]
+        context = FakeContext(self.bot, self.application, self.job_queue)
+        started = time.perf_counter()
+        try:
+            await self.processor.process_update(update, handler(update, context))
+        except Exception as e:
+            self.by_handler.errors[handler_name] += 1
+            self.by_state.errors[state] += 1
+            logger.debug(f"处理更新失败 ({handler_name}, {state}): {e}")
+        elapsed = time.perf_counter() - started
+        self.updates += 1
+        self.by_handler.record(handler_name, elapsed)
+        self.by_state.record(state, elapsed)
+
+    async def run_user(self, user_id: int):
+        for handler_name, state, text in self.script():
+            if handler_name == 'button_handler':
+                update = self.callback_update(user_id, text)
+            else:
+                update = self.text_update(user_id, text)
+            await self.dispatch(handler_name, state, update)
+            if self.think_time > 0:
+                await asyncio.sleep(self._random.uniform(0, 2 * self.think_time))
+        self.completed_users += 1
+
+    async def prepare(self):
+        """把模拟用户标记为未订阅，这样重复压测时 /start 仍然会走新用户的引导流程"""
+        await db_service.unsubscribe_users([self.user_id_base + i for i in range(self.users)])
+
+    async def run(self) -> float:
+        """跑完所有模拟用户，返回总耗时（秒）"""
+        semaphore = asyncio.Semaphore(self.concurrency)
+
+        async def limited(user_id: int):
+            async with semaphore:
+                await self.run_user(user_id)
+
+        started = time.perf_counter()
+        await asyncio.gather(*(limited(self.user_id_base + i) for i in range(self.users)))
+        # 等待防抖等延迟处理的后台任务
+        while self.application.tasks:
+            await asyncio.gather(*list(self.application.tasks), return_exceptions=True)
+        return time.perf_counter() - started
+
+
+def _phase_report() -> str:
+    """按追踪入口汇总各阶段的平均耗时，看时间花在数据库、AI、发消息还是停顿上"""
+    totals: Dict[str, Dict[str, Tuple[float, int]]] = defaultdict(dict)
+    for (trace_name, phase), child in tracing.TRACE_PHASE_DURATION.children():
+        totals[trace_name][phase] = (child.sum, child.count)
+    lines = ["按阶段（每次平均毫秒）："]
+    for trace_name in sorted(totals):
+        phases = sorted(totals[trace_name].items(), key=lambda item: -item[1][0])
+        summary = ', '.join(f"{phase}={seconds / count * 1000:.1f}" for phase, (seconds, count) in phases if count)
+        lines.append(f"  {trace_name:<24} {summary}")
+    return '\n'.join(lines)
+
+
+def _parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="对话引导流程的端到端压测")
+    parser.add_argument('--users', type=int, default=1000, help="模拟用户数")
+    parser.add_argument('--concurrency', type=int, default=200, help="同时进行对话的用户数")
+    parser.add_argument('--max-concurrent-updates', type=int, default=256, help="更新处理器的并发上限")
+    parser.add_argument('--user-id-base', type=int, default=9_000_000_000, help="模拟用户ID的起始值")
+    parser.add_argument('--think-time', type=float, default=0.0, help="用户两次发言之间的平均间隔（秒）")
+    parser.add_argument('--small-talk-share', type=float, default=0.2, help="每一步先闲聊一句（调用 AI）的概率")
+    parser.add_argument('--api-latency', type=float, default=0.05, help="每次 Telegram API 调用的模拟延迟（秒）")
+    parser.add_argument('--ai-latency', type=float, default=0.3, help="每次 AI 调用的模拟延迟（秒）")
+    parser.add_argument('--ai-error-rate', type=float, default=0.0, help="AI 返回临时性错误的概率")
+    parser.add_argument('--ai-quota-error-rate', type=float, default=0.0, help="AI 返回 429 的概率")
+    parser.add_argument('--ai-rpm', type=float, default=None, help="覆盖 AI 每分钟请求数上限（默认使用配置）")
+    parser.add_argument('--typing-scale', type=float, default=0.0, help="“正在输入”停顿的倍数，1 为线上速度")
+    parser.add_argument('--debounce-ms', type=int, default=0, help="消息防抖窗口（毫秒），0 表示不合并")
+    parser.add_argument('--db-backend', choices=['mysql', 'sqlite'], default=None,
+                        help="覆盖配置里的数据库类型（默认使用配置）")
+    parser.add_argument('--metrics-out', default=None, help="压测结束后把 Prometheus 格式的指标写到这个文件")
+    parser.add_argument('--seed', type=int, default=None, help="随机数种子，用于复现同样的流程")
+    return parser.parse_args(argv)
+
+
+async def _main(args: argparse.Namespace):
+    # AI 使用本地桩实现，处理函数里的停顿和防抖按参数调整
+    ai_service.ai_backend = StubBackend(latency=args.ai_latency, latency_jitter=args.ai_latency / 3,
+                                       error_rate=args.ai_error_rate, quota_error_rate=args.ai_quota_error_rate,
+                                       seed=args.seed)
+    if args.ai_rpm is not None:
+        ai_service.ai_governor = AIGovernor(requests_per_minute=args.ai_rpm)
+    handler_utils.TYPING_DELAY_SCALE = args.typing_scale
+    message_handler.MESSAGE_DEBOUNCE_MS = args.debounce_ms
+
+    if args.db_backend is not None:
+        db_service._storage = create_storage(args.db_backend)
+    await db_service.initialize_database()
+    bot = FakeBot(latency=args.api_latency, jitter=args.api_latency / 3, seed=args.seed)
+    processor = ChatOrderedUpdateProcessor(args.max_concurrent_updates)
+    test = FunnelLoadTest(args.users, args.concurrency, args.user_id_base, args.think_time,
+                          args.small_talk_share, bot, processor, seed=args.seed)
+    try:
+        await test.prepare()
+        elapsed = await test.run()
+    finally:
+        await db_service.close_pool()
+
+    print(f"模拟用户 {args.users}（完成 {test.completed_users}），更新 {test.updates}，耗时 {elapsed:.1f} 秒")
+    print(f"吞吐量：{test.updates / elapsed:.1f} 更新/秒，{test.completed_users / elapsed:.2f} 完整流程/秒")
+    print(test.by_handler.report("按处理函数：", ['start_command', 'text_message_handler', 'button_handler']))
+    print(test.by_state.report("按用户状态：", [
+        'new', 'awaiting_service_confirmation', 'awaiting_experience_confirmation',
+        'awaiting_registration_confirmation', 'awaiting_user_id', 'completed']))
+    print(f"Telegram API 调用：{dict(bot.calls)}")
+    print(f"安排的定时任务：{dict(test.job_queue.scheduled)}")
+    print(f"素材缓存：{media_registry.get_stats()}")
+    print(f"意图判断：{ai_service.get_intent_stats()}")
+    print(f"更新处理器：{processor.get_stats()}")
+    print(f"数据库（{db_service.get_storage().name}）：{db_service.get_storage_stats()}，"
+          f"对话写入：{db_service.get_chat_writer_stats()}")
+    print(_phase_report())
+    if args.metrics_out:
+        with open(args.metrics_out, 'w', encoding='utf-8') as f:
+            f.write(metrics.REGISTRY.render())
+        print(f"指标已写入 {args.metrics_out}")
+
+
+def main(argv: Optional[List[str]] = None):
+    logging.basicConfig(format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.WARNING)
+    asyncio.run(_main(_parse_args(argv)))
+
+
+if __name__ == "__main__":
+    main()
@@ -7,17 +7,29 @@ from telegram.ext import ContextTypes
 
 # 导入我们自己写的数据库服务，用来更新用户数据
 from services.db_service import update_user_data
+# 导入防抖窗口的处理，按钮点击之前先处理还没回复的消息
+from handlers.message_handler import flush_pending_burst
 # 导入我们公共回复模块中的发送链接函数
 from handlers.common_replies import send_service_link
+# 导入处理函数的耗时指标和计时装饰器
+from handlers.instrumentation import HANDLER_LATENCY, HANDLER_ERRORS
+from utils.metrics import timed
+# 导入按更新的耗时追踪
+from utils.tracing import traced
 
 
 # 定义一个异步函数，专门用来处理用户点击内联按钮的操作
+@timed(HANDLER_LATENCY, HANDLER_ERRORS, handler='button_handler')
+@traced('button_handler')
 async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """处理内联按钮点击"""
     # 从 update 对象中获取回调查询对象，它包含了按钮的所有信息
     query = update.callback_query
     # 必须调用 answer()，以通知 Telegram 我们已经收到了这次点击，否则用户的按钮会一直显示加载中
     await query.answer()
+    # 先处理这个聊天还在防抖窗口里的消息，保持和用户操作一致的顺序
+    if update.effective_chat:
+        await flush_pending_burst(update.effective_chat.id, context)
 
     # 从 query 对象中获取点击按钮的那个用户的ID
     user_id = query.from_user.id
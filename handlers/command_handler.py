@@ -1,111 +1,29 @@
 # handlers/command_handler.py
-import asyncio
 # 导入 logging 模块，用于记录程序运行信息
 import logging
-import time
 
-# 从 telegram 库导入 Update, InlineKeyboardButton, InlineKeyboardMarkup 类
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
-from telegram.constants import ChatAction
+# 从 telegram 库导入 Update 类
+from telegram import Update
 # 从 telegram.ext 库导入 ContextTypes，它包含了上下文信息
 from telegram.ext import ContextTypes
 # 导入我们自己写的 AI 服务，用来判断用户意图
 from services.ai_service import get_user_intent
 # 导入我们自己写的消息处理器，用来处理闲聊
-from handlers.message_handler import text_message_handler
+from handlers.message_handler import text_message_handler, flush_pending_burst
 # 导入我们自己写的数据库服务，用来操作数据库
 from services.db_service import get_user_data, update_user_data, save_chat_message
+# 导入处理函数的耗时指标和计时装饰器
+from handlers.instrumentation import HANDLER_LATENCY, HANDLER_ERRORS
+from utils.metrics import timed
+from utils.tracing import traced
 
 # 获取一个日志记录器实例，用于在这个文件中打印日志
 logger = logging.getLogger(__name__)
 
 
-# 定义一个异步函数，用于发送服务链接和策略按钮
-async def send_service_link(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """一个独立的函数，用于发送服务链接和策略按钮"""
-    # 定义包含可点击链接的文本
-    chat_id = update.effective_chat.id
-    # await context.bot.send_chat_action(chat_id=chat_id, action=ChatAction.TYPING)
-    # await asyncio.sleep(5)
-    link_text = "发射前30s通知：[点击这里进入游戏](https://www.example.com)"
-    # 定义一个包含三个按钮的键盘布局
-    keyboard = [
-        # 第一个按钮，显示文字为“策略1”，隐藏数据为 "strategy_1"
-        [InlineKeyboardButton("策略1", callback_data="strategy_1")],
-        # 第二个按钮
-        [InlineKeyboardButton("策略2", callback_data="strategy_2")],
-        # 第三个按钮
-        [InlineKeyboardButton("策略3 (不可用)", callback_data="disabled_button")],
-    ]
-    # 将键盘布局包装成一个回复标记对象
-    reply_markup = InlineKeyboardMarkup(keyboard)
-
-    # 发送包含链接的消息，并设置解析模式为 Markdown 以便链接生效
-    await context.bot.send_message(chat_id=update.effective_chat.id, text=link_text, parse_mode='Markdown')
-    # 发送另一条消息，附带我们创建的策略按钮
-    await context.bot.send_message(chat_id=update.effective_chat.id, text="请选择你的策略：", reply_markup=reply_markup)
-
-
-# 定义一个异步函数，用于发送图文并茂的注册教程
-async def send_registration_guide(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """发送图文并茂的注册和充值教程"""
-    # 获取当前聊天的ID
-    user_id = update.effective_user.id
-    chat_id = update.effective_chat.id
-
-    # --- 教程第一步：注册 ---
-    #先发送一条带链接的文案
-    # await context.bot.send_chat_action(chat_id=chat_id, action=ChatAction.UPLOAD_PHOTO) #正在上传照片
-    # await asyncio.sleep(5)
-
-    registration_link_messgae = (
-        "**Step 1: Registration**\n\n"
-        "Please use this link to register:\n"
-        "https://xz.u7777.net/?dl=dkyay3"
-    )
-    await context.bot.send_message(chat_id=chat_id, text=registration_link_messgae,parse_mode='Markdown')
-    await save_chat_message(user_id, "bot", registration_link_messgae)
-    # 定义注册教程的文字说明
-    registration_caption = (
-        "**Step 1: Registration**\n\n"
-        "1. Click the link in our bio.\n"
-        "2. Fill in your details.\n"
-        "3. Verify your email."
-    )
-    # 定义一张占位图片
-
-
-    registration_photo_url = "https://picsum.photos/seed/register/600/400"
-    # 发送图片，并将文字说明作为图片的标题
-    # await context.bot.send_chat_action(chat_id=chat_id, action=ChatAction.UPLOAD_PHOTO) #正在上传照片
-    # await asyncio.sleep(5)
-    await context.bot.send_photo(chat_id=chat_id, photo=registration_photo_url, caption=registration_caption,
-                                 parse_mode='Markdown')
-
-    # --- 教程第二步：充值 ---
-    # 定义充值教程的文字说明
-    recharge_caption = (
-        "**Step 2: Recharge**\n\n"
-        "1. Go to the 'Wallet' section.\n"
-        "2. Choose your payment method.\n"
-        "3. Complete the payment to start playing!"
-    )
-    # 定义另一张占位图片
-
-    recharge_photo_url = "https://picsum.photos/seed/recharge/600/400"
-    # 发送第二张图片和对应的说明
-    await context.bot.send_photo(chat_id=chat_id, photo=recharge_photo_url, caption=recharge_caption,
-                                 parse_mode='Markdown')
-
-    # --- 新增：引导用户下一步操作 ---
-    # 发送一条纯文本消息，告诉用户下一步该做什么
-    await context.bot.send_message(
-        chat_id=chat_id,
-        text="Please follow the guide to register. Let me know when you are done!"
-    )
-
-
 # 定义处理 /start 命令的主函数
+@timed(HANDLER_LATENCY, HANDLER_ERRORS, handler='start_command')
+@traced('start_command')
 async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """
     处理 /start 命令。
@@ -118,6 +36,8 @@ async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
     user_id = user.id
     # 获取聊天ID
     chat_id = update.effective_chat.id
+    # 先处理这个聊天还在防抖窗口里的消息，它们应该在 /start 重置状态之前生效
+    await flush_pending_burst(chat_id, context)
 
     # 从数据库获取该用户的历史数据
     user_data = await get_user_data(user_id)
@@ -4,6 +4,12 @@ from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import ContextTypes
 # 导入数据库保存函数
 from services.db_service import save_chat_message
+# 导入素材的 file_id 缓存
+from services.media_assets import MediaAsset, media_registry
+
+# 注册教程的两张配图：第一次由 Telegram 从网址下载，之后用 file_id 发送
+REGISTRATION_PHOTO = MediaAsset('registration_guide_register', 'https://picsum.photos/seed/register/600/400')
+RECHARGE_PHOTO = MediaAsset('registration_guide_recharge', 'https://picsum.photos/seed/recharge/600/400')
 
 
 async def send_service_link(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -43,20 +49,17 @@ async def send_registration_guide(update: Update, context: ContextTypes.DEFAULT_
         "2. Fill in your details.\n"
         "3. Verify your email."
     )
-    registration_photo_url = "https://picsum.photos/seed/register/600/400"
-    await context.bot.send_photo(chat_id=chat_id, photo=registration_photo_url, caption=registration_caption,
-                                 parse_mode='Markdown')
-    await save_chat_message(user_id, "bot", f"[Photo] {registration_caption}")
-
     recharge_caption = (
         "**Step 2: Recharge**\n\n"
         "1. Go to the 'Wallet' section.\n"
         "2. Choose your payment method.\n"
         "3. Complete the payment to start playing!"
     )
-    recharge_photo_url = "https://picsum.photos/seed/recharge/600/400"
-    await context.bot.send_photo(chat_id=chat_id, photo=recharge_photo_url, caption=recharge_caption,
-                                 parse_mode='Markdown')
+    # 两张图片合成一组发送，只调用一次 API；图片第一次上传后用 file_id 发送
+    await media_registry.send_photo_group(
+        context.bot, chat_id, [(REGISTRATION_PHOTO, registration_caption), (RECHARGE_PHOTO, recharge_caption)],
+        parse_mode='Markdown')
+    await save_chat_message(user_id, "bot", f"[Photo] {registration_caption}")
     await save_chat_message(user_id, "bot", f"[Photo] {recharge_caption}")
 
     follow_up_text = "Please follow the guide to register. Let me know when you are done!"
@@ -0,0 +1,23 @@
+# handlers/handler_utils.py
+
+import asyncio
+
+from telegram.constants import ChatAction
+from telegram.ext import ContextTypes
+# 导入配置文件
+from telegram_bot import config
+# 导入按更新的耗时追踪
+from utils import tracing
+
+# “正在输入”停顿时间的倍数：1 是正常速度，0 表示不停顿（压测时使用）
+TYPING_DELAY_SCALE = getattr(config, 'TYPING_DELAY_SCALE', 1.0)
+
+
+async def typing_pause(context: ContextTypes.DEFAULT_TYPE, chat_id: int, action: str = ChatAction.TYPING,
+                       seconds: float = 3):
+    """显示“正在输入”等状态，并停顿一会儿，让回复看起来更像真人"""
+    await context.bot.send_chat_action(chat_id=chat_id, action=action)
+    delay = seconds * TYPING_DELAY_SCALE
+    if delay > 0:
+        with tracing.span('typing_sleep'):
+            await asyncio.sleep(delay)
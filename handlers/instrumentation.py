@@ -0,0 +1,8 @@
+# handlers/instrumentation.py
+
+# 导入指标模块
+from utils import metrics
+
+# 各个处理函数的耗时和未捕获异常次数，按处理函数名区分
+HANDLER_LATENCY = metrics.histogram('tg_handler_duration_seconds', '更新处理函数耗时（秒）', ['handler'])
+HANDLER_ERRORS = metrics.counter('tg_handler_errors_total', '更新处理函数抛出异常的次数', ['handler'])
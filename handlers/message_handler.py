@@ -2,8 +2,12 @@
 import asyncio
 # 导入 logging 模块，用于记录程序运行信息
 import logging
-# 从 typing 模块导入 Dict 类型，用于类型提示，让代码更规范
-from typing import Dict
+# 导入 time 模块，用于计算消息防抖的时间窗口
+import time
+# 导入 dataclass，用于定义收集中的消息
+from dataclasses import dataclass
+# 从 typing 模块导入 Dict 和 List 类型，用于类型提示，让代码更规范
+from typing import Dict, List
 # 从 telegram 库导入 Update 类，它包含了所有收到的更新信息（比如消息）
 from telegram import Update
 # 从 telegram.ext 库导入 ContextTypes，它包含了上下文信息，比如机器人实例
@@ -17,40 +21,83 @@ from utils.language_detector import detect_language
 from services.ai_service import get_user_intent
 # 导入我们自己写的数据库服务，用来操作数据库
 from services.db_service import get_user_data, update_user_data, save_chat_message
+# 导入按聊天排序的更新处理器，合并后的消息要和这个聊天之后的更新一起排队
+from telegram_bot.update_processor import ChatOrderedUpdateProcessor
+# 导入持久化的提醒，新玩家的注册提醒由清扫任务统一发送
+from tasks import reminders
 # 从我们创建的公共回复模块中，导入发送链接和注册指南的函数
 from handlers.common_replies import send_service_link, send_registration_guide
+# 导入“正在输入”的停顿
+from handlers.handler_utils import typing_pause
+# 导入处理函数的耗时指标和计时装饰器
+from handlers.instrumentation import HANDLER_LATENCY, HANDLER_ERRORS
+from utils.metrics import timed
+# 导入按更新的耗时追踪
+from utils.tracing import traced, annotate
 
 # 获取一个日志记录器实例，用于在这个文件中打印日志
 logger = logging.getLogger(__name__)
 
+# 同一个聊天连续发消息时，等待多少毫秒没有新消息再统一处理；0 表示不合并（默认关闭，
+# 开启后每条消息都会多等这么久才回复，需要合并连发消息的部署自己打开）
+MESSAGE_DEBOUNCE_MS = getattr(config, 'MESSAGE_DEBOUNCE_MS', 0)
+# 用户一直不停地发消息时，最多等待多少毫秒就必须处理
+MESSAGE_DEBOUNCE_MAX_MS = getattr(config, 'MESSAGE_DEBOUNCE_MAX_MS', 4000)
 
-# 定义一个异步函数，用于发送注册提醒
-async def registration_reminder(context: ContextTypes.DEFAULT_TYPE):
-    """提醒用户是否注册完成"""
-    # 从上下文中获取 job 对象，它包含了定时任务的信息
-    job = context.job
-    # 从 job 对象中获取当时设置的用户ID
-    user_id = job.user_id
-    # 从 job 对象中获取当时设置的聊天ID
-    chat_id = job.chat_id
 
-    # 从数据库获取该用户的最新数据
-    user_data = await get_user_data(user_id)
-    # 检查用户的状态是否仍然是“等待注册确认”
-    if user_data.get('state') == 'awaiting_registration_confirmation':
-        # 如果是，就发送一条提醒消息
-        reminder_message = "Hi! Have you completed the registration? Let me know if you are ready."
-        # 使用机器人实例发送消息
-        await context.bot.send_chat_action(chat_id=chat_id, action=ChatAction.TYPING)
-        await asyncio.sleep(3)
-        await context.bot.send_message(chat_id=chat_id, text=reminder_message)
-        # 将这条提醒消息也保存到数据库的聊天记录中
-        await save_chat_message(user_id, "bot", reminder_message)
+@dataclass
+class _MessageBurst:
+    """同一个聊天在防抖窗口内连续发来的消息"""
+    texts: List[str]
+    # 最新一条消息的更新，回复都发到这条消息上
+    update: Update
+    started: float
+    deadline: float
+
+
+# chat_id -> 这个聊天正在收集中的消息
+_pending_bursts: Dict[int, _MessageBurst] = {}
+
+# 防抖的统计：收到的消息数、合并后实际处理的次数
+debounce_stats = {'messages': 0, 'bursts': 0}
+# 更新处理器不支持按聊天排序时只警告一次
+_unordered_warning_logged = False
+
+
+def _debounce_enabled(context: ContextTypes.DEFAULT_TYPE) -> bool:
+    """
+    是否合并连发的消息。合并后的消息在后台处理，必须和这个聊天之后的更新按顺序执行，
+    所以只有使用 ChatOrderedUpdateProcessor 时才开启；否则逐条立即处理并警告。
+    """
+    global _unordered_warning_logged
+    if MESSAGE_DEBOUNCE_MS <= 0:
+        return False
+    if isinstance(context.application.update_processor, ChatOrderedUpdateProcessor):
+        return True
+    if not _unordered_warning_logged:
+        _unordered_warning_logged = True
+        logger.warning("MESSAGE_DEBOUNCE_MS 需要 ChatOrderedUpdateProcessor 才能保证同一聊天的处理顺序，"
+                       "当前的更新处理器不支持，消息将逐条立即处理。")
+    return False
+
+
+# 定义一个函数，用于获取消息防抖的统计数据
+def get_debounce_stats() -> Dict[str, float]:
+    """返回消息防抖的统计数据，包括平均每次处理合并了多少条消息"""
+    stats = dict(debounce_stats)
+    stats['pending_chats'] = len(_pending_bursts)
+    stats['avg_burst_size'] = stats['messages'] / stats['bursts'] if stats['bursts'] else 0.0
+    return stats
 
 
 # 定义处理所有文本消息的主函数
+@timed(HANDLER_LATENCY, HANDLER_ERRORS, handler='text_message_handler')
+@traced('text_message_handler')
 async def text_message_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    """处理所有文本消息，作为一个状态机"""
+    """
+    处理所有文本消息。
+    每条消息到达时立即保存；同一个聊天在防抖窗口内连续发来的消息合并成一段，只判断和回复一次。
+    """
     # 如果收到的更新里没有消息，或者消息里没有文本，就直接返回，不做任何处理
     if not update.message or not update.message.text:
         return
@@ -62,6 +109,75 @@ async def text_message_handler(update: Update, context: ContextTypes.DEFAULT_TYP
     user_message = update.message.text
     # 将用户发送的这条消息保存到数据库
     await save_chat_message(user_id, "user", user_message)
+    debounce_stats['messages'] += 1
+
+    # 没有开启防抖时，每条消息立即处理
+    if not _debounce_enabled(context):
+        debounce_stats['bursts'] += 1
+        await respond_to_messages(update, context, [user_message])
+        return
+
+    now = time.monotonic()
+    burst = _pending_bursts.get(chat_id)
+    if burst is None:
+        # 这个聊天的第一条消息：开始收集，并安排窗口结束后统一处理
+        burst = _pending_bursts[chat_id] = _MessageBurst([], update, now, now)
+        context.application.create_task(_flush_burst_when_quiet(chat_id, context))
+    burst.texts.append(user_message)
+    burst.update = update
+    # 每来一条消息就把截止时间往后推，但总等待时间不超过上限
+    burst.deadline = min(now + MESSAGE_DEBOUNCE_MS / 1000, burst.started + MESSAGE_DEBOUNCE_MAX_MS / 1000)
+
+
+# 定义一个异步函数，等用户停止输入后处理收集到的消息
+async def _flush_burst_when_quiet(chat_id: int, context: ContextTypes.DEFAULT_TYPE):
+    """等到防抖窗口结束，再按这个聊天的更新顺序处理合并后的消息"""
+    while True:
+        burst = _pending_bursts.get(chat_id)
+        if burst is None:
+            return
+        delay = burst.deadline - time.monotonic()
+        if delay <= 0:
+            break
+        await asyncio.sleep(delay)
+
+    # 和这个聊天的其他更新一起排队，保证状态机不会并发执行
+    try:
+        await context.application.update_processor.run_ordered(chat_id, _process_burst(chat_id, context))
+    except Exception as e:
+        logger.error(f"处理聊天 {chat_id} 合并后的消息失败: {e}")
+
+
+async def flush_pending_burst(chat_id: int, context: ContextTypes.DEFAULT_TYPE):
+    """
+    这个聊天的其他更新（/start、按钮点击）开始处理之前，先处理还在防抖窗口里的消息。
+    调用方已经在这个聊天的顺序里执行，所以这里直接处理，不再排队；窗口结束时的后台任务会发现消息已经被取走。
+    """
+    if chat_id not in _pending_bursts:
+        return
+    try:
+        await _process_burst(chat_id, context)
+    except Exception as e:
+        logger.error(f"处理聊天 {chat_id} 合并后的消息失败: {e}")
+
+
+async def _process_burst(chat_id: int, context: ContextTypes.DEFAULT_TYPE):
+    # 拿到聊天锁之后才取走消息；之后再来的消息会开始新的一轮收集
+    burst = _pending_bursts.pop(chat_id, None)
+    if burst is None:
+        return
+    debounce_stats['bursts'] += 1
+    await respond_to_messages(burst.update, context, burst.texts)
+
+
+# 定义一个异步函数，根据用户当前的状态回复一条或多条消息，作为一个状态机
+@timed(HANDLER_LATENCY, HANDLER_ERRORS, handler='respond_to_messages')
+@traced('respond_to_messages')
+async def respond_to_messages(update: Update, context: ContextTypes.DEFAULT_TYPE, messages: List[str]) -> None:
+    """把连续发来的消息合并成一段文字，判断意图并回复一次"""
+    user_id = update.effective_user.id
+    chat_id = update.effective_chat.id
+    user_message = "\n".join(messages)
 
     # 从数据库获取该用户的完整数据
     user_data = await get_user_data(user_id)
@@ -78,6 +194,7 @@ async def text_message_handler(update: Update, context: ContextTypes.DEFAULT_TYP
     current_state = user_data.get('state', 'started')
     # 获取用户偏好的语言，如果没记录，则默认为 'en' (英语)
     language_code = user_data.get('language_code', 'en')
+    annotate(state=current_state, messages=len(messages))
 
     # 调用语言检测工具，判断用户最新消息的语言
     detected_lang = detect_language(user_message)
@@ -91,15 +208,15 @@ async def text_message_handler(update: Update, context: ContextTypes.DEFAULT_TYP
     # await context.bot.send_chat_action(chat_id=chat_id, action=ChatAction.TYPING)
     # await asyncio.sleep(2)
     if current_state == 'awaiting_user_id':
-        # 如果是，就判断用户发来的消息是不是9位纯数字
-        if user_message.isdigit() and len(user_message) == 9:
-            # 如果是，就打印一条成功日志
-            logger.info(f"用户 {user_id} 提供了有效的ID: {user_message}")
+        # 如果是，就判断用户发来的消息里有没有9位纯数字（连续发了多条时取最后一个）
+        valid_ids = [m.strip() for m in messages if m.strip().isdigit() and len(m.strip()) == 9]
+        if valid_ids:
+            # 如果有，就打印一条成功日志
+            logger.info(f"用户 {user_id} 提供了有效的ID: {valid_ids[-1]}")
             # 定义回复内容
             reply_text = "Thank you! Your registration is successful."
             # 回复用户注册成功
-            await context.bot.send_chat_action(chat_id=chat_id, action=ChatAction.TYPING)
-            await asyncio.sleep(3)
+            await typing_pause(context, chat_id)
             await update.message.reply_text(reply_text)
             # 在数据库里记录这次回复
             await save_chat_message(user_id, "bot", reply_text)
@@ -113,8 +230,7 @@ async def text_message_handler(update: Update, context: ContextTypes.DEFAULT_TYP
             # 定义回复内容
             reply_text = "The ID seems invalid. It must be a 9-digit number. Please try again."
             # 回复用户ID无效，让他重试
-            await context.bot.send_chat_action(chat_id=chat_id, action=ChatAction.TYPING)
-            await asyncio.sleep(3)
+            await typing_pause(context, chat_id)
             await update.message.reply_text(reply_text)
             # 在数据库里记录这次回复
             await save_chat_message(user_id, "bot", reply_text)
@@ -133,8 +249,7 @@ async def text_message_handler(update: Update, context: ContextTypes.DEFAULT_TYP
         if intent == 'service_request':
             # 就向用户提问“您以前玩过我们的游戏吗？”
             question = "Great! Have you played our game before?"
-            await context.bot.send_chat_action(chat_id=chat_id, action=ChatAction.TYPING)
-            await asyncio.sleep(3)
+            await typing_pause(context, chat_id)
             await update.message.reply_text(question)
             await save_chat_message(user_id, "bot", question)
             # 并将用户的状态更新为“等待确认游戏经验”
@@ -150,29 +265,24 @@ async def text_message_handler(update: Update, context: ContextTypes.DEFAULT_TYP
         # 如果用户的意图是“玩过”
         if intent == 'played_before':
             # 就直接发送游戏链接和策略按钮
-            await context.bot.send_chat_action(chat_id=chat_id, action=ChatAction.TYPING)
-            await asyncio.sleep(3)
+            await typing_pause(context, chat_id)
             await send_service_link(update, context)
             # 并将用户的状态更新为“已完成”，会员状态设为“已确认”
             await update_user_data(user_id, {'state': 'completed', 'service_status': 'confirmed'})
         # 如果用户的意图是“没玩过”（新玩家）
         elif intent == 'new_player':
             # 就发送注册和充值教程
-            await context.bot.send_chat_action(chat_id=chat_id, action=ChatAction.UPLOAD_PHOTO)
-            await asyncio.sleep(3)
+            await typing_pause(context, chat_id, ChatAction.UPLOAD_PHOTO)
             await send_registration_guide(update, context)
             # 并将用户的状态更新为“等待注册确认”
             await update_user_data(user_id, {'state': 'awaiting_registration_confirmation'})
-            # 同时，设置一个2分钟后触发的一次性定时任务，用来提醒用户
-            context.job_queue.run_once(
-                registration_reminder, 120, chat_id=update.effective_chat.id,
-                user_id=user_id, name=f"reminder_{user_id}"
-            )
+            # 同时，在数据库里安排一条2分钟后的提醒，到期时用户仍未确认注册才会发送
+            await reminders.schedule(reminders.REGISTRATION_REMINDER, user_id, chat_id,
+                                     reminders.REGISTRATION_REMINDER_DELAY)
         # 如果是其他意图
         else:
             # 就回复AI生成的闲聊内容
-            await context.bot.send_chat_action(chat_id=chat_id, action=ChatAction.TYPING)
-            await asyncio.sleep(3)
+            await typing_pause(context, chat_id)
             await update.message.reply_text(reply)
             await save_chat_message(user_id, "bot", reply)
 
@@ -182,8 +292,7 @@ async def text_message_handler(update: Update, context: ContextTypes.DEFAULT_TYP
         if intent == 'registration_complete':
             # 就向用户提问，索要他的用户ID
             question = "Awesome! Please send me your 9-digit User ID to complete the process."
-            await context.bot.send_chat_action(chat_id=chat_id, action=ChatAction.TYPING)
-            await asyncio.sleep(2)
+            await typing_pause(context, chat_id, seconds=2)
             await update.message.reply_text(question)
             await save_chat_message(user_id, "bot", question)
             # 并将用户的状态更新为“等待输入用户ID”
@@ -191,8 +300,7 @@ async def text_message_handler(update: Update, context: ContextTypes.DEFAULT_TYP
         # 如果是其他意图
         else:
             # 就回复AI生成的闲聊内容
-            await context.bot.send_chat_action(chat_id=chat_id, action=ChatAction.TYPING)
-            await asyncio.sleep(2)
+            await typing_pause(context, chat_id, seconds=2)
             await update.message.reply_text(reply)
             await save_chat_message(user_id, "bot", reply)
 
@@ -0,0 +1,159 @@
+# services/ai_backends.py
+
+import asyncio
+import json
+import logging
+import random
+from abc import ABC, abstractmethod
+from typing import Any, Dict, Optional
+
+from telegram_bot import config
+from services.intent_prompt import (SYSTEM_INSTRUCTION, INTENT_RESPONSE_SCHEMA, BATCH_SYSTEM_INSTRUCTION,
+                                    BATCH_INTENT_RESPONSE_SCHEMA)
+from utils.intent_classifier import classify_intent_locally
+
+try:
+    # google-generativeai 依赖 google-api-core，桩实现用它的异常类型模拟 429
+    from google.api_core import exceptions as google_exceptions
+except ImportError:  # pragma: no cover - 只在缺少依赖时走到这里
+    google_exceptions = None
+
+logger = logging.getLogger(__name__)
+
+# 使用哪个 AI 后端：'gemini' 调用真实的 Gemini，'stub' 使用本地的确定性桩实现（压测和离线调试用）
+AI_BACKEND = getattr(config, 'AI_BACKEND', 'gemini')
+# Gemini 模型名称
+GEMINI_MODEL_NAME = getattr(config, 'GEMINI_MODEL_NAME', 'gemini-1.5-flash')
+# 桩实现的模拟延迟（秒）和随机抖动（秒）
+AI_STUB_LATENCY = getattr(config, 'AI_STUB_LATENCY', 0.3)
+AI_STUB_LATENCY_JITTER = getattr(config, 'AI_STUB_LATENCY_JITTER', 0.1)
+# 桩实现返回临时性错误和 429 额度错误的概率（0 到 1）
+AI_STUB_ERROR_RATE = getattr(config, 'AI_STUB_ERROR_RATE', 0.0)
+AI_STUB_QUOTA_ERROR_RATE = getattr(config, 'AI_STUB_QUOTA_ERROR_RATE', 0.0)
+# 桩实现随机数的种子，相同的种子得到相同的延迟和错误序列
+AI_STUB_SEED = getattr(config, 'AI_STUB_SEED', None)
+
+
+class AIBackend(ABC):
+    """
+    意图判断的 AI 后端接口。
+    输入是 intent_prompt 构造好的 JSON 字符串，输出是模型返回的原始文本，解析和校验由调用方负责。
+    """
+
+    name = 'base'
+
+    @abstractmethod
+    async def generate(self, prompt: str) -> str:
+        """判断一条请求的意图，返回 {"intent", "reply"} 格式的 JSON 文本"""
+
+    @abstractmethod
+    async def generate_batch(self, prompt: str) -> str:
+        """判断一批请求的意图，返回 [{"id", "intent", "reply"}] 格式的 JSON 文本"""
+
+
+class GeminiBackend(AIBackend):
+    """调用 Google Gemini，固定说明放在系统指令里，并开启 JSON 结构化输出"""
+
+    name = 'gemini'
+
+    def __init__(self, api_key: str, model_name: str = GEMINI_MODEL_NAME):
+        import google.generativeai as genai
+
+        genai.configure(api_key=api_key)
+        self.model_name = model_name
+        self._model = genai.GenerativeModel(
+            model_name,
+            system_instruction=SYSTEM_INSTRUCTION,
+            generation_config=genai.GenerationConfig(
+                response_mime_type="application/json",
+                response_schema=INTENT_RESPONSE_SCHEMA,
+            ),
+        )
+        # 批量模式的模型：一次处理多个用户的消息，返回带 id 的结果数组
+        self._batch_model = genai.GenerativeModel(
+            model_name,
+            system_instruction=BATCH_SYSTEM_INSTRUCTION,
+            generation_config=genai.GenerationConfig(
+                response_mime_type="application/json",
+                response_schema=BATCH_INTENT_RESPONSE_SCHEMA,
+            ),
+        )
+
+    async def generate(self, prompt: str) -> str:
+        response = await self._model.generate_content_async(prompt)
+        return response.text
+
+    async def generate_batch(self, prompt: str) -> str:
+        response = await self._batch_model.generate_content_async(prompt)
+        return response.text
+
+
+class StubBackend(AIBackend):
+    """
+    不访问网络的确定性桩实现，用于压测和离线调试。
+    - 意图由本地关键词规则决定，规则判断不了的一律当作闲聊，同样的输入永远得到同样的意图
+    - 可以配置延迟、临时性错误率和 429 错误率，模拟 AI 变慢或出故障时机器人的表现
+    """
+
+    name = 'stub'
+
+    def __init__(self, latency: float = AI_STUB_LATENCY, latency_jitter: float = AI_STUB_LATENCY_JITTER,
+                 error_rate: float = AI_STUB_ERROR_RATE, quota_error_rate: float = AI_STUB_QUOTA_ERROR_RATE,
+                 seed: Optional[int] = AI_STUB_SEED):
+        self.latency = latency
+        self.latency_jitter = latency_jitter
+        self.error_rate = error_rate
+        self.quota_error_rate = quota_error_rate
+        self._random = random.Random(seed)
+        self.calls = 0
+        self.injected_errors = 0
+        self.injected_quota_errors = 0
+
+    async def _simulate_call(self):
+        """模拟网络延迟，并按配置的概率抛出错误"""
+        self.calls += 1
+        delay = self.latency + self._random.uniform(-self.latency_jitter, self.latency_jitter)
+        if delay > 0:
+            await asyncio.sleep(delay)
+        roll = self._random.random()
+        if roll < self.quota_error_rate:
+            self.injected_quota_errors += 1
+            if google_exceptions is not None:
+                raise google_exceptions.ResourceExhausted("429 quota exceeded (stub)")
+            raise RuntimeError("429 quota exceeded (stub)")
+        if roll < self.quota_error_rate + self.error_rate:
+            self.injected_errors += 1
+            raise ConnectionError("stub backend error")
+
+    @staticmethod
+    def _classify(request: Dict[str, Any]) -> Dict[str, str]:
+        language_code = 'hi' if request.get("reply_language") == "Hindi" else 'en'
+        result = classify_intent_locally(request.get("state", ""), request.get("message", ""), language_code)
+        if result is not None:
+            return {"intent": result["intent"], "reply": result["reply"]}
+        return {"intent": "small_talk", "reply": "Thanks for your message! (stub reply)"}
+
+    async def generate(self, prompt: str) -> str:
+        await self._simulate_call()
+        return json.dumps(self._classify(json.loads(prompt)), ensure_ascii=False)
+
+    async def generate_batch(self, prompt: str) -> str:
+        await self._simulate_call()
+        results = [dict(self._classify(request), id=request.get("id")) for request in json.loads(prompt)]
+        return json.dumps(results, ensure_ascii=False)
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            'calls': self.calls,
+            'injected_errors': self.injected_errors,
+            'injected_quota_errors': self.injected_quota_errors,
+        }
+
+
+def create_backend(name: str = AI_BACKEND, api_key: Optional[str] = None) -> AIBackend:
+    """按名称创建 AI 后端，名称未知时抛出 ValueError"""
+    if name == 'gemini':
+        return GeminiBackend(api_key)
+    if name == 'stub':
+        return StubBackend()
+    raise ValueError(f"未知的 AI 后端: {name!r}")
@@ -0,0 +1,218 @@
+# services/ai_governor.py
+
+import asyncio
+import logging
+import random
+import time
+from typing import Awaitable, Callable, Dict, TypeVar
+
+from telegram_bot import config
+from utils.rate_limiter import TokenBucket
+
+try:
+    # google-generativeai 依赖 google-api-core，这里用它的异常类型判断错误种类
+    from google.api_core import exceptions as google_exceptions
+except ImportError:  # pragma: no cover - 只在缺少依赖时走到这里
+    google_exceptions = None
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar('T')
+
+# 同时进行的 AI 调用数上限
+AI_MAX_CONCURRENCY = getattr(config, 'AI_MAX_CONCURRENCY', 8)
+# 每分钟最多发起多少次 AI 调用
+AI_REQUESTS_PER_MINUTE = getattr(config, 'AI_REQUESTS_PER_MINUTE', 60)
+# 预计排队时间超过这个秒数时直接拒绝，不再排队
+AI_MAX_QUEUE_WAIT = getattr(config, 'AI_MAX_QUEUE_WAIT', 10.0)
+# 临时性错误的最大重试次数，以及退避时间的基数和上限（秒）
+AI_MAX_RETRIES = getattr(config, 'AI_MAX_RETRIES', 2)
+AI_BACKOFF_BASE = getattr(config, 'AI_BACKOFF_BASE', 0.5)
+AI_BACKOFF_MAX = getattr(config, 'AI_BACKOFF_MAX', 8.0)
+# 额度用尽后熔断多久（秒）；连续熔断时时间翻倍，直到上限
+AI_CIRCUIT_COOLDOWN = getattr(config, 'AI_CIRCUIT_COOLDOWN', 60.0)
+AI_CIRCUIT_MAX_COOLDOWN = getattr(config, 'AI_CIRCUIT_MAX_COOLDOWN', 3600.0)
+
+
+class AIUnavailableError(Exception):
+    """AI 调用被限流器拒绝时抛出的异常基类"""
+
+
+class QuotaExhaustedError(AIUnavailableError):
+    """AI 额度已用尽，熔断器处于打开状态"""
+
+
+class AIOverloadedError(AIUnavailableError):
+    """排队的请求太多，为了快速失败而拒绝本次调用"""
+
+
+def is_quota_error(error: Exception) -> bool:
+    """判断是否是 429 / 额度用尽的错误"""
+    if google_exceptions is not None and isinstance(error, google_exceptions.ResourceExhausted):
+        return True
+    error_str = str(error).lower()
+    return "429" in error_str and "quota" in error_str
+
+
+def is_transient_error(error: Exception) -> bool:
+    """判断是否是值得重试的临时性错误（超时、5xx、网络问题）"""
+    if google_exceptions is not None and isinstance(error, (
+            google_exceptions.ServiceUnavailable,
+            google_exceptions.InternalServerError,
+            google_exceptions.DeadlineExceeded,
+            google_exceptions.GatewayTimeout,
+            google_exceptions.BadGateway)):
+        return True
+    return isinstance(error, (asyncio.TimeoutError, ConnectionError))
+
+
+class AIGovernor:
+    """
+    AI 调用的统一管控。
+    - 信号量限制并发数，令牌桶限制每分钟请求数
+    - 预计排队时间过长时立即拒绝，而不是堆积大量注定失败的请求
+    - 临时性错误和 429 按带抖动的指数退避重试
+    - 重试后仍然 429 时打开熔断器，熔断期间直接失败；冷却后放一个探测请求试探
+    """
+
+    def __init__(self, max_concurrency: int = AI_MAX_CONCURRENCY,
+                 requests_per_minute: float = AI_REQUESTS_PER_MINUTE,
+                 max_queue_wait: float = AI_MAX_QUEUE_WAIT, max_retries: int = AI_MAX_RETRIES,
+                 backoff_base: float = AI_BACKOFF_BASE, backoff_max: float = AI_BACKOFF_MAX,
+                 circuit_cooldown: float = AI_CIRCUIT_COOLDOWN,
+                 circuit_max_cooldown: float = AI_CIRCUIT_MAX_COOLDOWN):
+        self.max_concurrency = max_concurrency
+        self.max_queue_wait = max_queue_wait
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.circuit_cooldown = circuit_cooldown
+        self.circuit_max_cooldown = circuit_max_cooldown
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self._bucket = TokenBucket(requests_per_minute, capacity=max(1.0, requests_per_minute / 4), period=60)
+        self._waiting = 0
+        self._in_flight = 0
+        # 熔断器状态：closed 正常，open 熔断中，half_open 冷却结束、正在探测
+        self._circuit_state = 'closed'
+        self._circuit_open_until = 0.0
+        self._current_cooldown = circuit_cooldown
+        self.calls = 0
+        self.succeeded = 0
+        self.failed = 0
+        self.retries = 0
+        self.shed = 0
+        self.circuit_rejections = 0
+        self.circuit_trips = 0
+
+    @property
+    def circuit_state(self) -> str:
+        if self._circuit_state == 'open' and time.monotonic() >= self._circuit_open_until:
+            return 'half_open'
+        return self._circuit_state
+
+    def _check_circuit(self):
+        """熔断中直接失败；冷却结束后只放行一个探测请求"""
+        state = self.circuit_state
+        if state == 'closed':
+            return
+        if state == 'half_open' and self._circuit_state == 'open':
+            # 第一个到达的请求成为探测请求
+            self._circuit_state = 'half_open'
+            return
+        self.circuit_rejections += 1
+        raise QuotaExhaustedError("AI 额度已用尽，熔断中")
+
+    def _trip_circuit(self):
+        if self._circuit_state == 'half_open':
+            # 探测失败，冷却时间翻倍
+            self._current_cooldown = min(self._current_cooldown * 2, self.circuit_max_cooldown)
+        self._circuit_state = 'open'
+        self._circuit_open_until = time.monotonic() + self._current_cooldown
+        self.circuit_trips += 1
+        logger.warning(f"AI 额度用尽，熔断 {self._current_cooldown:.0f} 秒。")
+
+    def _close_circuit(self):
+        if self._circuit_state != 'closed':
+            logger.info("AI 调用恢复正常，熔断器已关闭。")
+        self._circuit_state = 'closed'
+        self._current_cooldown = self.circuit_cooldown
+
+    def _backoff(self, attempt: int) -> float:
+        """带完全抖动的指数退避"""
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * (2 ** attempt)))
+
+    async def _acquire_slot(self):
+        """拿到令牌和并发名额；预计等待太久时抛出 AIOverloadedError"""
+        expected_wait = self._bucket.time_until_available() + self._waiting / self._bucket.rate
+        if expected_wait > self.max_queue_wait:
+            self.shed += 1
+            raise AIOverloadedError(f"AI 请求排队预计需要 {expected_wait:.1f} 秒")
+        self._waiting += 1
+        started = time.monotonic()
+        try:
+            await self._bucket.acquire()
+            remaining = max(0.05, self.max_queue_wait - (time.monotonic() - started))
+            try:
+                await asyncio.wait_for(self._semaphore.acquire(), remaining)
+            except asyncio.TimeoutError:
+                self.shed += 1
+                raise AIOverloadedError("等待 AI 并发名额超时")
+        finally:
+            self._waiting -= 1
+
+    async def call(self, func: Callable[[], Awaitable[T]]) -> T:
+        """在限流、重试和熔断的保护下执行一次 AI 调用"""
+        self.calls += 1
+        self._check_circuit()
+        probing = self._circuit_state == 'half_open'
+        attempt = 0
+        try:
+            while True:
+                await self._acquire_slot()
+                self._in_flight += 1
+                try:
+                    result = await func()
+                except Exception as e:
+                    quota_error = is_quota_error(e)
+                    if (quota_error or is_transient_error(e)) and attempt < self.max_retries and not probing:
+                        delay = self._backoff(attempt)
+                        attempt += 1
+                        self.retries += 1
+                        logger.warning(f"AI 调用失败，{delay:.1f} 秒后第 {attempt} 次重试: {e}")
+                    else:
+                        if quota_error:
+                            self._trip_circuit()
+                            raise QuotaExhaustedError(str(e)) from e
+                        raise
+                else:
+                    self._close_circuit()
+                    self.succeeded += 1
+                    return result
+                finally:
+                    self._in_flight -= 1
+                    self._semaphore.release()
+                await asyncio.sleep(delay)
+        except QuotaExhaustedError:
+            self.failed += 1
+            raise
+        except Exception:
+            self.failed += 1
+            if probing and self._circuit_state == 'half_open':
+                # 探测请求因为其他原因失败，让下一个请求继续探测
+                self._circuit_state = 'open'
+                self._circuit_open_until = time.monotonic()
+            raise
+
+    def stats(self) -> Dict[str, float]:
+        return {
+            'calls': self.calls,
+            'succeeded': self.succeeded,
+            'failed': self.failed,
+            'retries': self.retries,
+            'shed': self.shed,
+            'in_flight': self._in_flight,
+            'waiting': self._waiting,
+            'circuit_open': int(self.circuit_state != 'closed'),
+            'circuit_trips': self.circuit_trips,
+            'circuit_rejections': self.circuit_rejections,
+        }
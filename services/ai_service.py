@@ -2,127 +2,210 @@
 
 # 导入 logging 模块，用于记录程序运行信息
 import logging
-# 导入 json 模块，用于解析 AI 返回的 JSON 格式字符串
-import json
-# 从 typing 模块导入 Dict 类型，用于类型提示
-from typing import Dict
-# 导入 Google Gemini 的官方库
-import google.generativeai as genai
+# 从 typing 模块导入类型提示
+from typing import Any, Dict, List, Optional, Tuple
 
+# 导入我们自己写的配置文件
+from telegram_bot import config
 # 导入我们自己写的数据库服务，用来获取聊天记录
 from services.db_service import get_chat_history
+# 导入 AI 调用的限流、重试和熔断管控
+from services.ai_governor import AIGovernor, AIOverloadedError, QuotaExhaustedError
+# 导入意图判断的提示词构造和结果解析
+from services.intent_prompt import (build_intent_request, build_batch_intent_prompt, serialize_intent_request,
+                                    parse_intent_response, parse_batch_intent_response)
+# 导入可切换的 AI 后端（Gemini 或本地桩实现）
+from services.ai_backends import AI_BACKEND, AIBackend, create_backend
+# 导入意图判断的微批处理
+from services.intent_batcher import IntentBatcher
+# 导入本地的关键词意图分类器
+from utils.intent_classifier import classify_intent_locally, normalize_message
+# 导入带过期时间的 LRU 缓存
+from utils.lru_cache import LRUCache
+# 导入指标（耗时分布、错误计数）和按更新的耗时追踪
+from utils import metrics, tracing
 
 # 获取一个日志记录器实例，用于在这个文件中打印日志
 logger = logging.getLogger(__name__)
 
-# 初始化一个全局变量，用来存放 Gemini 模型实例
-gemini_model = None
+# 初始化一个全局变量，用来存放当前使用的 AI 后端实例
+ai_backend: Optional[AIBackend] = None
 
+# 所有 AI 调用都经过这个管控器
+ai_governor = AIGovernor()
 
-# 定义一个函数，用于初始化 Gemini 模型
-def initialize_gemini(api_key: str):
-    """初始化 Gemini 模型"""
-    # 声明我们将要修改的是全局变量 gemini_model
-    global gemini_model
+# 每次 AI 后端调用（含管控器重试的每一次尝试）的耗时和失败次数
+AI_LATENCY = metrics.histogram('ai_request_duration_seconds', 'AI 后端调用耗时（秒）', ['backend', 'kind'])
+AI_ERRORS = metrics.counter('ai_request_errors_total', 'AI 后端调用失败次数', ['backend', 'kind'])
+
+# 额度用尽和系统繁忙时的固定回复
+QUOTA_EXHAUSTED_REPLY = "Sorry, the free call quota for today has been used up. Please try again tomorrow."
+OVERLOADED_REPLY = "Sorry, I'm a little busy right now. Please try again in a moment."
+
+# 本地分类器的置信度达到这个值时，直接采用结果，不再调用 Gemini
+LOCAL_INTENT_CONFIDENCE_THRESHOLD = getattr(config, 'LOCAL_INTENT_CONFIDENCE_THRESHOLD', 0.8)
+
+# 是否把同一时间窗口内的意图判断合并成一次 Gemini 调用
+AI_BATCH_ENABLED = getattr(config, 'AI_BATCH_ENABLED', False)
+# 收集请求的时间窗口（毫秒）和每批最多包含的请求数
+AI_BATCH_WINDOW_MS = getattr(config, 'AI_BATCH_WINDOW_MS', 150)
+AI_BATCH_MAX_SIZE = getattr(config, 'AI_BATCH_MAX_SIZE', 16)
+
+# 意图判断的统计：总次数、本地规则直接判断的次数、命中意图缓存的次数、调用 Gemini 的次数、
+# 需要 Gemini 但 AI 后端没有初始化的次数
+intent_stats = {'total': 0, 'local': 0, 'cached': 0, 'gemini': 0, 'unavailable': 0}
+
+# 只缓存推动状态流转的意图；闲聊等需要个性化回复的意图永远不缓存
+CACHEABLE_INTENTS = {'service_request', 'played_before', 'new_player', 'registration_complete'}
+# 意图缓存：键是 (状态, 语言, 规范化后的消息)
+_intent_cache = LRUCache(maxsize=getattr(config, 'INTENT_CACHE_SIZE', 5000),
+                         ttl=getattr(config, 'INTENT_CACHE_TTL', 3600))
+
+
+# 定义一个函数，生成意图缓存的键
+def _intent_cache_key(current_state: str, language_code: str, user_message: str):
+    return current_state, language_code, normalize_message(user_message)
+
+
+# 定义一个函数，用于获取意图判断的统计数据
+def get_intent_stats() -> Dict[str, float]:
+    """返回意图判断的统计数据，包括跳过 Gemini 的比例"""
+    stats = dict(intent_stats)
+    stats['local_share'] = stats['local'] / stats['total'] if stats['total'] else 0.0
+    stats['cache_hits'] = _intent_cache.hits
+    stats['cache_misses'] = _intent_cache.misses
+    stats['cache_hit_rate'] = _intent_cache.hit_rate
+    stats['cache_size'] = len(_intent_cache)
+    stats.update({f'governor_{key}': value for key, value in ai_governor.stats().items()})
+    stats.update({f'batch_{key}': value for key, value in intent_batcher.stats().items()})
+    # 桩实现会额外报告注入的错误数
+    if ai_backend is not None and hasattr(ai_backend, 'stats'):
+        stats.update({f'backend_{key}': value for key, value in ai_backend.stats().items()})
+    return stats
+
+
+# 定义一个函数，用于初始化 AI 后端
+def initialize_ai_backend(api_key: Optional[str] = None, backend_name: str = AI_BACKEND):
+    """按配置初始化 AI 后端：'gemini' 需要 API Key，'stub' 不访问网络"""
+    # 声明我们将要修改的是全局变量 ai_backend
+    global ai_backend
     # 使用 try...except 结构来捕获可能发生的错误
     try:
-        # 使用 API Key 配置 Gemini 库
-        genai.configure(api_key=api_key)
-        # 创建一个 gemini-1.5-flash 模型的实例
-        gemini_model = genai.GenerativeModel('gemini-1.5-flash')
+        ai_backend = create_backend(backend_name, api_key)
         # 打印一条成功日志
-        logger.info("Google Gemini 初始化成功。")
-        # 返回创建好的模型实例
-        return gemini_model
+        logger.info(f"AI 后端 {ai_backend.name} 初始化成功。")
+        # 返回创建好的后端实例
+        return ai_backend
     # 如果在初始化过程中发生任何异常
     except Exception as e:
         # 打印一条错误日志，并附上错误信息
-        logger.error(f"Google Gemini 初始化失败: {e}")
+        logger.error(f"AI 后端 {backend_name} 初始化失败: {e}")
         # 返回 None，表示初始化失败
         return None
 
 
+# 定义一个函数，用于初始化 Gemini 模型（保留旧的入口）
+def initialize_gemini(api_key: str):
+    """初始化 Gemini 后端"""
+    return initialize_ai_backend(api_key, 'gemini')
+
+
+# 定义一个异步函数，调用一次 AI 后端并记录耗时
+async def _generate(kind: str, prompt: str) -> str:
+    """kind 是 'single' 或 'batch'，决定调用 generate 还是 generate_batch"""
+    backend = ai_backend
+    with metrics.track(AI_LATENCY, AI_ERRORS, backend=backend.name, kind=kind):
+        if kind == 'batch':
+            return await backend.generate_batch(prompt)
+        return await backend.generate(prompt)
+
+
+# 定义一个异步函数，单独调用一次 AI 后端判断一条消息的意图
+async def _classify_single(request: Dict[str, Any]) -> Dict[str, str]:
+    """通过管控器调用 AI 后端，解析并校验返回的 JSON"""
+    prompt = serialize_intent_request(request)
+    response_text = await ai_governor.call(lambda: _generate('single', prompt))
+    return parse_intent_response(response_text)
+
+
+# 定义一个异步函数，一次 AI 调用判断多条消息的意图
+async def _classify_batch(requests: List[Tuple[str, Dict[str, Any]]]) -> Dict[str, Dict[str, str]]:
+    """批量调用只占用一次请求配额；返回 {请求ID: 意图结果}，缺失的请求由批处理器单独重试"""
+    prompt = build_batch_intent_prompt(requests)
+    response_text = await ai_governor.call(lambda: _generate('batch', prompt))
+    return parse_batch_intent_response(response_text)
+
+
+# 意图判断的批处理器，只有开启 AI_BATCH_ENABLED 时才会用到
+intent_batcher = IntentBatcher(_classify_batch, _classify_single, window=AI_BATCH_WINDOW_MS / 1000,
+                               max_batch_size=AI_BATCH_MAX_SIZE)
+
+
 # 定义一个异步函数，用于获取用户的意图
 async def get_user_intent(user_id: int, user_message: str, language_code: str, current_state: str) -> Dict[str, str]:
     """
     使用 Gemini API 判断用户意图，并根据用户当前状态和语言生成回复。
+    引导流程中的简短回答会先交给本地规则判断，置信度足够时不再调用 Gemini。
     """
-    # 检查模型是否已成功初始化
-    if not gemini_model:
+    intent_stats['total'] += 1
+    # 先用本地关键词规则判断
+    local_result = classify_intent_locally(current_state, user_message, language_code)
+    if local_result and local_result['confidence'] >= LOCAL_INTENT_CONFIDENCE_THRESHOLD:
+        intent_stats['local'] += 1
+        logger.info(f"本地规则意图分析结果 (用户状态: {current_state}): {local_result}")
+        return {"intent": local_result['intent'], "reply": local_result['reply']}
+
+    # 再查意图缓存：很多用户在同一状态下会发完全一样的简短回答
+    cache_key = _intent_cache_key(current_state, language_code, user_message)
+    cached_result = _intent_cache.get(cache_key)
+    if cached_result is not None:
+        intent_stats['cached'] += 1
+        return dict(cached_result)
+
+    # 检查 AI 后端是否已成功初始化
+    if not ai_backend:
+        intent_stats['unavailable'] += 1
         # 如果没有，就返回一个错误信息
         return {"intent": "error", "reply": "AI service is currently unavailable."}
+    intent_stats['gemini'] += 1
 
     # 从数据库获取该用户最近的聊天记录
     history_list = await get_chat_history(user_id)
-    # 将聊天记录列表转换成一个多行字符串，方便AI阅读
-    history_str = "\n".join([f"{item.get('role', 'unknown')}: {item.get('text', '')}" for item in history_list])
-
-    # 根据传入的语言代码，决定给AI下达的回复语言指令
-    if language_code == 'hi':
-        # 如果是 'hi'，就要求回复印地语
-        reply_language_instruction = "Hindi"
-    else:
-        # 否则，就要求回复印地语式英语
-        reply_language_instruction = "Hinglish (a casual, friendly mix of Hindi and English)"
-
-    # 定义给 Gemini AI 的“说明书”（Prompt）
-    prompt = f"""
-    You are a customer service assistant for a gaming service. Your goal is to guide the user through a conversation flow.
-    The user's preferred language is {reply_language_instruction}.
-    The user's current conversation state is: "{current_state}".
-
-    Conversation History:
-    {history_str}
-    ---
-    User's Latest Message: "{user_message}"
-    ---
-    **Conversation Flow Logic:**
-    - If state is 'awaiting_service_confirmation', user is answering "do you need our service?". Intent should be 'service_request' or 'rejection'.
-    - If state is 'awaiting_experience_confirmation', user is answering "have you played before?". Intent should be 'played_before' or 'new_player'.
-    - If state is 'awaiting_registration_confirmation', user is answering "have you registered?". Intent should be 'registration_complete'.
-    - Any other message should be 'small_talk'.
-
-    **Classify the user's intent into ONE of the following categories based on the logic above:**
-    1. "service_request": User wants the service.
-    2. "rejection": User does not want the service.
-    3. "played_before": User says they have played before.
-    4. "new_player": User says they are a new player.
-    5. "registration_complete": User confirms they have completed registration.
-    6. "registration_not_complete":  user has not confirmed that the registration has been completed
-    7. "small_talk": Any other message.
-    If the intent is "small_talk" or "rejection", please generate a friendly reply in {reply_language_instruction}.
-
-    Please return the result strictly in the following JSON format:
-    {{
-      "intent": "...",
-      "reply": "..."
-    }}
-    """
+    # 每次调用只发送状态、历史和最新消息，固定的说明已经在系统指令里
+    request = build_intent_request(current_state, language_code, history_list, user_message)
+
     # 使用 try...except 结构来捕获调用API时可能发生的错误
     try:
-        # 异步调用 Gemini 模型，生成内容
-        response = await gemini_model.generate_content_async(prompt)
-        # 清理AI返回的文本，移除可能存在的代码块标记
-        cleaned_response = response.text.strip().replace("```json", "").replace("```", "")
-        # 将清理后的字符串解析成 Python 字典
-        result = json.loads(cleaned_response)
+        # 开启批量模式时，和同一时间窗口内其他用户的请求合并成一次调用；
+        # ai 阶段包含管控器的排队和重试等待，以及批处理的收集窗口
+        with tracing.span('ai'):
+            if AI_BATCH_ENABLED:
+                result = await intent_batcher.classify(request)
+            else:
+                result = await _classify_single(request)
         # 打印一条成功日志，并附上AI的分析结果
         logger.info(f"Gemini 意图分析结果 (用户状态: {current_state}): {result}")
+        # 推动状态流转的意图放进缓存，下次同样的回答不再调用 Gemini
+        if result.get("intent") in CACHEABLE_INTENTS:
+            _intent_cache.set(cache_key, dict(result))
         # 返回解析后的结果字典
         return result
-    # 如果在调用过程中发生任何异常
+    # 如果额度已经用尽（熔断器打开），直接返回额度用尽的提示
+    except QuotaExhaustedError as e:
+        # 打印一条警告日志
+        logger.warning(f"Gemini API quota exceeded: {e}")
+        # 并返回一个专门针对额度用尽的错误信息
+        return {"intent": "error", "reply": QUOTA_EXHAUSTED_REPLY}
+    # 如果排队的请求太多，快速失败，让用户稍后再试
+    except AIOverloadedError as e:
+        logger.warning(f"Gemini 请求过多，已拒绝: {e}")
+        return {"intent": "error", "reply": OVERLOADED_REPLY}
+    # 如果 AI 返回的内容无法解析成合法的意图
+    except ValueError as e:
+        logger.error(f"Gemini 返回内容解析失败: {e}")
+        return {"intent": "error", "reply": "Sorry, I couldn't understand that. Please try again later."}
+    # 如果在调用过程中发生其他异常
     except Exception as e:
-        # 将错误信息转换为小写字符串，方便检查
-        error_str = str(e).lower()
-        # 检查错误信息中是否包含 "429" 和 "quota"，这通常表示免费额度用尽
-        if "429" in error_str and "quota" in error_str:
-            # 如果是，就打印一条警告日志
-            logger.warning(f"Gemini API quota exceeded: {e}")
-            # 并返回一个专门针对额度用尽的错误信息
-            return {"intent": "error",
-                    "reply": "Sorry, the free call quota for today has been used up. Please try again tomorrow."}
-
-        # 如果是其他类型的错误
         # 打印一条错误日志
         logger.error(f"Gemini API 调用失败: {e}")
         # 返回一个通用的错误信息
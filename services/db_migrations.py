@@ -0,0 +1,265 @@
+# services/db_migrations.py
+
+import logging
+from typing import List, Tuple
+
+logger = logging.getLogger(__name__)
+
+# MySQL 的 "Duplicate key name" 错误码：索引已经存在（比如之前手动建过）
+ER_DUP_KEYNAME = 1061
+
+# 按版本号排序的迁移列表，每一项是 (版本号, 名称, [SQL 语句...])
+# 已经发布的迁移不要再修改，新的改动请追加一个更大的版本号，并在 SQLITE_MIGRATIONS 里追加对应的 SQLite 版本
+MIGRATIONS: List[Tuple[int, str, List[str]]] = [
+    (1, 'chat_history_user_timestamp_index', [
+        # get_chat_history: WHERE user_id = ? ORDER BY timestamp DESC LIMIT n，走索引不再排序
+        "CREATE INDEX idx_chat_history_user_ts ON chat_history (user_id, timestamp)",
+    ]),
+    (2, 'users_broadcast_audience_index', [
+        # iter_subscribed_users: 等值条件在前，user_id 用来做键集分页，其余列让查询只读索引
+        "CREATE INDEX idx_users_broadcast_audience ON users "
+        "(service_status, subscribed_to_broadcast, user_id, push_message_count, chat_id, language_code)",
+    ]),
+    (3, 'chat_history_archive_table', [
+        # 维护任务会把旧的对话记录搬到这里，保持 chat_history 表和索引的大小有界
+        """
+        CREATE TABLE IF NOT EXISTS chat_history_archive
+        (
+            message_id INT PRIMARY KEY,
+            user_id BIGINT,
+            role VARCHAR(20),
+            text TEXT,
+            timestamp TIMESTAMP NULL,
+            archived_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            INDEX idx_chat_history_archive_user_ts (user_id, timestamp)
+        )
+        """,
+    ]),
+    (4, 'broadcast_cluster_tables', [
+        # 多进程部署：调度主节点的租约，以及由主节点创建、各进程认领的广播分片
+        """
+        CREATE TABLE IF NOT EXISTS leader_leases
+        (
+            name VARCHAR(64) PRIMARY KEY,
+            holder VARCHAR(128) NOT NULL,
+            expires_at DOUBLE NOT NULL
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS broadcast_rounds
+        (
+            round_id BIGINT AUTO_INCREMENT PRIMARY KEY,
+            multiplier VARCHAR(16) NOT NULL,
+            shard_count INT NOT NULL,
+            created_at DOUBLE NOT NULL,
+            INDEX idx_broadcast_rounds_created (created_at)
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS broadcast_shards
+        (
+            round_id BIGINT NOT NULL,
+            shard_index INT NOT NULL,
+            status VARCHAR(16) NOT NULL DEFAULT 'pending',
+            owner VARCHAR(128) NULL,
+            claimed_until DOUBLE NULL,
+            last_user_id BIGINT NULL,
+            sent INT DEFAULT 0,
+            failed INT DEFAULT 0,
+            attempts INT DEFAULT 0,
+            PRIMARY KEY (round_id, shard_index),
+            INDEX idx_broadcast_shards_status (status, claimed_until)
+        )
+        """,
+    ]),
+    (5, 'reminders_table', [
+        # 持久化的延时提醒：每个用户每种提醒最多一条，清扫任务按 due_at 分批取出到期的提醒
+        """
+        CREATE TABLE IF NOT EXISTS reminders
+        (
+            user_id BIGINT NOT NULL,
+            kind VARCHAR(32) NOT NULL,
+            chat_id BIGINT NOT NULL,
+            due_at DOUBLE NOT NULL,
+            PRIMARY KEY (user_id, kind),
+            INDEX idx_reminders_due (kind, due_at)
+        )
+        """,
+    ]),
+    (6, 'media_assets_table', [
+        # 图片等素材上传到 Telegram 之后得到的 file_id，之后发送时直接引用，不再重复上传
+        """
+        CREATE TABLE IF NOT EXISTS media_assets
+        (
+            name VARCHAR(64) PRIMARY KEY,
+            file_id VARCHAR(255) NOT NULL,
+            updated_at DOUBLE NOT NULL
+        )
+        """,
+    ]),
+]
+
+# 与 MIGRATIONS 版本号一一对应的 SQLite 语法版本
+SQLITE_MIGRATIONS: List[Tuple[int, str, List[str]]] = [
+    (1, 'chat_history_user_timestamp_index', [
+        "CREATE INDEX IF NOT EXISTS idx_chat_history_user_ts ON chat_history (user_id, timestamp)",
+    ]),
+    (2, 'users_broadcast_audience_index', [
+        "CREATE INDEX IF NOT EXISTS idx_users_broadcast_audience ON users "
+        "(service_status, subscribed_to_broadcast, user_id, push_message_count, chat_id, language_code)",
+    ]),
+    (3, 'chat_history_archive_table', [
+        """
+        CREATE TABLE IF NOT EXISTS chat_history_archive
+        (
+            message_id INTEGER PRIMARY KEY,
+            user_id INTEGER,
+            role TEXT,
+            text TEXT,
+            timestamp TIMESTAMP NULL,
+            archived_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_chat_history_archive_user_ts ON chat_history_archive (user_id, timestamp)",
+    ]),
+    (4, 'broadcast_cluster_tables', [
+        """
+        CREATE TABLE IF NOT EXISTS leader_leases
+        (
+            name TEXT PRIMARY KEY,
+            holder TEXT NOT NULL,
+            expires_at REAL NOT NULL
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS broadcast_rounds
+        (
+            round_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            multiplier TEXT NOT NULL,
+            shard_count INTEGER NOT NULL,
+            created_at REAL NOT NULL
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_broadcast_rounds_created ON broadcast_rounds (created_at)",
+        """
+        CREATE TABLE IF NOT EXISTS broadcast_shards
+        (
+            round_id INTEGER NOT NULL,
+            shard_index INTEGER NOT NULL,
+            status TEXT NOT NULL DEFAULT 'pending',
+            owner TEXT NULL,
+            claimed_until REAL NULL,
+            last_user_id INTEGER NULL,
+            sent INTEGER DEFAULT 0,
+            failed INTEGER DEFAULT 0,
+            attempts INTEGER DEFAULT 0,
+            PRIMARY KEY (round_id, shard_index)
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_broadcast_shards_status ON broadcast_shards (status, claimed_until)",
+    ]),
+    (5, 'reminders_table', [
+        """
+        CREATE TABLE IF NOT EXISTS reminders
+        (
+            user_id INTEGER NOT NULL,
+            kind TEXT NOT NULL,
+            chat_id INTEGER NOT NULL,
+            due_at REAL NOT NULL,
+            PRIMARY KEY (user_id, kind)
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_reminders_due ON reminders (kind, due_at)",
+    ]),
+    (6, 'media_assets_table', [
+        """
+        CREATE TABLE IF NOT EXISTS media_assets
+        (
+            name TEXT PRIMARY KEY,
+            file_id TEXT NOT NULL,
+            updated_at REAL NOT NULL
+        )
+        """,
+    ]),
+]
+
+
+async def apply_migrations(conn) -> int:
+    """按顺序执行尚未执行的迁移，返回本次执行的迁移数量"""
+    async with conn.cursor() as cur:
+        await cur.execute("""
+                          CREATE TABLE IF NOT EXISTS schema_migrations
+                          (
+                              version INT PRIMARY KEY,
+                              name VARCHAR(255) NOT NULL,
+                              applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                          )
+                          """)
+        # 多个进程同时启动时，只让一个进程执行迁移
+        await cur.execute("SELECT GET_LOCK('tg_z7game_schema_migrations', 60)")
+        (locked,) = await cur.fetchone()
+        if not locked:
+            raise RuntimeError("等待数据库迁移锁超时")
+        try:
+            await cur.execute("SELECT version FROM schema_migrations")
+            applied = {row[0] for row in await cur.fetchall()}
+            count = 0
+            for version, name, statements in sorted(MIGRATIONS):
+                if version in applied:
+                    continue
+                logger.info(f"正在执行数据库迁移 {version}: {name}")
+                for statement in statements:
+                    try:
+                        await cur.execute(statement)
+                    except Exception as e:
+                        if e.args and e.args[0] == ER_DUP_KEYNAME:
+                            logger.warning(f"迁移 {version} 的索引已存在，跳过: {e}")
+                            continue
+                        raise
+                await cur.execute("INSERT INTO schema_migrations (version, name) VALUES (%s, %s)", (version, name))
+                count += 1
+            if count:
+                logger.info(f"已执行 {count} 个数据库迁移。")
+            return count
+        finally:
+            await cur.execute("SELECT RELEASE_LOCK('tg_z7game_schema_migrations')")
+
+
+async def apply_sqlite_migrations(conn) -> int:
+    """
+    SQLite 版本的迁移：每个迁移和它的版本记录放在同一个写事务里。
+    BEGIN IMMEDIATE 会拿到数据库的写锁，多个进程共用一个数据库文件时，拿到锁之后再确认一次版本，
+    不会重复执行同一个迁移。
+    """
+    await conn.execute("""
+                       CREATE TABLE IF NOT EXISTS schema_migrations
+                       (
+                           version INTEGER PRIMARY KEY,
+                           name TEXT NOT NULL,
+                           applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                       )
+                       """)
+    async with conn.execute("SELECT version FROM schema_migrations") as cur:
+        applied = {row[0] for row in await cur.fetchall()}
+    count = 0
+    for version, name, statements in sorted(SQLITE_MIGRATIONS):
+        if version in applied:
+            continue
+        logger.info(f"正在执行数据库迁移 {version}: {name}")
+        await conn.execute("BEGIN IMMEDIATE")
+        try:
+            async with conn.execute("SELECT 1 FROM schema_migrations WHERE version = ?", (version,)) as cur:
+                if await cur.fetchone():
+                    await conn.commit()
+                    continue
+            for statement in statements:
+                await conn.execute(statement)
+            await conn.execute("INSERT INTO schema_migrations (version, name) VALUES (?, ?)", (version, name))
+        except Exception:
+            await conn.rollback()
+            raise
+        await conn.commit()
+        count += 1
+    if count:
+        logger.info(f"已执行 {count} 个数据库迁移。")
+    return count
@@ -1,179 +1,574 @@
 # services/db_service.py
 
+import asyncio
 import logging
-import aiomysql
-from typing import List, Dict, Any
+import time
+from contextlib import contextmanager
+from collections import OrderedDict, deque
+from typing import List, Dict, Any, Iterable, AsyncIterator, Optional, Tuple
 
 from telegram_bot import config
+from services.storage import Storage, create_storage
+from utils import metrics, tracing
+from utils.lru_cache import LRUCache
 logger = logging.getLogger(__name__)
 
-pool = None
+# 按配置选择的数据库实现（MySQL 或 SQLite），所有 SQL 都由它执行
+_storage: Storage = create_storage()
 
+# 每次数据库操作的耗时和失败次数，按操作名区分
+DB_LATENCY = metrics.histogram('db_query_duration_seconds', '数据库操作耗时（秒）', ['operation'])
+DB_ERRORS = metrics.counter('db_errors_total', '数据库操作失败次数', ['operation'])
 
-async def get_pool():
-    """获取或创建数据库连接池"""
-    global pool
-    if pool is None:
-        logger.info("Creating database connection pool...")
-        pool = await aiomysql.create_pool(
-            host=config.DB_HOST,
-            port=3306,
-            user=config.DB_USER,
-            password=config.DB_PASSWORD,
-            db=config.DB_NAME,
-            autocommit=True  # 自动提交事务
-        )
-    return pool
+
+@contextmanager
+def _track(operation: str):
+    """记录一次数据库操作的耗时，失败时计数；耗时同时算进当前追踪的 db 阶段"""
+    with tracing.span('db'), metrics.track(DB_LATENCY, DB_ERRORS, operation=operation):
+        yield
+
+
+# 批量更新时，每条 SQL 语句里最多包含的用户数
+BULK_CHUNK_SIZE = getattr(config, 'DB_BULK_CHUNK_SIZE', 1000)
+# 流式读取订阅用户时，每页读取的行数
+SUBSCRIBER_PAGE_SIZE = getattr(config, 'SUBSCRIBER_PAGE_SIZE', 1000)
+
+# 用户行缓存：活跃对话的 get_user_data 直接从内存返回
+_user_cache = LRUCache(maxsize=getattr(config, 'USER_CACHE_SIZE', 10000),
+                       ttl=getattr(config, 'USER_CACHE_TTL', 300))
+# user_id -> 正在从数据库读取这个用户的请求数
+_user_reads_in_flight: Dict[int, int] = {}
+# 读取期间被写过的用户，这些读取结果可能已经过时，不能放进缓存
+_user_written_during_read = set()
+
+# 每个用户在内存里保留最近多少条对话
+CHAT_HISTORY_BUFFER_TURNS = getattr(config, 'CHAT_HISTORY_BUFFER_TURNS', 10)
+# 所有用户的对话缓存加起来最多占用多少个字符，超过时淘汰最久不活跃的用户
+CHAT_HISTORY_BUFFER_MAX_CHARS = getattr(config, 'CHAT_HISTORY_BUFFER_MAX_CHARS', 20_000_000)
+
+
+class _ChatHistoryBuffer:
+    """
+    每个用户最近 N 条对话的内存环形缓冲区。
+    - 未命中时由调用方从数据库加载后填充
+    - save_chat_message 会把新消息追加到已存在的缓冲区
+    - 按用户做 LRU 淘汰，所有缓冲区的总字符数不超过上限
+    """
+
+    def __init__(self, turns: int, max_chars: int):
+        self.turns = turns
+        self.max_chars = max_chars
+        # user_id -> deque[(role, text)]，按最近使用排序
+        self._buffers: "OrderedDict[int, deque]" = OrderedDict()
+        # user_id -> 这个缓冲区里的字符数
+        self._sizes: Dict[int, int] = {}
+        self.total_chars = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        # 正在从数据库加载的用户，以及加载期间又有新消息的用户
+        self._loading: Dict[int, int] = {}
+        self._written_while_loading = set()
+
+    @staticmethod
+    def _size(entry: Tuple[str, str]) -> int:
+        return len(entry[0]) + len(entry[1] or '')
+
+    def get(self, user_id: int, limit: int) -> Optional[List[Dict[str, Any]]]:
+        """命中时返回最近 limit 条对话，未命中返回 None"""
+        buf = self._buffers.get(user_id)
+        if buf is None or limit > self.turns:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._buffers.move_to_end(user_id)
+        entries = list(buf)[-limit:] if limit > 0 else []
+        return [{'role': role, 'text': text} for role, text in entries]
+
+    def begin_load(self, user_id: int):
+        self._loading[user_id] = self._loading.get(user_id, 0) + 1
+
+    def end_load(self, user_id: int, rows: Optional[List[Dict[str, Any]]]):
+        """数据库加载完成；加载期间有新消息写入时放弃填充，避免缓存缺消息"""
+        remaining = self._loading.pop(user_id) - 1
+        stale = user_id in self._written_while_loading
+        if remaining:
+            self._loading[user_id] = remaining
+        else:
+            self._written_while_loading.discard(user_id)
+        if rows is None or stale or user_id in self._buffers:
+            return
+        buf = deque(((row.get('role'), row.get('text')) for row in rows[-self.turns:]), maxlen=self.turns)
+        size = sum(self._size(entry) for entry in buf)
+        self._buffers[user_id] = buf
+        self._sizes[user_id] = size
+        self.total_chars += size
+        self._evict()
+
+    def append(self, user_id: int, role: str, text: str):
+        """追加一条新消息；这个用户没有缓冲区时什么都不做，等下次读取时再从数据库加载"""
+        if user_id in self._loading:
+            self._written_while_loading.add(user_id)
+        buf = self._buffers.get(user_id)
+        if buf is None:
+            return
+        entry = (role, text)
+        delta = self._size(entry)
+        if len(buf) == buf.maxlen:
+            # deque 满了会自动挤掉最旧的一条
+            delta -= self._size(buf[0])
+        buf.append(entry)
+        self._sizes[user_id] += delta
+        self.total_chars += delta
+        self._buffers.move_to_end(user_id)
+        self._evict()
+
+    def _evict(self):
+        while self.total_chars > self.max_chars and self._buffers:
+            user_id, _ = self._buffers.popitem(last=False)
+            self.total_chars -= self._sizes.pop(user_id)
+            self.evictions += 1
+
+    def stats(self) -> Dict[str, float]:
+        total = self.hits + self.misses
+        return {
+            'users': len(self._buffers),
+            'chars': self.total_chars,
+            'max_chars': self.max_chars,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'hit_rate': self.hits / total if total else 0.0,
+        }
+
+
+_history_buffer = _ChatHistoryBuffer(CHAT_HISTORY_BUFFER_TURNS, CHAT_HISTORY_BUFFER_MAX_CHARS)
+
+# 对话记录批量写入：攒够多少条或等多久就写一次库
+CHAT_WRITE_BATCH_SIZE = getattr(config, 'CHAT_WRITE_BATCH_SIZE', 200)
+CHAT_WRITE_FLUSH_INTERVAL = getattr(config, 'CHAT_WRITE_FLUSH_INTERVAL', 0.5)
+# 写入队列的容量，满了之后 save_chat_message 会等待，形成背压
+CHAT_WRITE_QUEUE_SIZE = getattr(config, 'CHAT_WRITE_QUEUE_SIZE', 10000)
+
+
+class _ChatHistoryWriter:
+    """
+    对话记录的异步延迟写入队列。
+    - save_chat_message 只把消息放进队列，不等数据库
+    - 后台任务把消息攒成多行 INSERT，按数量或定时写库
+    - 多行写入失败时逐条重试，坏数据不会连累整批
+    """
+
+    def __init__(self, batch_size: int, flush_interval: float, queue_size: int):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.queue_size = max(queue_size, batch_size)
+        self._queue: Optional[asyncio.Queue] = None
+        self._task: Optional[asyncio.Task] = None
+        self._flush_requested: Optional[asyncio.Event] = None
+        # user_id -> 这个用户还没写库的消息数
+        self._pending: Dict[int, int] = {}
+        # user_id -> 等待这个用户的消息全部写库的事件
+        self._waiters: Dict[int, asyncio.Event] = {}
+        self.flushed_rows = 0
+        self.failed_rows = 0
+        self.flushes = 0
+        self.last_flush_seconds = 0.0
+        self.max_flush_seconds = 0.0
+        self.total_flush_seconds = 0.0
+
+    def _ensure_started(self):
+        if self._queue is None:
+            self._queue = asyncio.Queue(maxsize=self.queue_size)
+            self._flush_requested = asyncio.Event()
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def enqueue(self, user_id: int, role: str, text: str):
+        """把一条消息放进写入队列；队列满时在这里等待"""
+        self._ensure_started()
+        self._pending[user_id] = self._pending.get(user_id, 0) + 1
+        await self._queue.put((user_id, role, text))
+        if self._queue.qsize() >= self.batch_size:
+            self._flush_requested.set()
+
+    async def wait_until_written(self, user_id: int):
+        """等待某个用户已入队的消息全部写库，并催促后台任务立即写入"""
+        if not self._pending.get(user_id):
+            return
+        event = self._waiters.get(user_id)
+        if event is None:
+            event = self._waiters[user_id] = asyncio.Event()
+        self._flush_requested.set()
+        await event.wait()
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self._queue.get()]
+            deadline = loop.time() + self.flush_interval
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self._queue.get_nowait())
+                    continue
+                except asyncio.QueueEmpty:
+                    pass
+                remaining = deadline - loop.time()
+                if remaining <= 0 or self._flush_requested.is_set():
+                    break
+                try:
+                    await asyncio.wait_for(self._flush_requested.wait(), remaining)
+                except asyncio.TimeoutError:
+                    pass
+            self._flush_requested.clear()
+            try:
+                await self._write(batch)
+            finally:
+                self._mark_written(batch)
+
+    async def _write(self, batch: List[Tuple[int, str, str]]):
+        started = time.monotonic()
+        try:
+            try:
+                with _track('insert_chat_messages'):
+                    await _storage.insert_chat_messages(batch)
+            except Exception as e:
+                logger.warning(f"批量写入 {len(batch)} 条对话记录失败，改为逐条写入: {e}")
+                for row in batch:
+                    try:
+                        with _track('insert_chat_messages'):
+                            await _storage.insert_chat_messages([row])
+                    except Exception as row_error:
+                        self.failed_rows += 1
+                        logger.error(f"保存用户 {row[0]} 的对话记录失败: {row_error}")
+        except Exception as e:
+            self.failed_rows += len(batch)
+            logger.error(f"写入 {len(batch)} 条对话记录失败: {e}")
+            return
+        elapsed = time.monotonic() - started
+        self.flushes += 1
+        self.flushed_rows += len(batch)
+        self.last_flush_seconds = elapsed
+        self.max_flush_seconds = max(self.max_flush_seconds, elapsed)
+        self.total_flush_seconds += elapsed
+
+    def _mark_written(self, batch: List[Tuple[int, str, str]]):
+        for user_id, _, _ in batch:
+            remaining = self._pending.get(user_id, 1) - 1
+            if remaining > 0:
+                self._pending[user_id] = remaining
+            else:
+                self._pending.pop(user_id, None)
+                event = self._waiters.pop(user_id, None)
+                if event:
+                    event.set()
+            self._queue.task_done()
+
+    async def close(self):
+        """把队列里剩下的消息全部写库，然后停止后台任务"""
+        if self._queue is None:
+            return
+        if self._task is not None and not self._task.done():
+            self._flush_requested.set()
+            await self._queue.join()
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+        self._task = None
+
+    def stats(self) -> Dict[str, float]:
+        return {
+            'queue_depth': self._queue.qsize() if self._queue else 0,
+            'pending_users': len(self._pending),
+            'flushed_rows': self.flushed_rows,
+            'failed_rows': self.failed_rows,
+            'flushes': self.flushes,
+            'last_flush_seconds': self.last_flush_seconds,
+            'max_flush_seconds': self.max_flush_seconds,
+            'avg_flush_seconds': self.total_flush_seconds / self.flushes if self.flushes else 0.0,
+        }
+
+
+_chat_writer = _ChatHistoryWriter(CHAT_WRITE_BATCH_SIZE, CHAT_WRITE_FLUSH_INTERVAL, CHAT_WRITE_QUEUE_SIZE)
+
+
+def get_storage() -> Storage:
+    """返回当前使用的数据库实现"""
+    return _storage
+
+
+def get_storage_stats() -> Dict[str, float]:
+    """返回数据库连接相关的统计数据（连接池大小、空闲连接数等）"""
+    return _storage.stats()
 
 
 async def initialize_database():
     """初始化数据库，创建必要的表。"""
-    db_pool = await get_pool()
-    async with db_pool.acquire() as conn:
-        async with conn.cursor() as cur:
-            # 创建 users 表 (MySQL 语法)
-            await cur.execute("""
-                              CREATE TABLE IF NOT EXISTS users
-                              (
-                                  user_id
-                                  BIGINT
-                                  PRIMARY
-                                  KEY,
-                                  username
-                                  VARCHAR
-                              (
-                                  255
-                              ),
-                                  first_name VARCHAR
-                              (
-                                  255
-                              ),
-                                  chat_id BIGINT UNIQUE,
-                                  state VARCHAR
-                              (
-                                  50
-                              ),
-                                  chat_message_count INT DEFAULT 0,
-                                  subscribed_to_broadcast BOOLEAN DEFAULT 1,
-                                  service_status VARCHAR
-                              (
-                                  20
-                              ) DEFAULT 'pending',
-                                  push_message_count INT DEFAULT 0,
-                                  language_code VARCHAR
-                              (
-                                  10
-                              ) DEFAULT 'en'
-                                  )
-                              """)
-            # 创建 chat_history 表
-            await cur.execute("""
-                              CREATE TABLE IF NOT EXISTS chat_history
-                              (
-                                  message_id
-                                  INT
-                                  AUTO_INCREMENT
-                                  PRIMARY
-                                  KEY,
-                                  user_id
-                                  BIGINT,
-                                  role
-                                  VARCHAR
-                              (
-                                  20
-                              ),
-                                  text TEXT,
-                                  timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                                  FOREIGN KEY
-                              (
-                                  user_id
-                              ) REFERENCES users
-                              (
-                                  user_id
-                              )
-                                  )
-                              """)
-    logger.info(f"数据库 '{config.DB_NAME}' 初始化成功。")
+    with _track('initialize'):
+        await _storage.initialize()
+
+
+def _cache_user_write(user_id: int, data: Dict[str, Any]):
+    """写库之后同步更新缓存：已缓存的行直接合并新值"""
+    if user_id in _user_reads_in_flight:
+        _user_written_during_read.add(user_id)
+    row = _user_cache.peek(user_id)
+    if row is not None:
+        row.update(data)
+
+
+def _invalidate_cached_user(user_id: int):
+    """让某个用户的缓存失效"""
+    if user_id in _user_reads_in_flight:
+        _user_written_during_read.add(user_id)
+    _user_cache.pop(user_id)
+
+
+def get_user_cache_stats() -> Dict[str, float]:
+    """返回用户行缓存的统计数据（大小、命中次数、命中率等）"""
+    return _user_cache.stats()
 
 
 async def get_user_data(user_id: int) -> Dict[str, Any]:
-    """根据用户ID获取用户数据"""
-    db_pool = await get_pool()
-    async with db_pool.acquire() as conn:
-        async with conn.cursor(aiomysql.DictCursor) as cur:
-            await cur.execute("SELECT * FROM users WHERE user_id = %s", (user_id,))
-            row = await cur.fetchone()
-            return row if row else {}
+    """根据用户ID获取用户数据，优先从缓存读取"""
+    row = _user_cache.get(user_id)
+    if row is not None:
+        return dict(row)
+
+    _user_reads_in_flight[user_id] = _user_reads_in_flight.get(user_id, 0) + 1
+    try:
+        with _track('fetch_user'):
+            row = await _storage.fetch_user(user_id)
+        # 不存在的用户不缓存，他们马上会被 update_user_data 创建
+        if row and user_id not in _user_written_during_read:
+            _user_cache.set(user_id, dict(row))
+        return row if row else {}
+    finally:
+        remaining = _user_reads_in_flight.pop(user_id) - 1
+        if remaining:
+            _user_reads_in_flight[user_id] = remaining
+        else:
+            _user_written_during_read.discard(user_id)
 
 
 async def update_user_data(user_id: int, data: Dict[str, Any]):
-    """使用 INSERT ... ON DUPLICATE KEY UPDATE 更新或创建用户数据"""
+    """更新或创建用户数据（数据库里是一条 upsert 语句）"""
     data['user_id'] = user_id
 
-    columns = ', '.join(f"`{k}`" for k in data.keys())
-    placeholders = ', '.join(['%s'] * len(data))
-    updates = ', '.join(f"`{k}` = VALUES(`{k}`)" for k in data.keys())
+    try:
+        with _track('upsert_user'):
+            await _storage.upsert_user(user_id, data)
+    except Exception:
+        # 写库失败时不知道数据库里到底是什么，直接让缓存失效
+        _invalidate_cached_user(user_id)
+        raise
+    _cache_user_write(user_id, data)
 
-    sql = f"INSERT INTO users ({columns}) VALUES ({placeholders}) ON DUPLICATE KEY UPDATE {updates}"
 
-    db_pool = await get_pool()
-    async with db_pool.acquire() as conn:
-        async with conn.cursor() as cur:
-            await cur.execute(sql, tuple(data.values()))
+def get_chat_history_buffer_stats() -> Dict[str, float]:
+    """返回对话历史内存缓冲区的统计数据"""
+    return _history_buffer.stats()
 
 
 async def get_chat_history(user_id: int, limit: int = 10) -> List[Dict[str, Any]]:
-    """获取用户的对话历史"""
-    db_pool = await get_pool()
-    async with db_pool.acquire() as conn:
-        async with conn.cursor(aiomysql.DictCursor) as cur:
-            sql = "SELECT role, text FROM chat_history WHERE user_id = %s ORDER BY timestamp DESC LIMIT %s"
-            await cur.execute(sql, (user_id, limit))
-            rows = await cur.fetchall()
-            return list(reversed(rows))
+    """获取用户的对话历史，活跃用户直接从内存缓冲区返回"""
+    cached = _history_buffer.get(user_id, limit)
+    if cached is not None:
+        return cached
+
+    # 这个用户还有消息在写入队列里时，先让它们落库，否则读出来的历史会缺消息
+    await _chat_writer.wait_until_written(user_id)
+    # 未命中时按缓冲区容量从数据库加载，这样之后更小的 limit 也能命中
+    fetch_limit = max(limit, _history_buffer.turns)
+    rows = None
+    _history_buffer.begin_load(user_id)
+    try:
+        with _track('fetch_chat_history'):
+            rows = await _storage.fetch_chat_history(user_id, fetch_limit)
+    finally:
+        _history_buffer.end_load(user_id, rows)
+    return rows[-limit:] if limit > 0 else []
+
+
+def get_chat_writer_stats() -> Dict[str, float]:
+    """返回对话记录写入队列的统计数据（队列深度、写库耗时等）"""
+    return _chat_writer.stats()
 
 
 async def save_chat_message(user_id: int, role: str, text: str):
-    """保存单条对话消息到数据库"""
-    db_pool = await get_pool()
-    async with db_pool.acquire() as conn:
-        async with conn.cursor() as cur:
-            sql = "INSERT INTO chat_history (user_id, role, text) VALUES (%s, %s, %s)"
-            await cur.execute(sql, (user_id, role, text))
+    """保存单条对话消息：立即追加到内存缓冲区，由后台队列批量写库"""
+    _history_buffer.append(user_id, role, text)
+    await _chat_writer.enqueue(user_id, role, text)
+
+
+async def iter_subscribed_users(chunk_size: int = None, shard_count: int = 1, shard_index: int = 0,
+                                after_user_id: Optional[int] = None) -> AsyncIterator[Dict[str, Any]]:
+    """
+    流式获取所有符合条件的订阅用户。
+    按 user_id 做键集分页，每次只读取一页，读完一页就释放连接，
+    所以内存占用与用户总量无关，调用方也可以边读边发送。
+    shard_count > 1 时只返回 user_id % shard_count == shard_index 的用户；after_user_id 用于从断点继续。
+    """
+    chunk_size = chunk_size or SUBSCRIBER_PAGE_SIZE
+    last_user_id = -(2 ** 63) if after_user_id is None else after_user_id
+    while True:
+        with _track('fetch_subscribed_page'):
+            rows = await _storage.fetch_subscribed_page(config.MAX_PUSH_MESSAGES, last_user_id, chunk_size,
+                                                        shard_count, shard_index)
+        for row in rows:
+            yield row
+        if len(rows) < chunk_size:
+            return
+        last_user_id = rows[-1]['user_id']
 
 
 async def get_subscribed_users() -> List[Dict[str, Any]]:
-    """获取所有符合条件的订阅用户信息"""
-    db_pool = await get_pool()
-    async with db_pool.acquire() as conn:
-        async with conn.cursor(aiomysql.DictCursor) as cur:
-            sql = """
-                  SELECT user_id, chat_id, language_code \
-                  FROM users
-                  WHERE service_status = 'confirmed'
-                    AND subscribed_to_broadcast = 1
-                    AND chat_id IS NOT NULL
-                    AND push_message_count < %s \
-                  """
-            await cur.execute(sql, (config.MAX_PUSH_MESSAGES,))
-            return await cur.fetchall()
+    """获取所有符合条件的订阅用户信息（一次性读入内存，大量用户时请使用 iter_subscribed_users）"""
+    return [user async for user in iter_subscribed_users()]
 
 
 async def increment_push_count(user_id: int):
     """为指定用户增加一次推送计数"""
-    db_pool = await get_pool()
-    async with db_pool.acquire() as conn:
-        async with conn.cursor() as cur:
-            sql = "UPDATE users SET push_message_count = push_message_count + 1 WHERE user_id = %s"
-            await cur.execute(sql, (user_id,))
-
-
-async def close_pool(application):
-    """优雅地关闭数据库连接池"""
-    global pool
-    if pool:
-        logger.info("正在关闭数据库连接池...")
-        pool.close()
-        await pool.wait_closed()
-        pool = None
-        logger.info("数据库连接池已关闭。")
+    with _track('increment_push_count'):
+        await _storage.increment_push_count(user_id)
+    _invalidate_cached_user(user_id)
+
+
+async def _bulk_update_users(set_clause: str, user_ids: Iterable[int]) -> int:
+    """分块执行 UPDATE users SET ... WHERE user_id IN (...)"""
+    ids = list(dict.fromkeys(user_ids))
+    if not ids:
+        return 0
+    try:
+        with _track('bulk_update_users'):
+            return await _storage.bulk_update_users(set_clause, ids, BULK_CHUNK_SIZE)
+    finally:
+        # 批量语句改的是数据库里的值，缓存里对应的行直接失效，下次读取时重新加载
+        for user_id in ids:
+            _invalidate_cached_user(user_id)
+
+
+async def increment_push_counts(user_ids: Iterable[int]) -> int:
+    """批量为多个用户增加一次推送计数，返回受影响的行数"""
+    return await _bulk_update_users("push_message_count = push_message_count + 1", user_ids)
+
+
+async def unsubscribe_users(user_ids: Iterable[int]) -> int:
+    """批量将多个用户取消订阅，返回受影响的行数"""
+    return await _bulk_update_users("subscribed_to_broadcast = 0", user_ids)
+
+
+async def archive_old_chat_history(max_age_days: int, batch_size: int, max_batches: int) -> int:
+    """把早于 max_age_days 天的对话记录分小批搬到归档表，返回搬走的行数"""
+    with _track('archive_old_chat_history'):
+        return await _storage.archive_old_chat_history(max_age_days, batch_size, max_batches)
+
+
+async def archive_chat_history_over_cap(per_user_cap: int, batch_size: int, max_batches: int,
+                                        after_user_id: Optional[int], max_users: int) -> Tuple[int, Optional[int]]:
+    """
+    每个用户只保留最近 per_user_cap 条对话，更早的分小批搬到归档表。
+    从 after_user_id 之后最多检查 max_users 个用户，返回 (搬走的行数, 下次继续的位置)，检查完所有用户时位置为 None。
+    """
+    with _track('archive_chat_history_over_cap'):
+        return await _storage.archive_chat_history_over_cap(per_user_cap, batch_size, max_batches,
+                                                            after_user_id, max_users)
+
+
+async def try_acquire_lease(name: str, holder: str, ttl: float) -> bool:
+    """抢占或续约一个租约，返回 holder 现在是否持有它"""
+    with _track('try_acquire_lease'):
+        return await _storage.try_acquire_lease(name, holder, ttl, time.time())
+
+
+async def release_lease(name: str, holder: str):
+    """主动放弃租约"""
+    with _track('release_lease'):
+        await _storage.release_lease(name, holder)
+
+
+async def create_broadcast_round(multiplier: str, shard_count: int) -> int:
+    """创建一轮广播和它的待认领分片，返回轮次 ID"""
+    with _track('create_broadcast_round'):
+        return await _storage.create_broadcast_round(multiplier, shard_count, time.time())
+
+
+async def count_open_broadcast_shards(max_age: float) -> int:
+    """最近 max_age 秒内创建的轮次里还没发完的分片数"""
+    with _track('count_open_broadcast_shards'):
+        return await _storage.count_open_broadcast_shards(time.time() - max_age)
+
+
+async def claim_broadcast_shard(owner: str, claim_ttl: float, max_age: float) -> Optional[Dict[str, Any]]:
+    """认领一个最近 max_age 秒内创建的、待发送或认领已过期的分片"""
+    with _track('claim_broadcast_shard'):
+        now = time.time()
+        return await _storage.claim_broadcast_shard(owner, claim_ttl, now, now - max_age)
+
+
+async def checkpoint_broadcast_shard(round_id: int, shard_index: int, owner: str, last_user_id: Optional[int],
+                                     sent: int, claim_ttl: float) -> bool:
+    """记录分片的发送进度并续期，分片已被别人认领时返回 False"""
+    with _track('checkpoint_broadcast_shard'):
+        return await _storage.checkpoint_broadcast_shard(round_id, shard_index, owner, last_user_id, sent,
+                                                         claim_ttl, time.time())
+
+
+async def complete_broadcast_shard(round_id: int, shard_index: int, owner: str, sent: int, failed: int):
+    """把分片标记为已完成"""
+    with _track('complete_broadcast_shard'):
+        await _storage.complete_broadcast_shard(round_id, shard_index, owner, sent, failed)
+
+
+async def prune_broadcast_rounds(max_age: float) -> int:
+    """删除 max_age 秒之前创建的广播轮次记录"""
+    with _track('prune_broadcast_rounds'):
+        return await _storage.prune_broadcast_rounds(time.time() - max_age)
+
+
+async def schedule_reminder(user_id: int, kind: str, chat_id: int, delay: float):
+    """安排 delay 秒后给用户发一条某种提醒；同一种提醒重复安排时只保留最新的一条"""
+    with _track('upsert_reminder'):
+        await _storage.upsert_reminder(user_id, kind, chat_id, time.time() + delay)
+
+
+async def fetch_due_reminders(kind: str, now: float, limit: int) -> List[Dict[str, Any]]:
+    """取出一批已经到期的提醒，带上用户当前的 state"""
+    with _track('fetch_due_reminders'):
+        return await _storage.fetch_due_reminders(kind, now, limit)
+
+
+async def delete_reminders(kind: str, user_ids: Iterable[int], due_before: float) -> int:
+    """删除已经处理过的提醒，返回删除的行数"""
+    ids = list(dict.fromkeys(user_ids))
+    if not ids:
+        return 0
+    with _track('delete_reminders'):
+        return await _storage.delete_reminders(kind, ids, due_before, BULK_CHUNK_SIZE)
+
+
+async def get_media_file_ids() -> Dict[str, str]:
+    """读取所有已经上传过的素材的 file_id"""
+    with _track('fetch_media_file_ids'):
+        return await _storage.fetch_media_file_ids()
+
+
+async def save_media_file_id(name: str, file_id: str):
+    """保存素材上传后得到的 file_id"""
+    with _track('save_media_file_id'):
+        await _storage.save_media_file_id(name, file_id, time.time())
+
+
+async def delete_media_file_id(name: str):
+    """删除已经失效的 file_id，下次发送时重新上传"""
+    with _track('delete_media_file_id'):
+        await _storage.delete_media_file_id(name)
+
+
+async def close_pool(application=None):
+    """优雅地关闭数据库连接"""
+    # 先把还没写库的对话记录写完，再关闭连接
+    await _chat_writer.close()
+    await _storage.close()
@@ -0,0 +1,195 @@
+# services/fanout.py
+
+import asyncio
+import inspect
+import logging
+import time
+from dataclasses import dataclass, field
+from typing import Any, AsyncIterable, Awaitable, Callable, Dict, Iterable, Optional, Union
+
+from telegram.error import Forbidden, RetryAfter
+
+from telegram_bot import config
+from utils.rate_limiter import TokenBucket
+from utils import tracing
+
+logger = logging.getLogger(__name__)
+
+# Telegram 的全局限制大约是 30 条/秒，这里留一点余量
+DEFAULT_CONCURRENCY = getattr(config, 'BROADCAST_CONCURRENCY', 16)
+DEFAULT_RATE_PER_SECOND = getattr(config, 'BROADCAST_RATE_PER_SECOND', 28)
+# 同一个聊天两条消息之间的最小间隔（秒）
+DEFAULT_PER_CHAT_INTERVAL = getattr(config, 'BROADCAST_PER_CHAT_INTERVAL', 1.0)
+# 收到 RetryAfter 后单条消息最多重试的次数
+DEFAULT_MAX_RETRIES = getattr(config, 'BROADCAST_MAX_RETRIES', 3)
+
+
+@dataclass
+class SendJob:
+    """一条待发送的消息"""
+    chat_id: int
+    text: str
+    user_id: Optional[int] = None
+    # 接收人的语言，只用于回调里区分结果，不会传给 send_message
+    language_code: Optional[str] = None
+    # 额外传给 send_message 的参数，比如 parse_mode
+    kwargs: Dict[str, Any] = field(default_factory=dict)
+
+
+@dataclass
+class FanoutStats:
+    """一轮发送的统计结果"""
+    sent: int = 0
+    failed: int = 0
+    throttled: int = 0
+    forbidden: int = 0
+    elapsed: float = 0.0
+
+    @property
+    def rate(self) -> float:
+        """实际发送速率（条/秒）"""
+        return self.sent / self.elapsed if self.elapsed > 0 else 0.0
+
+    def __str__(self):
+        return (f"sent={self.sent} failed={self.failed} throttled={self.throttled} "
+                f"forbidden={self.forbidden} elapsed={self.elapsed:.1f}s rate={self.rate:.1f}/s")
+
+
+def _retry_after_seconds(error: RetryAfter) -> float:
+    """兼容 retry_after 为整数或 timedelta 的不同版本"""
+    retry_after = error.retry_after
+    if hasattr(retry_after, 'total_seconds'):
+        return retry_after.total_seconds()
+    return float(retry_after)
+
+
+# 结果回调既可以是普通函数，也可以是协程函数
+ResultCallback = Callable[[SendJob], Optional[Awaitable[None]]]
+
+
+async def _notify(callback: Optional[ResultCallback], job: SendJob):
+    """调用结果回调，如果回调返回的是协程就等待它完成"""
+    if callback is None:
+        return
+    try:
+        result = callback(job)
+        if inspect.isawaitable(result):
+            await result
+    except Exception as e:
+        logger.error(f"处理发送结果回调时出错 (chat {job.chat_id}): {e}")
+
+
+async def _iterate(jobs: Union[Iterable[SendJob], AsyncIterable[SendJob]]):
+    """把同步或异步的可迭代对象统一成异步迭代"""
+    if hasattr(jobs, '__aiter__'):
+        async for job in jobs:
+            yield job
+    else:
+        for job in jobs:
+            yield job
+
+
+class FanoutEngine:
+    """
+    并发、限流的消息群发引擎。
+    - 用固定数量的 worker 并发发送
+    - 全局令牌桶保证不超过 Telegram 的全局速率
+    - 每个聊天之间保持最小发送间隔
+    - 收到 RetryAfter 时暂停整个流水线，然后重试
+    """
+
+    def __init__(self, bot, concurrency: int = None, rate_per_second: float = None,
+                 per_chat_interval: float = None, max_retries: int = None):
+        self.bot = bot
+        self.concurrency = concurrency or DEFAULT_CONCURRENCY
+        self.per_chat_interval = DEFAULT_PER_CHAT_INTERVAL if per_chat_interval is None else per_chat_interval
+        self.max_retries = DEFAULT_MAX_RETRIES if max_retries is None else max_retries
+        # 容量设为 1，让发送均匀分布，而不是每秒开头来一波突发
+        self.limiter = TokenBucket(rate_per_second or DEFAULT_RATE_PER_SECOND, capacity=1)
+        # chat_id -> 下一次允许发送的时间
+        self._chat_next_allowed: Dict[int, float] = {}
+
+    async def run(self, jobs: Union[Iterable[SendJob], AsyncIterable[SendJob]],
+                  on_sent: ResultCallback = None,
+                  on_forbidden: ResultCallback = None,
+                  on_failed: ResultCallback = None) -> FanoutStats:
+        """发送所有任务，返回本轮的统计结果；on_failed 在重试用尽或其他错误导致发送失败时调用"""
+        stats = FanoutStats()
+        started = time.monotonic()
+        # 有界队列：生产者读得比发送快时会被自然地挡住
+        queue: asyncio.Queue = asyncio.Queue(maxsize=self.concurrency * 4)
+        workers = [
+            asyncio.create_task(self._worker(queue, stats, on_sent, on_forbidden, on_failed))
+            for _ in range(self.concurrency)
+        ]
+        try:
+            async for job in _iterate(jobs):
+                if not job.chat_id:
+                    continue
+                await queue.put(job)
+            for _ in workers:
+                await queue.put(None)
+            await asyncio.gather(*workers)
+        except BaseException:
+            for worker in workers:
+                worker.cancel()
+            raise
+        finally:
+            stats.elapsed = time.monotonic() - started
+        return stats
+
+    async def _worker(self, queue: asyncio.Queue, stats: FanoutStats, on_sent, on_forbidden, on_failed):
+        while True:
+            job = await queue.get()
+            if job is None:
+                return
+            await self._deliver(job, stats, on_sent, on_forbidden, on_failed)
+
+    async def _wait_chat_slot(self, chat_id: int):
+        """等待直到这个聊天允许再次发送，并占住下一个时间槽"""
+        now = time.monotonic()
+        next_allowed = self._chat_next_allowed.get(chat_id, 0.0)
+        self._chat_next_allowed[chat_id] = max(now, next_allowed) + self.per_chat_interval
+        if next_allowed > now:
+            await asyncio.sleep(next_allowed - now)
+        # 定期清理已经过期的记录，避免字典随受众规模无限增长
+        if len(self._chat_next_allowed) > self.concurrency * 64:
+            self._chat_next_allowed = {
+                cid: t for cid, t in self._chat_next_allowed.items() if t > now
+            }
+
+    async def _deliver(self, job: SendJob, stats: FanoutStats, on_sent, on_forbidden, on_failed):
+        attempts = 0
+        while True:
+            with tracing.span('rate_limit'):
+                await self._wait_chat_slot(job.chat_id)
+                await self.limiter.acquire()
+            try:
+                await self.bot.send_message(chat_id=job.chat_id, text=job.text, **job.kwargs)
+            except RetryAfter as e:
+                stats.throttled += 1
+                attempts += 1
+                delay = _retry_after_seconds(e)
+                # 暂停整个流水线，而不是只让这一个 worker 等待
+                self.limiter.pause(delay)
+                logger.warning(f"触发 Telegram 限流，全部发送暂停 {delay:.1f} 秒 (chat {job.chat_id})")
+                if attempts > self.max_retries:
+                    stats.failed += 1
+                    logger.error(f"向 {job.chat_id} 发送失败：重试 {self.max_retries} 次后仍被限流")
+                    await _notify(on_failed, job)
+                    return
+                continue
+            except Forbidden:
+                stats.forbidden += 1
+                stats.failed += 1
+                logger.warning(f"用户 {job.user_id} ({job.chat_id}) 已拉黑机器人。")
+                await _notify(on_forbidden, job)
+                return
+            except Exception as e:
+                stats.failed += 1
+                logger.error(f"向 {job.chat_id} 发送消息失败: {e}")
+                await _notify(on_failed, job)
+                return
+            stats.sent += 1
+            await _notify(on_sent, job)
+            return
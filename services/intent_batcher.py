@@ -0,0 +1,131 @@
+# services/intent_batcher.py
+
+import asyncio
+import functools
+import itertools
+import logging
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Set, Tuple
+
+from services.ai_governor import AIUnavailableError
+
+logger = logging.getLogger(__name__)
+
+# 一次批量调用：传入 [(请求ID, 请求内容)]，返回 {请求ID: 意图结果}（可以缺少部分请求）
+BatchCall = Callable[[List[Tuple[str, Dict[str, Any]]]], Awaitable[Dict[str, Dict[str, str]]]]
+# 一次单独调用：传入请求内容，返回意图结果
+SingleCall = Callable[[Dict[str, Any]], Awaitable[Dict[str, str]]]
+
+
+class IntentBatcher:
+    """
+    意图判断的微批处理。
+    - 在一个很短的时间窗口内收集并发到达的请求，凑满 max_batch_size 时立即发送
+    - 多个请求合并成一次 AI 调用，结果按请求ID分发给各自等待的调用方
+    - 批量结果里缺失或格式不对的请求，退回单独调用
+    """
+
+    def __init__(self, batch_call: BatchCall, single_call: SingleCall,
+                 window: float = 0.15, max_batch_size: int = 16):
+        self.batch_call = batch_call
+        self.single_call = single_call
+        self.window = window
+        self.max_batch_size = max_batch_size
+        self._pending: List[Tuple[str, Dict[str, Any], asyncio.Future]] = []
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self._ids = itertools.count(1)
+        # 事件循环只保留任务的弱引用，正在执行的批次要自己持有，否则可能被回收，调用方永远等不到结果
+        self._tasks: Set[asyncio.Task] = set()
+        self.batches = 0
+        self.batched_requests = 0
+        self.single_calls = 0
+        self.fallbacks = 0
+
+    async def classify(self, request: Dict[str, Any]) -> Dict[str, str]:
+        """提交一个请求，等待它所在批次的结果"""
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append((str(next(self._ids)), request, future))
+        if len(self._pending) >= self.max_batch_size:
+            self._flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(self.window, self._flush)
+        return await future
+
+    def _flush(self):
+        """把当前收集到的请求作为一个批次发出去"""
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        batch, self._pending = self._pending, []
+        if batch:
+            task = asyncio.get_running_loop().create_task(self._run_batch(batch))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+            task.add_done_callback(functools.partial(self._on_batch_done, batch))
+
+    @staticmethod
+    def _on_batch_done(batch: List[Tuple[str, Dict[str, Any], asyncio.Future]], task: asyncio.Task):
+        """批次意外失败或被取消时记录日志，并通知还在等待的调用方"""
+        if task.cancelled():
+            error: BaseException = asyncio.CancelledError()
+        elif task.exception() is not None:
+            error = task.exception()
+            logger.error(f"意图判断批次执行失败（{len(batch)} 个请求）: {error}")
+        else:
+            return
+        for _, _, future in batch:
+            if not future.done():
+                future.set_exception(error)
+
+    async def _run_batch(self, batch: List[Tuple[str, Dict[str, Any], asyncio.Future]]):
+        if len(batch) == 1:
+            # 只有一个请求时没必要用批量格式
+            await self._run_single(*batch[0])
+            return
+
+        self.batches += 1
+        self.batched_requests += len(batch)
+        try:
+            results = await self.batch_call([(request_id, request) for request_id, request, _ in batch])
+        except AIUnavailableError as e:
+            # 额度用尽或系统繁忙：单独重试也不会成功，直接通知所有调用方
+            for _, _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        except Exception as e:
+            logger.warning(f"批量意图判断失败，{len(batch)} 个请求改为单独调用: {e}")
+            results = {}
+
+        missing = []
+        for request_id, request, future in batch:
+            result = results.get(request_id)
+            if result is None:
+                missing.append((request_id, request, future))
+            elif not future.done():
+                future.set_result(result)
+        if missing:
+            self.fallbacks += len(missing)
+            await asyncio.gather(*(self._run_single(*item) for item in missing))
+
+    async def _run_single(self, request_id: str, request: Dict[str, Any], future: asyncio.Future):
+        self.single_calls += 1
+        try:
+            result = await self.single_call(request)
+        except Exception as e:
+            if not future.done():
+                future.set_exception(e)
+            return
+        if not future.done():
+            future.set_result(result)
+
+    def stats(self) -> Dict[str, float]:
+        return {
+            'pending': len(self._pending),
+            'in_flight': len(self._tasks),
+            'batches': self.batches,
+            'batched_requests': self.batched_requests,
+            'avg_batch_size': self.batched_requests / self.batches if self.batches else 0.0,
+            'single_calls': self.single_calls,
+            'fallbacks': self.fallbacks,
+        }
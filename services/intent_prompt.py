@@ -0,0 +1,175 @@
+# services/intent_prompt.py
+
+import json
+import re
+from typing import Any, Dict, List, Tuple
+
+# 模型可以返回的全部意图
+VALID_INTENTS = (
+    "service_request",
+    "rejection",
+    "played_before",
+    "new_player",
+    "registration_complete",
+    "registration_not_complete",
+    "small_talk",
+)
+
+# 固定不变的说明只放在系统指令里，创建模型时设置一次，每次调用不再重复发送。
+# 单条和批量两种指令由下面几段拼成，只有描述请求格式和返回格式的部分不同
+_ROLE_INSTRUCTION = (
+    "You are a customer service assistant for a gaming service. "
+    "Your goal is to guide the user through a conversation flow."
+)
+
+_REQUEST_FIELDS = """
+- "state": the user's current conversation state
+- "reply_language": the language to reply in
+- "history": recent conversation turns as [role, text] pairs, oldest first
+- "message": the user's latest message
+""".strip()
+
+_CLASSIFICATION_RULES = """
+**Conversation Flow Logic:**
+- If state is 'awaiting_service_confirmation', user is answering "do you need our service?". Intent should be 'service_request' or 'rejection'.
+- If state is 'awaiting_experience_confirmation', user is answering "have you played before?". Intent should be 'played_before' or 'new_player'.
+- If state is 'awaiting_registration_confirmation', user is answering "have you registered?". Intent should be 'registration_complete'.
+- Any other message should be 'small_talk'.
+
+**Classify the user's intent into ONE of the following categories based on the logic above:**
+1. "service_request": User wants the service.
+2. "rejection": User does not want the service.
+3. "played_before": User says they have played before.
+4. "new_player": User says they are a new player.
+5. "registration_complete": User confirms they have completed registration.
+6. "registration_not_complete": user has not confirmed that the registration has been completed
+7. "small_talk": Any other message.
+If the intent is "small_talk", "rejection" or "registration_not_complete", generate a friendly reply in reply_language.
+Otherwise "reply" may be an empty string.
+""".strip()
+
+
+def _system_instruction(request_format: str, output_format: str) -> str:
+    """用共同的角色、字段和分类规则，加上各自的请求格式和返回格式，拼出一份系统指令"""
+    return "\n".join([_ROLE_INSTRUCTION, request_format, _REQUEST_FIELDS, "", _CLASSIFICATION_RULES, "",
+                      output_format])
+
+
+SYSTEM_INSTRUCTION = _system_instruction(
+    "Each request is a JSON object with these fields:",
+    'Return only a JSON object: {"intent": "...", "reply": "..."}',
+)
+
+# 批量模式的系统指令：一次请求里包含多个用户的消息，按 id 返回结果
+BATCH_SYSTEM_INSTRUCTION = _system_instruction(
+    "Each request is a JSON array of independent conversations. Every element has an \"id\" and these fields:",
+    'Classify every element on its own. Return only a JSON array with one object per element, '
+    'in any order: [{"id": "...", "intent": "...", "reply": "..."}]',
+)
+
+# 结构化输出的 JSON Schema，让模型直接返回合法的 JSON
+INTENT_RESPONSE_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "intent": {"type": "string", "format": "enum", "enum": list(VALID_INTENTS)},
+        "reply": {"type": "string"},
+    },
+    "required": ["intent", "reply"],
+}
+
+# 批量模式的 JSON Schema：一个带 id 的结果数组
+BATCH_INTENT_RESPONSE_SCHEMA = {
+    "type": "array",
+    "items": {
+        "type": "object",
+        "properties": {
+            "id": {"type": "string"},
+            "intent": {"type": "string", "format": "enum", "enum": list(VALID_INTENTS)},
+            "reply": {"type": "string"},
+        },
+        "required": ["id", "intent", "reply"],
+    },
+}
+
+
+def reply_language_for(language_code: str) -> str:
+    """根据语言代码决定回复语言"""
+    if language_code == 'hi':
+        return "Hindi"
+    return "Hinglish (a casual, friendly mix of Hindi and English)"
+
+
+def build_intent_request(current_state: str, language_code: str, history: List[Dict[str, Any]],
+                         user_message: str) -> Dict[str, Any]:
+    """构造一次意图判断的请求内容（只包含每次都会变化的部分）"""
+    return {
+        "state": current_state,
+        "reply_language": reply_language_for(language_code),
+        "history": [[item.get('role', 'unknown'), item.get('text', '')] for item in history],
+        "message": user_message,
+    }
+
+
+def serialize_intent_request(request: Dict[str, Any]) -> str:
+    """把一次意图判断的请求内容序列化成紧凑的 JSON 字符串"""
+    return json.dumps(request, ensure_ascii=False, separators=(',', ':'))
+
+
+def build_batch_intent_prompt(requests: List[Tuple[str, Dict[str, Any]]]) -> str:
+    """把多个 (请求ID, 请求内容) 合并成一个 JSON 数组，作为一次批量调用的内容"""
+    items = [dict(request, id=request_id) for request_id, request in requests]
+    return json.dumps(items, ensure_ascii=False, separators=(',', ':'))
+
+
+def _load_json(text: str) -> Any:
+    """尽量从模型输出中解析出 JSON：兼容代码块标记和前后多余的文字"""
+    cleaned = text.strip()
+    cleaned = re.sub(r"^```(?:json)?\s*|\s*```$", "", cleaned)
+    try:
+        return json.loads(cleaned)
+    except ValueError:
+        pass
+    # 退而求其次：截取第一个 { 或 [ 到最后一个 } 或 ] 之间的内容
+    match = re.search(r"[\[{].*[\]}]", cleaned, re.DOTALL)
+    if not match:
+        raise ValueError(f"模型输出中没有 JSON: {text[:200]!r}")
+    return json.loads(match.group(0))
+
+
+def validate_intent_result(data: Any) -> Dict[str, str]:
+    """校验并规范化一条意图结果：intent 必须合法，reply 一定是字符串"""
+    if isinstance(data, list) and len(data) == 1:
+        data = data[0]
+    if not isinstance(data, dict):
+        raise ValueError(f"意图结果不是 JSON 对象: {data!r}")
+    intent = str(data.get("intent", "")).strip().strip('"').lower()
+    if intent not in VALID_INTENTS:
+        raise ValueError(f"未知的意图: {intent!r}")
+    reply = data.get("reply")
+    return {"intent": intent, "reply": reply.strip() if isinstance(reply, str) else ""}
+
+
+def parse_intent_response(text: str) -> Dict[str, str]:
+    """解析模型返回的意图 JSON，格式不对时抛出 ValueError"""
+    return validate_intent_result(_load_json(text))
+
+
+def parse_batch_intent_response(text: str) -> Dict[str, Dict[str, str]]:
+    """
+    解析批量调用的结果，返回 {请求ID: 意图结果}。
+    单个元素格式不对时直接跳过，由调用方对缺失的请求单独重试；整体无法解析时抛出 ValueError。
+    """
+    data = _load_json(text)
+    if isinstance(data, dict):
+        data = data.get("results", [data])
+    if not isinstance(data, list):
+        raise ValueError(f"批量结果不是 JSON 数组: {text[:200]!r}")
+    results = {}
+    for item in data:
+        if not isinstance(item, dict) or "id" not in item:
+            continue
+        try:
+            results[str(item["id"])] = validate_intent_result(item)
+        except ValueError:
+            continue
+    return results
@@ -0,0 +1,107 @@
+# services/leader_election.py
+
+import logging
+import os
+import socket
+import time
+from typing import Dict, Optional
+
+from telegram.ext import ContextTypes, JobQueue
+
+from telegram_bot import config
+from services import db_service
+
+logger = logging.getLogger(__name__)
+
+# 多进程部署时是否通过数据库选出一个主节点来执行定时任务；关闭时每个进程都认为自己是主节点
+LEADER_ELECTION_ENABLED = getattr(config, 'LEADER_ELECTION_ENABLED', False)
+# 租约有效期（秒）：主节点挂掉后，最多过这么久其他进程就会接手
+LEADER_LEASE_TTL = getattr(config, 'LEADER_LEASE_TTL', 30)
+# 续约间隔（秒），应明显小于租约有效期，允许偶尔一两次续约失败
+LEADER_RENEW_INTERVAL = getattr(config, 'LEADER_RENEW_INTERVAL', 10)
+# 本地认为自己是主节点的时间比数据库里的租约早结束这么多秒，抵消各台机器之间的时钟误差
+LEADER_CLOCK_SKEW_MARGIN = getattr(config, 'LEADER_CLOCK_SKEW_MARGIN', 2)
+
+
+def process_identity() -> str:
+    """当前进程在集群里的名字，用作租约和广播分片的持有者"""
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+class LeaderElector:
+    """
+    基于数据库租约的主节点选举。
+    - 每个进程定期尝试抢占或续约同一行租约，租约过期前只有持有者能续约
+    - 主节点挂掉或和数据库断开后不再续约，租约过期后由其他进程接手
+    - 判断失败时偏向保守：续约失败后，本地的主节点身份在租约到期之前就会失效，不会出现两个主节点
+    没有用 MySQL 的 GET_LOCK：它绑定在一个连接上，而我们的连接来自连接池，归还连接之后锁的归属就说不清了。
+    """
+
+    def __init__(self, name: str = 'scheduler', holder: Optional[str] = None, ttl: float = LEADER_LEASE_TTL,
+                 renew_interval: float = LEADER_RENEW_INTERVAL):
+        if renew_interval >= ttl:
+            raise ValueError("续约间隔必须小于租约有效期")
+        self.name = name
+        self.holder = holder or process_identity()
+        self.ttl = ttl
+        self.renew_interval = renew_interval
+        # 本地认为自己是主节点的截止时间（monotonic）
+        self._leader_until = 0.0
+        self.terms = 0
+        self.renew_failures = 0
+
+    @property
+    def is_leader(self) -> bool:
+        return time.monotonic() < self._leader_until
+
+    def setup(self, job_queue: JobQueue):
+        """把续约任务注册到 JobQueue，启动后立即尝试一次"""
+        job_queue.run_repeating(self.tick, interval=self.renew_interval, first=0, name=f"leader_lease_{self.name}")
+
+    async def tick(self, context: ContextTypes.DEFAULT_TYPE = None):
+        """抢占或续约租约，并更新本地的主节点身份"""
+        # 从发请求之前开始计时，数据库里的租约不会比本地认为的更早过期
+        started = time.monotonic()
+        was_leader = self.is_leader
+        try:
+            acquired = await db_service.try_acquire_lease(self.name, self.holder, self.ttl)
+        except Exception as e:
+            self.renew_failures += 1
+            logger.error(f"续约主节点租约 {self.name} 失败: {e}")
+            return
+        if acquired:
+            self._leader_until = started + self.ttl - LEADER_CLOCK_SKEW_MARGIN
+            if not was_leader:
+                self.terms += 1
+                logger.info(f"{self.holder} 成为 {self.name} 的主节点。")
+        else:
+            self._leader_until = 0.0
+            if was_leader:
+                logger.warning(f"{self.holder} 失去了 {self.name} 的主节点身份。")
+
+    async def release(self):
+        """进程退出前主动放弃租约，其他进程不用等到租约过期"""
+        if not self.is_leader:
+            return
+        self._leader_until = 0.0
+        try:
+            await db_service.release_lease(self.name, self.holder)
+        except Exception as e:
+            logger.error(f"释放主节点租约 {self.name} 失败: {e}")
+
+    def get_stats(self) -> Dict[str, float]:
+        """返回选举的统计数据"""
+        return {
+            'is_leader': int(self.is_leader),
+            'terms': self.terms,
+            'renew_failures': self.renew_failures,
+        }
+
+
+# 定时任务调度用的全局选举器
+elector = LeaderElector()
+
+
+def is_leader() -> bool:
+    """当前进程是否应该执行只允许一个进程执行的定时任务"""
+    return not LEADER_ELECTION_ENABLED or elector.is_leader
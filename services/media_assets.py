@@ -0,0 +1,142 @@
+# services/media_assets.py
+
+import asyncio
+import logging
+from dataclasses import dataclass
+from typing import Dict, Optional, Sequence, Tuple
+
+from telegram import InputMediaPhoto, Message
+from telegram.error import BadRequest
+
+from services.db_service import get_media_file_ids, save_media_file_id, delete_media_file_id
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass(frozen=True)
+class MediaAsset:
+    """一个可以发送的素材"""
+    # 在 media_assets 表里保存 file_id 用的名字
+    name: str
+    # 还没有 file_id 时使用的网址，由 Telegram 自己去下载
+    url: str
+
+
+class MediaAssetRegistry:
+    """
+    素材的 file_id 缓存。
+    - 每个素材只让 Telegram 下载一次，返回的 file_id 存进数据库，所有进程、重启之后都直接复用
+    - file_id 失效（比如换了机器人）时删掉缓存，重新用网址发送一次
+    - 数据库读不出 file_id 时本次按没有缓存处理，用网址发送，下次再读
+    """
+
+    def __init__(self):
+        self._file_ids: Dict[str, str] = {}
+        self._loaded = False
+        self._load_lock = asyncio.Lock()
+        self._upload_lock = asyncio.Lock()
+        self.cached_sends = 0
+        self.uploads = 0
+        self.stale_file_ids = 0
+        self.load_failures = 0
+
+    async def _ensure_loaded(self):
+        """第一次用到时从数据库读出所有 file_id，素材数量很少，全部放在内存里"""
+        if self._loaded:
+            return
+        async with self._load_lock:
+            if self._loaded:
+                return
+            try:
+                stored = await get_media_file_ids()
+            except Exception as e:
+                self.load_failures += 1
+                logger.error(f"读取素材的 file_id 失败，本次用网址发送: {e}")
+                return
+            # 读取失败期间本进程新拿到的 file_id 比数据库里的新
+            self._file_ids = {**stored, **self._file_ids}
+            self._loaded = True
+
+    def resolve(self, asset: MediaAsset) -> str:
+        """返回发送这个素材时用的参数：已知的 file_id，否则是网址"""
+        return self._file_ids.get(asset.name) or asset.url
+
+    def _count(self, media: str, asset: MediaAsset):
+        if media == asset.url:
+            self.uploads += 1
+        else:
+            self.cached_sends += 1
+
+    async def _remember(self, asset: MediaAsset, message: Message):
+        """从发送结果里取出最大尺寸图片的 file_id 并保存"""
+        if not message.photo:
+            return
+        file_id = message.photo[-1].file_id
+        if file_id == self._file_ids.get(asset.name):
+            return
+        self._file_ids[asset.name] = file_id
+        try:
+            await save_media_file_id(asset.name, file_id)
+        except Exception as e:
+            # 只影响其他进程和重启后的复用，本进程的内存里已经有了
+            logger.error(f"保存素材 {asset.name} 的 file_id 失败: {e}")
+
+    async def _forget(self, assets: Sequence[MediaAsset]):
+        for asset in assets:
+            self._file_ids.pop(asset.name, None)
+            self.stale_file_ids += 1
+            try:
+                await delete_media_file_id(asset.name)
+            except Exception as e:
+                # 本进程已经不再使用它，数据库里的旧值下次发送失败时会再删一次
+                logger.error(f"删除素材 {asset.name} 的 file_id 失败: {e}")
+
+    async def send_photo_group(self, bot, chat_id: int, photos: Sequence[Tuple[MediaAsset, str]],
+                               parse_mode: Optional[str] = None) -> Tuple[Message, ...]:
+        """用一次 send_media_group 发送多张图片，每张图片带自己的说明文字"""
+        await self._ensure_loaded()
+        if all(asset.name in self._file_ids for asset, _ in photos):
+            messages = await self._send_group(bot, chat_id, photos, parse_mode)
+            if messages is not None:
+                return messages
+        # 有素材需要上传：同一时间只让一个协程上传，其他协程等它拿到 file_id 之后直接复用
+        async with self._upload_lock:
+            while True:
+                messages = await self._send_group(bot, chat_id, photos, parse_mode)
+                if messages is not None:
+                    return messages
+
+    async def _send_group(self, bot, chat_id: int, photos: Sequence[Tuple[MediaAsset, str]],
+                          parse_mode: Optional[str]) -> Optional[Tuple[Message, ...]]:
+        """发送一组图片并记下 file_id；用到的 file_id 已失效时删掉它们并返回 None，由调用方重新上传"""
+        resolved = [(asset, self.resolve(asset)) for asset, _ in photos]
+        media = [InputMediaPhoto(value, caption=caption, parse_mode=parse_mode)
+                 for (_, value), (_, caption) in zip(resolved, photos)]
+        try:
+            messages = await bot.send_media_group(chat_id=chat_id, media=media)
+        except BadRequest as e:
+            stale = [asset for asset, value in resolved if value == self._file_ids.get(asset.name)]
+            if not stale or 'file' not in str(e).lower():
+                raise
+            logger.warning(f"素材的 file_id 已失效，重新上传: {[asset.name for asset in stale]} ({e})")
+            await self._forget(stale)
+            return None
+        for asset, value in resolved:
+            self._count(value, asset)
+        for (asset, _), message in zip(photos, messages or ()):
+            await self._remember(asset, message)
+        return messages
+
+    def get_stats(self) -> Dict[str, float]:
+        """返回素材发送的统计数据"""
+        return {
+            'known_file_ids': len(self._file_ids),
+            'cached_sends': self.cached_sends,
+            'uploads': self.uploads,
+            'stale_file_ids': self.stale_file_ids,
+            'load_failures': self.load_failures,
+        }
+
+
+# 全局唯一的素材缓存
+media_registry = MediaAssetRegistry()
@@ -0,0 +1,21 @@
+# services/storage/__init__.py
+
+from telegram_bot import config
+from services.storage.base import Storage
+
+# 使用哪种数据库：'mysql'（默认）或 'sqlite'（单机部署和压测用，不需要数据库服务器）
+DB_BACKEND = getattr(config, 'DB_BACKEND', 'mysql')
+
+
+def create_storage(name: str = DB_BACKEND) -> Storage:
+    """按名称创建存储实现，名称未知时抛出 ValueError；只导入用到的数据库驱动"""
+    if name == 'mysql':
+        from services.storage.mysql import MySQLStorage
+        return MySQLStorage()
+    if name == 'sqlite':
+        from services.storage.sqlite import SQLiteStorage
+        return SQLiteStorage()
+    raise ValueError(f"未知的数据库类型: {name!r}")
+
+
+__all__ = ['DB_BACKEND', 'Storage', 'create_storage']
@@ -0,0 +1,140 @@
+# services/storage/base.py
+
+from abc import ABC, abstractmethod
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+
+class Storage(ABC):
+    """
+    数据库存储接口：db_service 用到的所有 SQL 都在这里定义成方法，由具体的数据库实现。
+    缓存、延迟写入队列等逻辑留在 db_service，与使用哪种数据库无关。
+    """
+
+    name = 'base'
+
+    @abstractmethod
+    async def initialize(self):
+        """建立连接，创建数据表并执行迁移"""
+
+    @abstractmethod
+    async def close(self):
+        """关闭所有连接"""
+
+    @abstractmethod
+    async def fetch_user(self, user_id: int) -> Optional[Dict[str, Any]]:
+        """读取一个用户的整行数据，不存在时返回 None"""
+
+    @abstractmethod
+    async def upsert_user(self, user_id: int, data: Dict[str, Any]):
+        """插入或更新用户数据（data 里已经包含 user_id）"""
+
+    @abstractmethod
+    async def fetch_chat_history(self, user_id: int, limit: int) -> List[Dict[str, Any]]:
+        """读取用户最近 limit 条对话，按时间从旧到新排列"""
+
+    @abstractmethod
+    async def insert_chat_messages(self, rows: List[Tuple[int, str, str]]):
+        """在一次写入里插入多条 (user_id, role, text) 对话记录，失败时抛出异常"""
+
+    @abstractmethod
+    async def fetch_subscribed_page(self, max_push_messages: int, after_user_id: int, limit: int,
+                                    shard_count: int = 1, shard_index: int = 0) -> List[Dict[str, Any]]:
+        """
+        按 user_id 键集分页读取一页符合广播条件的订阅用户。
+        shard_count > 1 时只读取 user_id % shard_count == shard_index 的用户。
+        """
+
+    @abstractmethod
+    async def increment_push_count(self, user_id: int):
+        """为指定用户增加一次推送计数"""
+
+    @abstractmethod
+    async def bulk_update_users(self, set_clause: str, user_ids: List[int], chunk_size: int) -> int:
+        """分块执行 UPDATE users SET ... WHERE user_id IN (...)，返回受影响的行数"""
+
+    @abstractmethod
+    async def archive_old_chat_history(self, max_age_days: int, batch_size: int, max_batches: int) -> int:
+        """把早于 max_age_days 天的对话记录分小批搬到归档表，返回搬走的行数"""
+
+    @abstractmethod
+    async def archive_chat_history_over_cap(self, per_user_cap: int, batch_size: int, max_batches: int,
+                                            after_user_id: Optional[int], max_users: int) -> Tuple[int, Optional[int]]:
+        """
+        每个用户只保留最近 per_user_cap 条对话，更早的分小批搬到归档表。
+        从 after_user_id 之后按 user_id 每次检查 batch_size 个用户，最多检查 max_users 个；
+        返回 (搬走的行数, 下次从哪个 user_id 之后继续)，已经检查到最后一个用户时返回 None。
+        """
+
+    @abstractmethod
+    async def try_acquire_lease(self, name: str, holder: str, ttl: float, now: float) -> bool:
+        """租约不存在、已过期或本来就属于 holder 时，把它（续）给 holder 到 now + ttl，返回是否持有租约"""
+
+    @abstractmethod
+    async def release_lease(self, name: str, holder: str):
+        """holder 主动放弃租约，其他进程不用等到过期"""
+
+    @abstractmethod
+    async def create_broadcast_round(self, multiplier: str, shard_count: int, now: float) -> int:
+        """在一个事务里创建一轮广播和它的 shard_count 个待认领分片，返回轮次 ID"""
+
+    @abstractmethod
+    async def count_open_broadcast_shards(self, created_after: float) -> int:
+        """created_after 之后创建的轮次里还没发完的分片数"""
+
+    @abstractmethod
+    async def claim_broadcast_shard(self, owner: str, claim_ttl: float, now: float,
+                                    created_after: float) -> Optional[Dict[str, Any]]:
+        """
+        认领一个待发送的分片，或者认领期已过、原主人多半已经挂掉的分片。
+        返回 round_id、shard_index、shard_count、multiplier、created_at、last_user_id（续发的起点），没有可认领的分片时返回 None
+        """
+
+    @abstractmethod
+    async def checkpoint_broadcast_shard(self, round_id: int, shard_index: int, owner: str,
+                                         last_user_id: Optional[int], sent: int, claim_ttl: float, now: float) -> bool:
+        """记录发送进度并延长认领期；分片已经不属于 owner 时返回 False"""
+
+    @abstractmethod
+    async def complete_broadcast_shard(self, round_id: int, shard_index: int, owner: str, sent: int, failed: int):
+        """把分片标记为已完成"""
+
+    @abstractmethod
+    async def prune_broadcast_rounds(self, created_before: float) -> int:
+        """删除 created_before 之前创建的轮次和它们的分片，返回删除的轮次数"""
+
+    @abstractmethod
+    async def upsert_reminder(self, user_id: int, kind: str, chat_id: int, due_at: float):
+        """安排一条提醒；同一用户同一种提醒已经存在时改成新的到期时间"""
+
+    @abstractmethod
+    async def fetch_due_reminders(self, kind: str, now: float, limit: int) -> List[Dict[str, Any]]:
+        """
+        按到期时间取出最多 limit 条已经到期的提醒，同时带出用户当前的 state（用户不存在时为 None）。
+        返回 user_id、chat_id、due_at、state
+        """
+
+    @abstractmethod
+    async def delete_reminders(self, kind: str, user_ids: List[int], due_before: float, chunk_size: int) -> int:
+        """删除已经处理过的提醒；只删 due_at <= due_before 的，处理期间被重新安排的提醒会保留"""
+
+    @abstractmethod
+    async def fetch_media_file_ids(self) -> Dict[str, str]:
+        """读取所有素材的 file_id，返回 {素材名: file_id}"""
+
+    @abstractmethod
+    async def save_media_file_id(self, name: str, file_id: str, now: float):
+        """保存或替换一个素材的 file_id"""
+
+    @abstractmethod
+    async def delete_media_file_id(self, name: str):
+        """删除一个已经失效的 file_id"""
+
+    def stats(self) -> Dict[str, float]:
+        """返回连接相关的统计数据"""
+        return {}
+
+
+def chunked(items: List[Any], size: int) -> Iterable[List[Any]]:
+    """把列表按固定大小切块"""
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
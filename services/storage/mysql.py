@@ -0,0 +1,475 @@
+# services/storage/mysql.py
+
+import asyncio
+import logging
+from typing import Any, Dict, List, Optional, Tuple
+
+import aiomysql
+
+from telegram_bot import config
+from services.db_migrations import apply_migrations
+from services.storage.base import Storage, chunked
+
+logger = logging.getLogger(__name__)
+
+# 连接池的最小和最大连接数
+DB_POOL_MIN_SIZE = getattr(config, 'DB_POOL_MIN_SIZE', 1)
+DB_POOL_MAX_SIZE = getattr(config, 'DB_POOL_MAX_SIZE', 10)
+
+
+class MySQLStorage(Storage):
+    """基于 aiomysql 连接池的 MySQL 存储"""
+
+    name = 'mysql'
+
+    def __init__(self):
+        self.pool = None
+
+    async def get_pool(self):
+        """获取或创建数据库连接池"""
+        if self.pool is None:
+            logger.info("Creating database connection pool...")
+            self.pool = await aiomysql.create_pool(
+                host=config.DB_HOST,
+                port=3306,
+                user=config.DB_USER,
+                password=config.DB_PASSWORD,
+                db=config.DB_NAME,
+                minsize=DB_POOL_MIN_SIZE,
+                maxsize=DB_POOL_MAX_SIZE,
+                autocommit=True  # 自动提交事务
+            )
+        return self.pool
+
+    async def initialize(self):
+        """创建必要的表，并执行版本化的数据库迁移"""
+        db_pool = await self.get_pool()
+        async with db_pool.acquire() as conn:
+            async with conn.cursor() as cur:
+                # 创建 users 表 (MySQL 语法)
+                await cur.execute("""
+                                  CREATE TABLE IF NOT EXISTS users
+                                  (
+                                      user_id
+                                      BIGINT
+                                      PRIMARY
+                                      KEY,
+                                      username
+                                      VARCHAR
+                                  (
+                                      255
+                                  ),
+                                      first_name VARCHAR
+                                  (
+                                      255
+                                  ),
+                                      chat_id BIGINT UNIQUE,
+                                      state VARCHAR
+                                  (
+                                      50
+                                  ),
+                                      chat_message_count INT DEFAULT 0,
+                                      subscribed_to_broadcast BOOLEAN DEFAULT 1,
+                                      service_status VARCHAR
+                                  (
+                                      20
+                                  ) DEFAULT 'pending',
+                                      push_message_count INT DEFAULT 0,
+                                      language_code VARCHAR
+                                  (
+                                      10
+                                  ) DEFAULT 'en'
+                                      )
+                                  """)
+                # 创建 chat_history 表
+                await cur.execute("""
+                                  CREATE TABLE IF NOT EXISTS chat_history
+                                  (
+                                      message_id
+                                      INT
+                                      AUTO_INCREMENT
+                                      PRIMARY
+                                      KEY,
+                                      user_id
+                                      BIGINT,
+                                      role
+                                      VARCHAR
+                                  (
+                                      20
+                                  ),
+                                      text TEXT,
+                                      timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                                      FOREIGN KEY
+                                  (
+                                      user_id
+                                  ) REFERENCES users
+                                  (
+                                      user_id
+                                  )
+                                      )
+                                  """)
+            # 执行版本化的数据库迁移（索引等）
+            await apply_migrations(conn)
+        logger.info(f"数据库 '{config.DB_NAME}' 初始化成功。")
+
+    async def close(self):
+        if self.pool:
+            logger.info("正在关闭数据库连接池...")
+            self.pool.close()
+            await self.pool.wait_closed()
+            self.pool = None
+            logger.info("数据库连接池已关闭。")
+
+    async def fetch_user(self, user_id: int) -> Optional[Dict[str, Any]]:
+        db_pool = await self.get_pool()
+        async with db_pool.acquire() as conn:
+            async with conn.cursor(aiomysql.DictCursor) as cur:
+                await cur.execute("SELECT * FROM users WHERE user_id = %s", (user_id,))
+                return await cur.fetchone()
+
+    async def upsert_user(self, user_id: int, data: Dict[str, Any]):
+        """使用 INSERT ... ON DUPLICATE KEY UPDATE 更新或创建用户数据"""
+        columns = ', '.join(f"`{k}`" for k in data.keys())
+        placeholders = ', '.join(['%s'] * len(data))
+        updates = ', '.join(f"`{k}` = VALUES(`{k}`)" for k in data.keys())
+
+        sql = f"INSERT INTO users ({columns}) VALUES ({placeholders}) ON DUPLICATE KEY UPDATE {updates}"
+
+        db_pool = await self.get_pool()
+        async with db_pool.acquire() as conn:
+            async with conn.cursor() as cur:
+                await cur.execute(sql, tuple(data.values()))
+
+    async def fetch_chat_history(self, user_id: int, limit: int) -> List[Dict[str, Any]]:
+        db_pool = await self.get_pool()
+        async with db_pool.acquire() as conn:
+            async with conn.cursor(aiomysql.DictCursor) as cur:
+                sql = "SELECT role, text FROM chat_history WHERE user_id = %s ORDER BY timestamp DESC LIMIT %s"
+                await cur.execute(sql, (user_id, limit))
+                return list(reversed(await cur.fetchall()))
+
+    async def insert_chat_messages(self, rows: List[Tuple[int, str, str]]):
+        sql = "INSERT INTO chat_history (user_id, role, text) VALUES (%s, %s, %s)"
+        db_pool = await self.get_pool()
+        async with db_pool.acquire() as conn:
+            async with conn.cursor() as cur:
+                # aiomysql 会把 executemany 的 INSERT 合并成一条多行 INSERT
+                await cur.executemany(sql, rows)
+
+    async def fetch_subscribed_page(self, max_push_messages: int, after_user_id: int, limit: int,
+                                    shard_count: int = 1, shard_index: int = 0) -> List[Dict[str, Any]]:
+        shard_filter = "AND MOD(user_id, %s) = %s" if shard_count > 1 else ""
+        sql = f"""
+              SELECT user_id, chat_id, language_code \
+              FROM users
+              WHERE service_status = 'confirmed'
+                AND subscribed_to_broadcast = 1
+                AND chat_id IS NOT NULL
+                AND push_message_count < %s
+                AND user_id > %s
+                {shard_filter}
+              ORDER BY user_id
+              LIMIT %s \
+              """
+        params = (max_push_messages, after_user_id)
+        if shard_count > 1:
+            params += (shard_count, shard_index)
+        db_pool = await self.get_pool()
+        async with db_pool.acquire() as conn:
+            async with conn.cursor(aiomysql.DictCursor) as cur:
+                await cur.execute(sql, params + (limit,))
+                return await cur.fetchall()
+
+    async def increment_push_count(self, user_id: int):
+        db_pool = await self.get_pool()
+        async with db_pool.acquire() as conn:
+            async with conn.cursor() as cur:
+                sql = "UPDATE users SET push_message_count = push_message_count + 1 WHERE user_id = %s"
+                await cur.execute(sql, (user_id,))
+
+    async def bulk_update_users(self, set_clause: str, user_ids: List[int], chunk_size: int) -> int:
+        """在同一个连接上分块执行批量 UPDATE"""
+        affected = 0
+        db_pool = await self.get_pool()
+        async with db_pool.acquire() as conn:
+            async with conn.cursor() as cur:
+                for chunk in chunked(user_ids, chunk_size):
+                    placeholders = ', '.join(['%s'] * len(chunk))
+                    sql = f"UPDATE users SET {set_clause} WHERE user_id IN ({placeholders})"
+                    affected += await cur.execute(sql, tuple(chunk))
+        return affected
+
+    @staticmethod
+    async def _move_chat_history_rows(conn, message_ids: List[int]) -> int:
+        """在一个事务里把指定的对话记录复制到归档表并从原表删除"""
+        if not message_ids:
+            return 0
+        placeholders = ', '.join(['%s'] * len(message_ids))
+        await conn.begin()
+        try:
+            async with conn.cursor() as cur:
+                await cur.execute(
+                    f"INSERT IGNORE INTO chat_history_archive (message_id, user_id, role, text, timestamp) "
+                    f"SELECT message_id, user_id, role, text, timestamp FROM chat_history "
+                    f"WHERE message_id IN ({placeholders})", tuple(message_ids))
+                moved = await cur.execute(
+                    f"DELETE FROM chat_history WHERE message_id IN ({placeholders})", tuple(message_ids))
+            await conn.commit()
+        except Exception:
+            await conn.rollback()
+            raise
+        return moved
+
+    async def archive_old_chat_history(self, max_age_days: int, batch_size: int, max_batches: int) -> int:
+        moved = 0
+        db_pool = await self.get_pool()
+        for _ in range(max_batches):
+            async with db_pool.acquire() as conn:
+                async with conn.cursor() as cur:
+                    await cur.execute(
+                        "SELECT message_id FROM chat_history "
+                        "WHERE timestamp < NOW() - INTERVAL %s DAY ORDER BY message_id LIMIT %s",
+                        (max_age_days, batch_size))
+                    message_ids = [row[0] for row in await cur.fetchall()]
+                moved += await self._move_chat_history_rows(conn, message_ids)
+            if len(message_ids) < batch_size:
+                break
+            # 每批之间让出事件循环，也给数据库上的其他写入留出空隙
+            await asyncio.sleep(0)
+        return moved
+
+    async def archive_chat_history_over_cap(self, per_user_cap: int, batch_size: int, max_batches: int,
+                                            after_user_id: Optional[int], max_users: int) -> Tuple[int, Optional[int]]:
+        moved = 0
+        batches = 0
+        scanned = 0
+        cursor = after_user_id
+        db_pool = await self.get_pool()
+        while scanned < max_users:
+            # 沿 idx_chat_history_user_ts 按 user_id 分段，每条查询只读一小段用户的索引
+            async with db_pool.acquire() as conn:
+                async with conn.cursor() as cur:
+                    if cursor is None:
+                        await cur.execute("SELECT DISTINCT user_id FROM chat_history ORDER BY user_id LIMIT %s",
+                                          (batch_size,))
+                    else:
+                        await cur.execute(
+                            "SELECT DISTINCT user_id FROM chat_history WHERE user_id > %s ORDER BY user_id LIMIT %s",
+                            (cursor, batch_size))
+                    user_ids = [row[0] for row in await cur.fetchall()]
+                    if not user_ids:
+                        return moved, None
+                    await cur.execute(
+                        "SELECT user_id FROM chat_history WHERE user_id BETWEEN %s AND %s "
+                        "GROUP BY user_id HAVING COUNT(*) > %s",
+                        (user_ids[0], user_ids[-1], per_user_cap))
+                    over_cap = [row[0] for row in await cur.fetchall()]
+            for user_id in over_cap:
+                while True:
+                    if batches >= max_batches:
+                        # 批次用完了，下次从这个用户继续
+                        return moved, user_id - 1
+                    async with db_pool.acquire() as conn:
+                        async with conn.cursor() as cur:
+                            await cur.execute(
+                                "SELECT message_id FROM chat_history WHERE user_id = %s "
+                                "ORDER BY timestamp DESC, message_id DESC LIMIT %s OFFSET %s",
+                                (user_id, batch_size, per_user_cap))
+                            message_ids = [row[0] for row in await cur.fetchall()]
+                        moved += await self._move_chat_history_rows(conn, message_ids)
+                    batches += 1
+                    if len(message_ids) < batch_size:
+                        break
+                    await asyncio.sleep(0)
+            if len(user_ids) < batch_size:
+                return moved, None
+            cursor = user_ids[-1]
+            scanned += len(user_ids)
+            await asyncio.sleep(0)
+        return moved, cursor
+
+    async def try_acquire_lease(self, name: str, holder: str, ttl: float, now: float) -> bool:
+        """
+        一条 upsert 完成抢占或续约：MySQL 按从左到右的顺序执行 ON DUPLICATE KEY UPDATE 的赋值，
+        所以第二个 IF 看到的 holder 已经是更新后的值，只有真正拿到租约时才会延长过期时间。
+        """
+        sql = """
+              INSERT INTO leader_leases (name, holder, expires_at) VALUES (%s, %s, %s)
+              ON DUPLICATE KEY UPDATE
+                  holder = IF(expires_at < %s OR holder = VALUES(holder), VALUES(holder), holder),
+                  expires_at = IF(holder = VALUES(holder), VALUES(expires_at), expires_at)
+              """
+        db_pool = await self.get_pool()
+        async with db_pool.acquire() as conn:
+            async with conn.cursor() as cur:
+                await cur.execute(sql, (name, holder, now + ttl, now))
+                await cur.execute("SELECT holder FROM leader_leases WHERE name = %s", (name,))
+                row = await cur.fetchone()
+        return bool(row) and row[0] == holder
+
+    async def release_lease(self, name: str, holder: str):
+        db_pool = await self.get_pool()
+        async with db_pool.acquire() as conn:
+            async with conn.cursor() as cur:
+                await cur.execute("DELETE FROM leader_leases WHERE name = %s AND holder = %s", (name, holder))
+
+    async def create_broadcast_round(self, multiplier: str, shard_count: int, now: float) -> int:
+        db_pool = await self.get_pool()
+        async with db_pool.acquire() as conn:
+            await conn.begin()
+            try:
+                async with conn.cursor() as cur:
+                    await cur.execute(
+                        "INSERT INTO broadcast_rounds (multiplier, shard_count, created_at) VALUES (%s, %s, %s)",
+                        (multiplier, shard_count, now))
+                    round_id = cur.lastrowid
+                    await cur.executemany(
+                        "INSERT INTO broadcast_shards (round_id, shard_index) VALUES (%s, %s)",
+                        [(round_id, index) for index in range(shard_count)])
+                await conn.commit()
+            except Exception:
+                await conn.rollback()
+                raise
+        return round_id
+
+    async def count_open_broadcast_shards(self, created_after: float) -> int:
+        sql = """
+              SELECT COUNT(*) FROM broadcast_shards s
+              JOIN broadcast_rounds r ON r.round_id = s.round_id
+              WHERE s.status <> 'done' AND r.created_at >= %s
+              """
+        db_pool = await self.get_pool()
+        async with db_pool.acquire() as conn:
+            async with conn.cursor() as cur:
+                await cur.execute(sql, (created_after,))
+                (count,) = await cur.fetchone()
+        return count
+
+    async def claim_broadcast_shard(self, owner: str, claim_ttl: float, now: float,
+                                    created_after: float) -> Optional[Dict[str, Any]]:
+        """SELECT ... FOR UPDATE SKIP LOCKED：多个进程同时认领时各自拿到不同的分片，互不等待"""
+        sql = """
+              SELECT s.round_id, s.shard_index, r.shard_count, r.multiplier, r.created_at, s.last_user_id
+              FROM broadcast_shards s
+              JOIN broadcast_rounds r ON r.round_id = s.round_id
+              WHERE (s.status = 'pending' OR (s.status = 'claimed' AND s.claimed_until < %s))
+                AND r.created_at >= %s
+              ORDER BY s.round_id, s.shard_index
+              LIMIT 1
+              FOR UPDATE OF s SKIP LOCKED
+              """
+        db_pool = await self.get_pool()
+        async with db_pool.acquire() as conn:
+            await conn.begin()
+            try:
+                async with conn.cursor(aiomysql.DictCursor) as cur:
+                    await cur.execute(sql, (now, created_after))
+                    shard = await cur.fetchone()
+                    if shard:
+                        await cur.execute(
+                            "UPDATE broadcast_shards SET status = 'claimed', owner = %s, claimed_until = %s, "
+                            "attempts = attempts + 1 WHERE round_id = %s AND shard_index = %s",
+                            (owner, now + claim_ttl, shard['round_id'], shard['shard_index']))
+                await conn.commit()
+            except Exception:
+                await conn.rollback()
+                raise
+        return shard
+
+    async def checkpoint_broadcast_shard(self, round_id: int, shard_index: int, owner: str,
+                                         last_user_id: Optional[int], sent: int, claim_ttl: float, now: float) -> bool:
+        sql = """
+              UPDATE broadcast_shards
+              SET claimed_until = %s, last_user_id = COALESCE(%s, last_user_id), sent = %s
+              WHERE round_id = %s AND shard_index = %s AND owner = %s AND status = 'claimed'
+              """
+        db_pool = await self.get_pool()
+        async with db_pool.acquire() as conn:
+            async with conn.cursor() as cur:
+                affected = await cur.execute(sql, (now + claim_ttl, last_user_id, sent, round_id, shard_index, owner))
+        # 值没有变化时 MySQL 默认返回 0 行，但 claimed_until 每次都会变，所以 0 行就说明分片已经被别人认领
+        return affected > 0
+
+    async def complete_broadcast_shard(self, round_id: int, shard_index: int, owner: str, sent: int, failed: int):
+        db_pool = await self.get_pool()
+        async with db_pool.acquire() as conn:
+            async with conn.cursor() as cur:
+                await cur.execute(
+                    "UPDATE broadcast_shards SET status = 'done', sent = %s, failed = %s "
+                    "WHERE round_id = %s AND shard_index = %s AND owner = %s",
+                    (sent, failed, round_id, shard_index, owner))
+
+    async def prune_broadcast_rounds(self, created_before: float) -> int:
+        db_pool = await self.get_pool()
+        async with db_pool.acquire() as conn:
+            async with conn.cursor() as cur:
+                await cur.execute(
+                    "DELETE s FROM broadcast_shards s JOIN broadcast_rounds r ON r.round_id = s.round_id "
+                    "WHERE r.created_at < %s", (created_before,))
+                return await cur.execute("DELETE FROM broadcast_rounds WHERE created_at < %s", (created_before,))
+
+    async def upsert_reminder(self, user_id: int, kind: str, chat_id: int, due_at: float):
+        sql = """
+              INSERT INTO reminders (user_id, kind, chat_id, due_at) VALUES (%s, %s, %s, %s)
+              ON DUPLICATE KEY UPDATE chat_id = VALUES(chat_id), due_at = VALUES(due_at)
+              """
+        db_pool = await self.get_pool()
+        async with db_pool.acquire() as conn:
+            async with conn.cursor() as cur:
+                await cur.execute(sql, (user_id, kind, chat_id, due_at))
+
+    async def fetch_due_reminders(self, kind: str, now: float, limit: int) -> List[Dict[str, Any]]:
+        """走 (kind, due_at) 索引按到期顺序读取，用户状态通过主键 JOIN 一次查出"""
+        sql = """
+              SELECT r.user_id, r.chat_id, r.due_at, u.state
+              FROM reminders r
+              LEFT JOIN users u ON u.user_id = r.user_id
+              WHERE r.kind = %s AND r.due_at <= %s
+              ORDER BY r.due_at
+              LIMIT %s
+              """
+        db_pool = await self.get_pool()
+        async with db_pool.acquire() as conn:
+            async with conn.cursor(aiomysql.DictCursor) as cur:
+                await cur.execute(sql, (kind, now, limit))
+                return list(await cur.fetchall())
+
+    async def delete_reminders(self, kind: str, user_ids: List[int], due_before: float, chunk_size: int) -> int:
+        affected = 0
+        db_pool = await self.get_pool()
+        async with db_pool.acquire() as conn:
+            async with conn.cursor() as cur:
+                for chunk in chunked(user_ids, chunk_size):
+                    placeholders = ', '.join(['%s'] * len(chunk))
+                    sql = (f"DELETE FROM reminders WHERE kind = %s AND due_at <= %s "
+                           f"AND user_id IN ({placeholders})")
+                    affected += await cur.execute(sql, (kind, due_before) + tuple(chunk))
+        return affected
+
+    async def fetch_media_file_ids(self) -> Dict[str, str]:
+        db_pool = await self.get_pool()
+        async with db_pool.acquire() as conn:
+            async with conn.cursor() as cur:
+                await cur.execute("SELECT name, file_id FROM media_assets")
+                return {name: file_id for name, file_id in await cur.fetchall()}
+
+    async def save_media_file_id(self, name: str, file_id: str, now: float):
+        sql = """
+              INSERT INTO media_assets (name, file_id, updated_at) VALUES (%s, %s, %s)
+              ON DUPLICATE KEY UPDATE file_id = VALUES(file_id), updated_at = VALUES(updated_at)
+              """
+        db_pool = await self.get_pool()
+        async with db_pool.acquire() as conn:
+            async with conn.cursor() as cur:
+                await cur.execute(sql, (name, file_id, now))
+
+    async def delete_media_file_id(self, name: str):
+        db_pool = await self.get_pool()
+        async with db_pool.acquire() as conn:
+            async with conn.cursor() as cur:
+                await cur.execute("DELETE FROM media_assets WHERE name = %s", (name,))
+
+    def stats(self) -> Dict[str, float]:
+        if self.pool is None:
+            return {'pool_size': 0, 'pool_free': 0, 'pool_max_size': DB_POOL_MAX_SIZE}
+        return {'pool_size': self.pool.size, 'pool_free': self.pool.freesize, 'pool_max_size': self.pool.maxsize}
@@ -0,0 +1,446 @@
+# services/storage/sqlite.py
+
+import asyncio
+import itertools
+import logging
+from contextlib import asynccontextmanager
+from typing import Any, Dict, List, Optional, Tuple
+
+import aiosqlite
+
+from telegram_bot import config
+from services.db_migrations import apply_sqlite_migrations
+from services.storage.base import Storage, chunked
+
+logger = logging.getLogger(__name__)
+
+# SQLite 数据库文件路径
+SQLITE_PATH = getattr(config, 'SQLITE_PATH', 'tg_z7game.sqlite3')
+# 只读连接的数量：WAL 模式下读和写互不阻塞，多个读连接可以并行查询
+SQLITE_READ_CONNECTIONS = getattr(config, 'SQLITE_READ_CONNECTIONS', 4)
+# 页缓存大小（KiB）和内存映射大小（字节）
+SQLITE_CACHE_SIZE_KB = getattr(config, 'SQLITE_CACHE_SIZE_KB', 65536)
+SQLITE_MMAP_SIZE = getattr(config, 'SQLITE_MMAP_SIZE', 268435456)
+# 数据库被锁时最多等待多少毫秒
+SQLITE_BUSY_TIMEOUT_MS = getattr(config, 'SQLITE_BUSY_TIMEOUT_MS', 5000)
+
+# 把 users 表的行读成字典时的列名
+_USER_COLUMNS = ('user_id', 'username', 'first_name', 'chat_id', 'state', 'chat_message_count',
+                 'subscribed_to_broadcast', 'service_status', 'push_message_count', 'language_code')
+
+
+class SQLiteStorage(Storage):
+    """
+    基于 aiosqlite 的单机存储，适合小规模部署和压测，不需要数据库服务器。
+    - WAL 模式，synchronous=NORMAL：提交只追加 WAL，不等每次 fsync
+    - 所有写入走同一个写连接并串行化（SQLite 同一时刻只允许一个写事务），多行写入放在一个事务里提交
+    - 读取轮流使用几个只读连接，不会被写事务阻塞
+    """
+
+    name = 'sqlite'
+
+    def __init__(self, path: str = SQLITE_PATH, read_connections: int = SQLITE_READ_CONNECTIONS):
+        self.path = path
+        self.read_connection_count = max(1, read_connections)
+        self._writer: Optional[aiosqlite.Connection] = None
+        self._readers: List[aiosqlite.Connection] = []
+        self._reader_cycle = None
+        self._connect_lock = asyncio.Lock()
+        self._write_lock = asyncio.Lock()
+        self.write_transactions = 0
+        self.rows_written = 0
+
+    async def _connect(self, read_only: bool = False) -> aiosqlite.Connection:
+        # isolation_level=None：不使用 sqlite3 模块的隐式事务，写事务由 _write_transaction 显式开启
+        conn = await aiosqlite.connect(self.path, isolation_level=None)
+        conn.row_factory = aiosqlite.Row
+        await self._pragma(conn, f"busy_timeout = {int(SQLITE_BUSY_TIMEOUT_MS)}")
+        await self._pragma(conn, "synchronous = NORMAL")
+        await self._pragma(conn, "temp_store = MEMORY")
+        await self._pragma(conn, f"cache_size = -{int(SQLITE_CACHE_SIZE_KB)}")
+        await self._pragma(conn, f"mmap_size = {int(SQLITE_MMAP_SIZE)}")
+        if read_only:
+            # 读连接拒绝任何写入，写入只能走串行化的写连接
+            await self._pragma(conn, "query_only = ON")
+        return conn
+
+    @staticmethod
+    async def _pragma(conn: aiosqlite.Connection, statement: str):
+        # 读完并关闭游标：没读完的 PRAGMA 语句会一直占着数据库锁
+        async with conn.execute(f"PRAGMA {statement}") as cur:
+            await cur.fetchall()
+
+    async def _ensure_connected(self):
+        if self._writer is not None:
+            return
+        # 建立连接的过程中会让出控制权，加锁避免并发的第一次调用各自建一套连接
+        async with self._connect_lock:
+            if self._writer is not None:
+                return
+            writer = await self._connect()
+            # journal_mode 是持久化的设置，在写连接上设置一次即可
+            await self._pragma(writer, "journal_mode = WAL")
+            self._readers = [await self._connect(read_only=True) for _ in range(self.read_connection_count)]
+            self._reader_cycle = itertools.cycle(self._readers)
+            # 读连接都准备好之后才设置写连接，其他协程看到它就可以直接使用
+            self._writer = writer
+
+    async def _reader(self) -> aiosqlite.Connection:
+        await self._ensure_connected()
+        return next(self._reader_cycle)
+
+    @asynccontextmanager
+    async def _write_transaction(self):
+        """串行化的写事务：成功时提交，失败时回滚"""
+        await self._ensure_connected()
+        async with self._write_lock:
+            await self._writer.execute("BEGIN IMMEDIATE")
+            try:
+                yield self._writer
+            except BaseException:
+                await self._writer.rollback()
+                raise
+            await self._writer.commit()
+            self.write_transactions += 1
+
+    async def initialize(self):
+        """创建必要的表，并执行版本化的数据库迁移"""
+        await self._ensure_connected()
+        async with self._write_lock:
+            await self._writer.executescript("""
+                CREATE TABLE IF NOT EXISTS users
+                (
+                    user_id INTEGER PRIMARY KEY,
+                    username TEXT,
+                    first_name TEXT,
+                    chat_id INTEGER UNIQUE,
+                    state TEXT,
+                    chat_message_count INTEGER DEFAULT 0,
+                    subscribed_to_broadcast INTEGER DEFAULT 1,
+                    service_status TEXT DEFAULT 'pending',
+                    push_message_count INTEGER DEFAULT 0,
+                    language_code TEXT DEFAULT 'en'
+                );
+                CREATE TABLE IF NOT EXISTS chat_history
+                (
+                    message_id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    user_id INTEGER REFERENCES users (user_id),
+                    role TEXT,
+                    text TEXT,
+                    timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                );
+            """)
+            # 执行版本化的数据库迁移（索引等）
+            await apply_sqlite_migrations(self._writer)
+        logger.info(f"SQLite 数据库 '{self.path}' 初始化成功。")
+
+    async def close(self):
+        if self._writer is None:
+            return
+        logger.info("正在关闭 SQLite 连接...")
+        for conn in self._readers:
+            await conn.close()
+        # 关闭前把 WAL 合并回主文件，避免 WAL 文件一直变大
+        try:
+            await self._pragma(self._writer, "wal_checkpoint(TRUNCATE)")
+        except Exception as e:
+            logger.warning(f"SQLite WAL 检查点失败: {e}")
+        await self._writer.close()
+        self._writer = None
+        self._readers = []
+        self._reader_cycle = None
+        logger.info("SQLite 连接已关闭。")
+
+    async def fetch_user(self, user_id: int) -> Optional[Dict[str, Any]]:
+        conn = await self._reader()
+        async with conn.execute(f"SELECT {', '.join(_USER_COLUMNS)} FROM users WHERE user_id = ?",
+                                (user_id,)) as cur:
+            row = await cur.fetchone()
+        return dict(row) if row else None
+
+    async def upsert_user(self, user_id: int, data: Dict[str, Any]):
+        """使用 INSERT ... ON CONFLICT DO UPDATE 更新或创建用户数据"""
+        columns = ', '.join(f'"{k}"' for k in data.keys())
+        placeholders = ', '.join(['?'] * len(data))
+        updates = ', '.join(f'"{k}" = excluded."{k}"' for k in data.keys() if k != 'user_id')
+        sql = f"INSERT INTO users ({columns}) VALUES ({placeholders})"
+        sql += f" ON CONFLICT (user_id) DO UPDATE SET {updates}" if updates else " ON CONFLICT (user_id) DO NOTHING"
+        async with self._write_transaction() as conn:
+            await conn.execute(sql, tuple(data.values()))
+        self.rows_written += 1
+
+    async def fetch_chat_history(self, user_id: int, limit: int) -> List[Dict[str, Any]]:
+        conn = await self._reader()
+        # CURRENT_TIMESTAMP 只精确到秒，同一秒内的消息按自增 ID 排序
+        sql = ("SELECT role, text FROM chat_history WHERE user_id = ? "
+               "ORDER BY timestamp DESC, message_id DESC LIMIT ?")
+        async with conn.execute(sql, (user_id, limit)) as cur:
+            rows = await cur.fetchall()
+        return [dict(row) for row in reversed(rows)]
+
+    async def insert_chat_messages(self, rows: List[Tuple[int, str, str]]):
+        async with self._write_transaction() as conn:
+            await conn.executemany("INSERT INTO chat_history (user_id, role, text) VALUES (?, ?, ?)", rows)
+        self.rows_written += len(rows)
+
+    async def fetch_subscribed_page(self, max_push_messages: int, after_user_id: int, limit: int,
+                                    shard_count: int = 1, shard_index: int = 0) -> List[Dict[str, Any]]:
+        shard_filter = "AND user_id % ? = ?" if shard_count > 1 else ""
+        sql = f"""
+              SELECT user_id, chat_id, language_code
+              FROM users
+              WHERE service_status = 'confirmed'
+                AND subscribed_to_broadcast = 1
+                AND chat_id IS NOT NULL
+                AND push_message_count < ?
+                AND user_id > ?
+                {shard_filter}
+              ORDER BY user_id
+              LIMIT ?
+              """
+        params = (max_push_messages, after_user_id)
+        if shard_count > 1:
+            params += (shard_count, shard_index)
+        conn = await self._reader()
+        async with conn.execute(sql, params + (limit,)) as cur:
+            return [dict(row) for row in await cur.fetchall()]
+
+    async def increment_push_count(self, user_id: int):
+        async with self._write_transaction() as conn:
+            await conn.execute("UPDATE users SET push_message_count = push_message_count + 1 WHERE user_id = ?",
+                               (user_id,))
+        self.rows_written += 1
+
+    async def bulk_update_users(self, set_clause: str, user_ids: List[int], chunk_size: int) -> int:
+        """所有分块在同一个写事务里执行，只提交一次"""
+        affected = 0
+        async with self._write_transaction() as conn:
+            for chunk in chunked(user_ids, chunk_size):
+                placeholders = ', '.join(['?'] * len(chunk))
+                cur = await conn.execute(f"UPDATE users SET {set_clause} WHERE user_id IN ({placeholders})",
+                                         tuple(chunk))
+                affected += cur.rowcount
+                await cur.close()
+        self.rows_written += affected
+        return affected
+
+    async def _move_chat_history_rows(self, message_ids: List[int]) -> int:
+        """在一个事务里把指定的对话记录复制到归档表并从原表删除"""
+        if not message_ids:
+            return 0
+        placeholders = ', '.join(['?'] * len(message_ids))
+        async with self._write_transaction() as conn:
+            await conn.execute(
+                f"INSERT OR IGNORE INTO chat_history_archive (message_id, user_id, role, text, timestamp) "
+                f"SELECT message_id, user_id, role, text, timestamp FROM chat_history "
+                f"WHERE message_id IN ({placeholders})", tuple(message_ids))
+            cur = await conn.execute(f"DELETE FROM chat_history WHERE message_id IN ({placeholders})",
+                                     tuple(message_ids))
+            moved = cur.rowcount
+            await cur.close()
+        return moved
+
+    async def archive_old_chat_history(self, max_age_days: int, batch_size: int, max_batches: int) -> int:
+        moved = 0
+        for _ in range(max_batches):
+            conn = await self._reader()
+            async with conn.execute(
+                    "SELECT message_id FROM chat_history "
+                    "WHERE timestamp < datetime('now', ?) ORDER BY message_id LIMIT ?",
+                    (f"-{int(max_age_days)} days", batch_size)) as cur:
+                message_ids = [row[0] for row in await cur.fetchall()]
+            moved += await self._move_chat_history_rows(message_ids)
+            if len(message_ids) < batch_size:
+                break
+            # 每批之间让出事件循环，也给其他写入留出空隙
+            await asyncio.sleep(0)
+        return moved
+
+    async def archive_chat_history_over_cap(self, per_user_cap: int, batch_size: int, max_batches: int,
+                                            after_user_id: Optional[int], max_users: int) -> Tuple[int, Optional[int]]:
+        moved = 0
+        batches = 0
+        scanned = 0
+        cursor = after_user_id
+        while scanned < max_users:
+            # 沿 idx_chat_history_user_ts 按 user_id 分段，每条查询只读一小段用户的索引
+            conn = await self._reader()
+            if cursor is None:
+                query = conn.execute("SELECT DISTINCT user_id FROM chat_history ORDER BY user_id LIMIT ?",
+                                     (batch_size,))
+            else:
+                query = conn.execute(
+                    "SELECT DISTINCT user_id FROM chat_history WHERE user_id > ? ORDER BY user_id LIMIT ?",
+                    (cursor, batch_size))
+            async with query as cur:
+                user_ids = [row[0] for row in await cur.fetchall()]
+            if not user_ids:
+                return moved, None
+            async with conn.execute(
+                    "SELECT user_id FROM chat_history WHERE user_id BETWEEN ? AND ? "
+                    "GROUP BY user_id HAVING COUNT(*) > ?",
+                    (user_ids[0], user_ids[-1], per_user_cap)) as cur:
+                over_cap = [row[0] for row in await cur.fetchall()]
+            for user_id in over_cap:
+                while True:
+                    if batches >= max_batches:
+                        # 批次用完了，下次从这个用户继续
+                        return moved, user_id - 1
+                    conn = await self._reader()
+                    async with conn.execute(
+                            "SELECT message_id FROM chat_history WHERE user_id = ? "
+                            "ORDER BY timestamp DESC, message_id DESC LIMIT ? OFFSET ?",
+                            (user_id, batch_size, per_user_cap)) as cur:
+                        message_ids = [row[0] for row in await cur.fetchall()]
+                    moved += await self._move_chat_history_rows(message_ids)
+                    batches += 1
+                    if len(message_ids) < batch_size:
+                        break
+                    await asyncio.sleep(0)
+            if len(user_ids) < batch_size:
+                return moved, None
+            cursor = user_ids[-1]
+            scanned += len(user_ids)
+            await asyncio.sleep(0)
+        return moved, cursor
+
+    async def try_acquire_lease(self, name: str, holder: str, ttl: float, now: float) -> bool:
+        async with self._write_transaction() as conn:
+            await conn.execute(
+                "INSERT INTO leader_leases (name, holder, expires_at) VALUES (?, ?, ?) "
+                "ON CONFLICT (name) DO UPDATE SET holder = excluded.holder, expires_at = excluded.expires_at "
+                "WHERE leader_leases.holder = excluded.holder OR leader_leases.expires_at < ?",
+                (name, holder, now + ttl, now))
+            async with conn.execute("SELECT holder FROM leader_leases WHERE name = ?", (name,)) as cur:
+                row = await cur.fetchone()
+        return bool(row) and row[0] == holder
+
+    async def release_lease(self, name: str, holder: str):
+        async with self._write_transaction() as conn:
+            await conn.execute("DELETE FROM leader_leases WHERE name = ? AND holder = ?", (name, holder))
+
+    async def create_broadcast_round(self, multiplier: str, shard_count: int, now: float) -> int:
+        async with self._write_transaction() as conn:
+            cur = await conn.execute(
+                "INSERT INTO broadcast_rounds (multiplier, shard_count, created_at) VALUES (?, ?, ?)",
+                (multiplier, shard_count, now))
+            round_id = cur.lastrowid
+            await cur.close()
+            await conn.executemany("INSERT INTO broadcast_shards (round_id, shard_index) VALUES (?, ?)",
+                                   [(round_id, index) for index in range(shard_count)])
+        self.rows_written += 1 + shard_count
+        return round_id
+
+    async def count_open_broadcast_shards(self, created_after: float) -> int:
+        conn = await self._reader()
+        async with conn.execute(
+                "SELECT COUNT(*) FROM broadcast_shards s JOIN broadcast_rounds r ON r.round_id = s.round_id "
+                "WHERE s.status <> 'done' AND r.created_at >= ?", (created_after,)) as cur:
+            (count,) = await cur.fetchone()
+        return count
+
+    async def claim_broadcast_shard(self, owner: str, claim_ttl: float, now: float,
+                                    created_after: float) -> Optional[Dict[str, Any]]:
+        """写事务本身就是互斥的（BEGIN IMMEDIATE），查出来再更新不会被别的进程抢走"""
+        async with self._write_transaction() as conn:
+            async with conn.execute(
+                    "SELECT s.round_id, s.shard_index, r.shard_count, r.multiplier, r.created_at, s.last_user_id "
+                    "FROM broadcast_shards s JOIN broadcast_rounds r ON r.round_id = s.round_id "
+                    "WHERE (s.status = 'pending' OR (s.status = 'claimed' AND s.claimed_until < ?)) "
+                    "AND r.created_at >= ? ORDER BY s.round_id, s.shard_index LIMIT 1",
+                    (now, created_after)) as cur:
+                row = await cur.fetchone()
+            if row is None:
+                return None
+            shard = dict(row)
+            await conn.execute(
+                "UPDATE broadcast_shards SET status = 'claimed', owner = ?, claimed_until = ?, "
+                "attempts = attempts + 1 WHERE round_id = ? AND shard_index = ?",
+                (owner, now + claim_ttl, shard['round_id'], shard['shard_index']))
+        self.rows_written += 1
+        return shard
+
+    async def checkpoint_broadcast_shard(self, round_id: int, shard_index: int, owner: str,
+                                         last_user_id: Optional[int], sent: int, claim_ttl: float, now: float) -> bool:
+        async with self._write_transaction() as conn:
+            cur = await conn.execute(
+                "UPDATE broadcast_shards SET claimed_until = ?, last_user_id = COALESCE(?, last_user_id), sent = ? "
+                "WHERE round_id = ? AND shard_index = ? AND owner = ? AND status = 'claimed'",
+                (now + claim_ttl, last_user_id, sent, round_id, shard_index, owner))
+            affected = cur.rowcount
+            await cur.close()
+        self.rows_written += affected
+        return affected > 0
+
+    async def complete_broadcast_shard(self, round_id: int, shard_index: int, owner: str, sent: int, failed: int):
+        async with self._write_transaction() as conn:
+            await conn.execute(
+                "UPDATE broadcast_shards SET status = 'done', sent = ?, failed = ? "
+                "WHERE round_id = ? AND shard_index = ? AND owner = ?",
+                (sent, failed, round_id, shard_index, owner))
+        self.rows_written += 1
+
+    async def prune_broadcast_rounds(self, created_before: float) -> int:
+        async with self._write_transaction() as conn:
+            await conn.execute(
+                "DELETE FROM broadcast_shards WHERE round_id IN "
+                "(SELECT round_id FROM broadcast_rounds WHERE created_at < ?)", (created_before,))
+            cur = await conn.execute("DELETE FROM broadcast_rounds WHERE created_at < ?", (created_before,))
+            deleted = cur.rowcount
+            await cur.close()
+        return deleted
+
+    async def upsert_reminder(self, user_id: int, kind: str, chat_id: int, due_at: float):
+        async with self._write_transaction() as conn:
+            await conn.execute(
+                "INSERT INTO reminders (user_id, kind, chat_id, due_at) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT (user_id, kind) DO UPDATE SET chat_id = excluded.chat_id, due_at = excluded.due_at",
+                (user_id, kind, chat_id, due_at))
+        self.rows_written += 1
+
+    async def fetch_due_reminders(self, kind: str, now: float, limit: int) -> List[Dict[str, Any]]:
+        conn = await self._reader()
+        sql = ("SELECT r.user_id, r.chat_id, r.due_at, u.state FROM reminders r "
+               "LEFT JOIN users u ON u.user_id = r.user_id "
+               "WHERE r.kind = ? AND r.due_at <= ? ORDER BY r.due_at LIMIT ?")
+        async with conn.execute(sql, (kind, now, limit)) as cur:
+            return [dict(row) for row in await cur.fetchall()]
+
+    async def delete_reminders(self, kind: str, user_ids: List[int], due_before: float, chunk_size: int) -> int:
+        """所有分块在同一个写事务里执行，只提交一次"""
+        affected = 0
+        async with self._write_transaction() as conn:
+            for chunk in chunked(user_ids, chunk_size):
+                placeholders = ', '.join(['?'] * len(chunk))
+                cur = await conn.execute(
+                    f"DELETE FROM reminders WHERE kind = ? AND due_at <= ? AND user_id IN ({placeholders})",
+                    (kind, due_before) + tuple(chunk))
+                affected += cur.rowcount
+                await cur.close()
+        self.rows_written += affected
+        return affected
+
+    async def fetch_media_file_ids(self) -> Dict[str, str]:
+        conn = await self._reader()
+        async with conn.execute("SELECT name, file_id FROM media_assets") as cur:
+            return {row['name']: row['file_id'] for row in await cur.fetchall()}
+
+    async def save_media_file_id(self, name: str, file_id: str, now: float):
+        async with self._write_transaction() as conn:
+            await conn.execute(
+                "INSERT INTO media_assets (name, file_id, updated_at) VALUES (?, ?, ?) "
+                "ON CONFLICT (name) DO UPDATE SET file_id = excluded.file_id, updated_at = excluded.updated_at",
+                (name, file_id, now))
+        self.rows_written += 1
+
+    async def delete_media_file_id(self, name: str):
+        async with self._write_transaction() as conn:
+            await conn.execute("DELETE FROM media_assets WHERE name = ?", (name,))
+        self.rows_written += 1
+
+    def stats(self) -> Dict[str, float]:
+        return {
+            'read_connections': len(self._readers),
+            'write_transactions': self.write_transactions,
+            'rows_written': self.rows_written,
+        }
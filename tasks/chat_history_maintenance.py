@@ -0,0 +1,79 @@
+# tasks/chat_history_maintenance.py
+
+# 导入 logging 模块，用于记录程序运行信息
+import logging
+# 导入 time 模块，用于统计每次维护的耗时
+import time
+# 从 typing 模块导入 Dict 和 Optional 类型，用于类型提示
+from typing import Dict, Optional
+# 从 telegram.ext 库导入 ContextTypes 和 JobQueue 类
+from telegram.ext import ContextTypes, JobQueue
+
+# 导入我们自己写的配置文件
+from telegram_bot import config
+# 导入我们自己写的数据库服务中的归档函数
+from services.db_service import archive_old_chat_history, archive_chat_history_over_cap
+# 导入主节点选举，多进程部署时只由主节点执行维护
+from services.leader_election import is_leader
+
+# 获取一个日志记录器实例，用于在这个文件中打印日志
+logger = logging.getLogger(__name__)
+
+# 对话记录保留多少天，更早的会被归档
+CHAT_HISTORY_RETENTION_DAYS = getattr(config, 'CHAT_HISTORY_RETENTION_DAYS', 30)
+# 每个用户在 chat_history 表里最多保留多少条对话
+CHAT_HISTORY_PER_USER_CAP = getattr(config, 'CHAT_HISTORY_PER_USER_CAP', 200)
+# 每批搬动多少行，批次越小，对线上表的锁定时间越短
+CHAT_HISTORY_ARCHIVE_BATCH_SIZE = getattr(config, 'CHAT_HISTORY_ARCHIVE_BATCH_SIZE', 500)
+# 每次维护最多执行多少批，避免一次运行时间过长
+CHAT_HISTORY_ARCHIVE_MAX_BATCHES = getattr(config, 'CHAT_HISTORY_ARCHIVE_MAX_BATCHES', 200)
+# 每次维护最多检查多少个用户是否超出上限，其余的留给下一次，几次维护轮完一遍所有用户
+CHAT_HISTORY_CAP_SCAN_USERS = getattr(config, 'CHAT_HISTORY_CAP_SCAN_USERS', 20000)
+# 维护任务的执行间隔（秒）
+CHAT_HISTORY_MAINTENANCE_INTERVAL = getattr(config, 'CHAT_HISTORY_MAINTENANCE_INTERVAL', 3600)
+
+# 最近一次维护的结果
+last_run_stats: Dict[str, float] = {}
+# 按每用户上限检查到的位置：下次从这个 user_id 之后继续，None 表示从头开始
+_cap_cursor: Optional[int] = None
+
+
+# 定义一个异步函数，作为对话记录的维护任务
+async def chat_history_maintenance_task(context: ContextTypes.DEFAULT_TYPE):
+    """把过旧或超出每用户上限的对话记录分批搬到归档表"""
+    global _cap_cursor
+    # 多进程部署时每个进程都注册了这个任务，只有主节点真正执行
+    if not is_leader():
+        return
+    # 打印一条日志，表示任务已开始
+    logger.info("开始执行对话记录维护任务...")
+    started = time.monotonic()
+    try:
+        # 先归档超过保留天数的记录
+        moved_by_age = await archive_old_chat_history(
+            CHAT_HISTORY_RETENTION_DAYS, CHAT_HISTORY_ARCHIVE_BATCH_SIZE, CHAT_HISTORY_ARCHIVE_MAX_BATCHES)
+        # 再归档每个用户超出上限的记录，接着上一次检查到的位置往后检查一段用户
+        moved_by_cap, _cap_cursor = await archive_chat_history_over_cap(
+            CHAT_HISTORY_PER_USER_CAP, CHAT_HISTORY_ARCHIVE_BATCH_SIZE, CHAT_HISTORY_ARCHIVE_MAX_BATCHES,
+            _cap_cursor, CHAT_HISTORY_CAP_SCAN_USERS)
+    except Exception as e:
+        # 打印一条错误日志，下次再试
+        logger.error(f"对话记录维护任务失败: {e}")
+        return
+
+    # 记录并打印本次维护的结果
+    last_run_stats.update({
+        'moved_by_age': moved_by_age,
+        'moved_by_cap': moved_by_cap,
+        'elapsed_seconds': time.monotonic() - started,
+    })
+    logger.info(f"对话记录维护完成：按天数归档 {moved_by_age} 行，按每用户上限归档 {moved_by_cap} 行，"
+                f"耗时 {last_run_stats['elapsed_seconds']:.1f} 秒。")
+
+
+# 定义一个函数，把维护任务注册到 JobQueue
+def setup_chat_history_maintenance(job_queue: JobQueue, first: float = 300):
+    """按配置的间隔重复执行对话记录维护任务"""
+    job_queue.run_repeating(chat_history_maintenance_task, interval=CHAT_HISTORY_MAINTENANCE_INTERVAL,
+                            first=first, name="chat_history_maintenance")
+    logger.info(f"对话记录维护任务已添加，每 {CHAT_HISTORY_MAINTENANCE_INTERVAL} 秒执行一次。")
@@ -0,0 +1,137 @@
+# tasks/reminders.py
+
+# 导入 logging 模块，用于记录程序运行信息
+import logging
+# 导入 time 模块，用于判断提醒是否到期
+import time
+# 导入 dataclass，用于描述一种提醒
+from dataclasses import dataclass
+from typing import Dict, Iterable
+# 从 telegram.ext 库导入 ContextTypes、Application 和 JobQueue 类
+from telegram.ext import ContextTypes, Application, JobQueue
+
+# 导入我们自己写的配置文件
+from telegram_bot import config
+# 导入我们自己写的数据库服务中的函数
+from services.db_service import schedule_reminder, fetch_due_reminders, delete_reminders, save_chat_message
+# 导入主节点选举，多进程部署时只由主节点发送提醒
+from services.leader_election import is_leader
+# 导入并发限流的群发引擎
+from services.fanout import FanoutEngine, SendJob
+
+# 获取一个日志记录器实例，用于在这个文件中打印日志
+logger = logging.getLogger(__name__)
+
+# 新玩家收到注册教程后，多少秒没有确认注册就提醒一次
+REGISTRATION_REMINDER_DELAY = getattr(config, 'REGISTRATION_REMINDER_DELAY', 120)
+# 清扫任务的执行间隔（秒），提醒最多比预定时间晚这么久
+REMINDER_SWEEP_INTERVAL = getattr(config, 'REMINDER_SWEEP_INTERVAL', 5)
+# 每批从数据库取出多少条到期的提醒
+REMINDER_BATCH_SIZE = getattr(config, 'REMINDER_BATCH_SIZE', 500)
+# 每次清扫每种提醒最多处理多少批，剩下的留给下一次
+REMINDER_MAX_BATCHES = getattr(config, 'REMINDER_MAX_BATCHES', 20)
+
+
+@dataclass(frozen=True)
+class ReminderKind:
+    """一种提醒：到期时用户仍处于 required_state 才发送 text"""
+    name: str
+    required_state: str
+    text: str
+
+
+# 新玩家收到注册教程后，提醒他确认是否注册完成
+REGISTRATION_REMINDER = ReminderKind(
+    name='registration',
+    required_state='awaiting_registration_confirmation',
+    text="Hi! Have you completed the registration? Let me know if you are ready.",
+)
+
+
+async def schedule(kind: ReminderKind, user_id: int, chat_id: int, delay: float):
+    """把提醒写进数据库；同一用户重复进入同一状态时只保留最新的一条，重启或发布后也不会丢"""
+    await schedule_reminder(user_id, kind.name, chat_id, delay)
+
+
+class ReminderSweeper:
+    """
+    提醒的清扫任务，代替每个用户一个的 run_once 任务。
+    - 按到期时间分批从数据库取出提醒，用户状态在同一条查询里一起查出，内存只和批大小有关
+    - 状态已经变化的提醒直接丢弃，其余的交给群发引擎并发、限流地发送
+    - 一批处理完才删除，进程中途退出时这一批会在下一次清扫时重新发送
+    """
+
+    def __init__(self, kinds: Iterable[ReminderKind] = (REGISTRATION_REMINDER,),
+                 batch_size: int = REMINDER_BATCH_SIZE, max_batches: int = REMINDER_MAX_BATCHES):
+        self.kinds = tuple(kinds)
+        self.batch_size = batch_size
+        self.max_batches = max_batches
+        self._engine = None
+        self._running = False
+        self.sweeps = 0
+        self.sent = 0
+        self.failed = 0
+        self.skipped = 0
+        self.last_lag = 0.0
+
+    def setup(self, job_queue: JobQueue, interval: float = REMINDER_SWEEP_INTERVAL, first: float = 5):
+        """把清扫任务注册到 JobQueue"""
+        job_queue.run_repeating(self.on_tick, interval=interval, first=first, name="reminder_sweep")
+        logger.info(f"提醒清扫任务已添加，每 {interval} 秒执行一次。")
+
+    def get_stats(self) -> Dict[str, float]:
+        """返回清扫任务的统计数据"""
+        return {
+            'running': int(self._running),
+            'sweeps': self.sweeps,
+            'sent': self.sent,
+            'failed': self.failed,
+            'skipped': self.skipped,
+            'last_lag_seconds': self.last_lag,
+        }
+
+    async def on_tick(self, context: ContextTypes.DEFAULT_TYPE):
+        """定时任务回调：清扫放到后台任务里，上一次还没结束时跳过"""
+        if self._running or not is_leader():
+            return
+        self._running = True
+        context.application.create_task(self._sweep_all(context.application))
+
+    async def _sweep_all(self, app: Application):
+        try:
+            if self._engine is None:
+                self._engine = FanoutEngine(app.bot)
+            for kind in self.kinds:
+                await self._sweep(kind)
+            self.sweeps += 1
+        except Exception as e:
+            logger.error(f"提醒清扫任务失败: {e}")
+        finally:
+            self._running = False
+
+    async def _sweep(self, kind: ReminderKind):
+        now = time.time()
+        for _ in range(self.max_batches):
+            due = await fetch_due_reminders(kind.name, now, self.batch_size)
+            if not due:
+                return
+            self.last_lag = now - due[0]['due_at']
+            jobs = [SendJob(chat_id=row['chat_id'], text=kind.text, user_id=row['user_id'])
+                    for row in due if row['state'] == kind.required_state]
+            self.skipped += len(due) - len(jobs)
+            if jobs:
+                stats = await self._engine.run(jobs, on_sent=self._on_sent)
+                self.sent += stats.sent
+                self.failed += stats.failed
+            await delete_reminders(kind.name, (row['user_id'] for row in due), now)
+            if len(due) < self.batch_size:
+                return
+
+    @staticmethod
+    async def _on_sent(job: SendJob):
+        # 将这条提醒消息也保存到数据库的聊天记录中
+        await save_chat_message(job.user_id, "bot", job.text)
+
+
+# 全局唯一的提醒清扫任务
+reminder_sweeper = ReminderSweeper()
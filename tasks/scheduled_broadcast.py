@@ -2,54 +2,158 @@
 
 # 导入 logging 模块，用于记录程序运行信息
 import logging
-# 导入 asyncio 模块，用于处理异步操作，比如 sleep
-import asyncio
+# 导入 time 模块，用于计算轮次的延迟
+import time
 # 导入 random 模块，用于生成随机数
 import random
 # 从 datetime 模块导入 datetime 类，用于获取当前时间
 from datetime import datetime
-# 从 telegram.ext 库导入 ContextTypes 和 Application 类
-from telegram.ext import ContextTypes, Application
-# 从 telegram.error 库导入 Forbidden 错误类型，专门用来处理用户拉黑机器人的情况
-from telegram.error import Forbidden
+# 导入 array，用紧凑的整数数组保存排行榜的接收人
+from array import array
+# 导入 dataclass，用于描述一轮广播
+from dataclasses import dataclass, field
+from typing import Dict, Optional
+# 从 telegram.ext 库导入 ContextTypes、Application 和 JobQueue 类
+from telegram.ext import ContextTypes, Application, JobQueue
+
+# 导入我们自己写的配置文件
+from telegram_bot import config
 
 # 导入我们自己写的数据库服务中的函数
-from services.db_service import get_subscribed_users, update_user_data, increment_push_count
+from services.db_service import iter_subscribed_users, increment_push_counts, unsubscribe_users, BULK_CHUNK_SIZE
+# 导入并发限流的群发引擎
+from services.fanout import FanoutEngine, FanoutStats, SendJob
+# 导入指标和耗时追踪
+from utils import metrics
+from utils.tracing import traced, annotate
 
 # 获取一个日志记录器实例，用于在这个文件中打印日志
 logger = logging.getLogger(__name__)
 
+# 上一轮还在发送时新一轮到点的处理方式：'skip' 直接跳过，'coalesce' 合并成上一轮结束后立即补发的一轮
+BROADCAST_OVERLAP_POLICY = getattr(config, 'BROADCAST_OVERLAP_POLICY', 'coalesce')
+# 最多允许多少个排行榜任务同时在排队等待，超过时跳过新的轮次，保证内存有界
+MAX_PENDING_LEADERBOARDS = getattr(config, 'BROADCAST_MAX_PENDING_LEADERBOARDS', 3)
 
-# 定义一个异步函数，作为我们的定时广播任务
-async def broadcast_task(context: ContextTypes.DEFAULT_TYPE):
-    """定时广播任务，根据用户语言发送不同内容。"""
-    # 打印一条日志，表示任务已开始
-    logger.info("开始执行每日广播任务...")
-    # 从上下文中获取 application 对象，它包含了机器人实例
-    app: Application = context.application
-
-    # 从数据库获取所有符合条件的订阅用户信息
-    subscribed_users = await get_subscribed_users()
-    # 如果没有找到任何用户
-    if not subscribed_users:
-        # 打印一条日志，然后直接返回，结束本次任务
-        logger.info("没有符合条件的订阅用户，广播任务结束。")
-        return
-
-    # --- 您的随机倍率逻辑 ---
-    # 定义一个内部函数，用于生成随机倍率
-    def get_random_multiplier():
-        # 定义几个倍率范围
-        ranges = [(2.34, 5.67), (5.67, 6.78), (6.78, 12.34), (12.34, 99.99)]
-        # 定义每个范围对应的权重（概率）
-        weights = [80, 15, 4, 1]
-        # 根据权重随机选择一个范围
-        chosen_range = random.choices(ranges, weights=weights, k=1)[0]
-        # 在选定的范围内生成一个随机浮点数，并保留两位小数
-        return str(round(random.uniform(*chosen_range), 2))
-
-    # 调用函数，生成本次广播的倍率
-    multiplier = get_random_multiplier()
+# 广播的吞吐指标，phase 是 'multiplier'（倍率消息）或 'leaderboard'（排行榜）
+BROADCAST_MESSAGES = metrics.counter('broadcast_messages_total', '广播消息的发送结果', ['phase', 'result'])
+BROADCAST_PHASE_DURATION = metrics.histogram('broadcast_phase_duration_seconds', '一轮广播某个阶段的总耗时（秒）',
+                                             ['phase'], buckets=(1, 5, 15, 30, 60, 120, 300, 600, 1200, 3600))
+BROADCAST_LAST_RATE = metrics.gauge('broadcast_last_phase_rate', '最近一轮广播某个阶段的发送速率（条/秒）', ['phase'])
+
+
+def _record_phase_metrics(phase: str, stats: FanoutStats):
+    """把一个阶段的发送统计记到指标里"""
+    for result in ('sent', 'failed', 'throttled', 'forbidden'):
+        BROADCAST_MESSAGES.labels(phase=phase, result=result).inc(getattr(stats, result))
+    BROADCAST_PHASE_DURATION.labels(phase=phase).observe(stats.elapsed)
+    BROADCAST_LAST_RATE.labels(phase=phase).set(stats.rate)
+
+
+class RoundBookkeeper:
+    """
+    记录一轮广播的发送结果。
+    - 成功和拉黑的用户ID先放进缓冲区，攒够一批就批量写库，内存不随受众增长
+    - 排行榜接收人只保存 chat_id，按语言分开放进紧凑的整数数组
+    - 记住已经交给引擎、还没有结果的用户，算出中断后可以续发的断点
+    """
+
+    def __init__(self):
+        self.sent_count = 0
+        self.forbidden_count = 0
+        self.failed_count = 0
+        self.leaderboard_chat_ids = {'en': array('q'), 'hi': array('q')}
+        self._pending_sent = []
+        self._pending_forbidden = []
+        # 发送中的用户最多是引擎的队列长度加上 worker 数，集合大小有界
+        self._in_flight = set()
+        self._last_queued_user_id: Optional[int] = None
+
+    @property
+    def resume_after_user_id(self) -> Optional[int]:
+        """这个 user_id 以及之前的用户都已经有了发送结果，中断后从它之后续发即可"""
+        if self._in_flight:
+            return min(self._in_flight) - 1
+        return self._last_queued_user_id
+
+    def on_queued(self, user_id: int):
+        self._in_flight.add(user_id)
+        self._last_queued_user_id = user_id
+
+    def on_failed(self, job: SendJob):
+        self.failed_count += 1
+        self._in_flight.discard(job.user_id)
+
+    async def on_sent(self, job: SendJob):
+        self.sent_count += 1
+        self._in_flight.discard(job.user_id)
+        language_code = 'hi' if job.language_code == 'hi' else 'en'
+        self.leaderboard_chat_ids[language_code].append(job.chat_id)
+        self._pending_sent.append(job.user_id)
+        if len(self._pending_sent) >= BULK_CHUNK_SIZE:
+            await self._flush_sent()
+
+    async def on_forbidden(self, job: SendJob):
+        self.forbidden_count += 1
+        self._in_flight.discard(job.user_id)
+        self._pending_forbidden.append(job.user_id)
+        if len(self._pending_forbidden) >= BULK_CHUNK_SIZE:
+            await self._flush_forbidden()
+
+    async def _flush_sent(self):
+        # 先把缓冲区换掉再写库，这样写库期间其他 worker 可以继续往新缓冲区里放
+        user_ids, self._pending_sent = self._pending_sent, []
+        if user_ids:
+            await increment_push_counts(user_ids)
+
+    async def _flush_forbidden(self):
+        user_ids, self._pending_forbidden = self._pending_forbidden, []
+        if user_ids:
+            await unsubscribe_users(user_ids)
+
+    async def flush(self):
+        """把缓冲区里剩下的结果全部写库"""
+        await self._flush_sent()
+        await self._flush_forbidden()
+
+
+@dataclass
+class BroadcastRound:
+    """一轮广播的信息，排行榜任务会用到它"""
+    round_id: int
+    multiplier: str
+    # 成功收到倍率消息的 chat_id，按语言分组
+    leaderboard_chat_ids: Dict[str, array] = field(default_factory=dict)
+    # 排行榜的随机种子；同一轮分给多个进程发送时用它保证排行榜内容一致
+    leaderboard_seed: Optional[int] = None
+
+
+# --- 您的随机倍率逻辑 ---
+# 定义一个函数，用于生成随机倍率
+def get_random_multiplier() -> str:
+    # 定义几个倍率范围
+    ranges = [(2.34, 5.67), (5.67, 6.78), (6.78, 12.34), (12.34, 99.99)]
+    # 定义每个范围对应的权重（概率）
+    weights = [80, 15, 4, 1]
+    # 根据权重随机选择一个范围
+    chosen_range = random.choices(ranges, weights=weights, k=1)[0]
+    # 在选定的范围内生成一个随机浮点数，并保留两位小数
+    return str(round(random.uniform(*chosen_range), 2))
+
+
+# 定义一个异步函数，发送一轮广播的倍率消息
+@traced('broadcast_multiplier')
+async def send_multiplier_phase(engine: FanoutEngine, round_id: int, multiplier: Optional[str] = None,
+                                shard_count: int = 1, shard_index: int = 0, after_user_id: Optional[int] = None,
+                                bookkeeper: Optional[RoundBookkeeper] = None) -> Optional[BroadcastRound]:
+    """
+    发送倍率消息并完成记账，返回本轮信息；没有任何用户收到时返回 None。
+    多进程部署时由调用方传入本轮的倍率和分片，after_user_id 是上一个认领者留下的断点；
+    传入 bookkeeper 的调用方可以在发送过程中读取进度。
+    """
+    annotate(round_id=round_id, shard_index=shard_index)
+    # 生成本次广播的倍率（分片发送时由主节点统一生成）
+    multiplier = multiplier or get_random_multiplier()
 
     # --- 创建不同语言版本的消息 ---
     # 创建英文版的广播消息
@@ -57,69 +161,71 @@ async def broadcast_task(context: ContextTypes.DEFAULT_TYPE):
     # 创建印地语版的广播消息
     broadcast_message_hi = f"30 सेकंड में {multiplier}x लॉन्च होने वाला है, जल्दी करें और अपना दांव लगाएं"
 
-    # 创建一个空列表，用来记录成功发送了消息的用户ID
-    successfully_sent_user_ids = []
-    # 遍历所有订阅用户
-    for user in subscribed_users:
-        # 获取用户ID
-        user_id = user.get("user_id")
-        # 获取聊天ID
-        chat_id = user.get("chat_id")
-        # 获取用户的偏好语言，如果没记录，则默认为 'en' (英语)
-        language_code = user.get("language_code", "en")
-        # 如果聊天ID不存在，就跳过这个用户
-        if not chat_id: continue
-
-        # 根据用户的偏好语言，选择要发送的消息版本
-        message_to_send = broadcast_message_hi if language_code == 'hi' else broadcast_message_en
-
-        # 使用 try...except 结构来捕获发送过程中可能发生的错误
-        try:
-            # 尝试发送消息
-            await app.bot.send_message(chat_id=chat_id, text=message_to_send)
-            # 如果发送成功，就将该用户的ID添加到成功列表中
-            successfully_sent_user_ids.append(user_id)
-        # 如果捕获到的是 Forbidden 错误（用户拉黑了机器人）
-        except Forbidden:
-            # 打印一条警告日志
-            logger.warning(f"用户 {user_id} ({chat_id}) 已拉黑机器人。正在将其取消订阅...")
-            # 在数据库中将该用户的订阅状态更新为 0 (False)
-            await update_user_data(user_id, {'subscribed_to_broadcast': 0})
-        # 如果捕获到的是其他类型的错误（比如网络问题）
-        except Exception as e:
-            # 打印一条错误日志
-            logger.error(f"向 {chat_id} 发送广播失败: {e}")
+    # 创建本轮的结果记录器，负责批量写库和记录排行榜接收人
+    bookkeeper = bookkeeper or RoundBookkeeper()
 
-    # 遍历所有成功接收到消息的用户
-    for user_id in successfully_sent_user_ids:
-        # 为他们每个人在数据库里的推送次数加一
-        await increment_push_count(user_id)
-    # 打印一条日志，记录本次操作
-    logger.info(f"已为 {len(successfully_sent_user_ids)} 名用户增加推送计数。")
+    # 一边从数据库分页读取订阅用户，一边生成发送任务
+    async def build_multiplier_jobs():
+        # 遍历所有订阅用户
+        async for user in iter_subscribed_users(shard_count=shard_count, shard_index=shard_index,
+                                                after_user_id=after_user_id):
+            chat_id = user.get("chat_id")
+            # 没有 chat_id 的用户发不了消息，引擎也会跳过，这里直接略过，不计入发送中的用户
+            if not chat_id:
+                continue
+            # 获取用户的偏好语言，如果没记录，则默认为 'en' (英语)
+            language_code = user.get("language_code", "en")
+            # 根据用户的偏好语言，选择要发送的消息版本
+            message_to_send = broadcast_message_hi if language_code == 'hi' else broadcast_message_en
+            # 把语言记在任务上，发送成功后用来决定排行榜的语言版本
+            bookkeeper.on_queued(user.get("user_id"))
+            yield SendJob(chat_id=chat_id, text=message_to_send,
+                          user_id=user.get("user_id"), language_code=language_code)
 
-    # 生成一个60到120秒之间的随机延迟时间
-    delay = random.randint(60, 120)
-    # 打印日志，告知将要等待
-    logger.info(f"将等待 {delay} 秒后发送排行榜...")
-    # 异步等待指定的秒数
-    await asyncio.sleep(delay)
+    # 并发发送倍率消息，发送结果交给记录器处理
+    try:
+        stats = await engine.run(
+            build_multiplier_jobs(),
+            on_sent=bookkeeper.on_sent,
+            on_forbidden=bookkeeper.on_forbidden,
+            on_failed=bookkeeper.on_failed,
+        )
+    finally:
+        # 无论是否出错，都把已经攒下的结果写库，避免重复推送
+        await bookkeeper.flush()
+    _record_phase_metrics('multiplier', stats)
+    # 打印本轮倍率消息的发送统计
+    logger.info(f"第 {round_id} 轮倍率消息发送完毕: {stats}")
+    # 打印一条日志，记录本次操作
+    logger.info(f"已为 {bookkeeper.sent_count} 名用户增加推送计数，"
+                f"{bookkeeper.forbidden_count} 名拉黑机器人的用户已取消订阅。")
 
     # 如果没有任何用户成功收到第一条消息
-    if not successfully_sent_user_ids:
+    if not bookkeeper.sent_count:
         # 打印日志，然后直接返回，不再发送排行榜
         logger.info("没有成功接收消息的用户，不再发送排行榜。")
-        return
+        return None
+    return BroadcastRound(round_id=round_id, multiplier=multiplier,
+                          leaderboard_chat_ids=bookkeeper.leaderboard_chat_ids)
+
 
+# 定义一个函数，生成两个语言版本的排行榜文案
+def build_leaderboards(multiplier: str, seed: Optional[int] = None):
+    """
+    生成随机排行榜，返回 (英文版, 印地语版)。
+    给定 seed 时结果是确定的，同一轮的各个分片各自生成，用户看到的仍是同一份排行榜。
+    """
+    rng = random.Random(seed) if seed is not None else random
     # 生成一个16位的随机游戏ID
-    GIDnumber = ''.join([str(random.randint(0, 9)) for _ in range(16)])
+    GIDnumber = ''.join([str(rng.randint(0, 9)) for _ in range(16)])
     # 创建一个空列表，用来存放排行榜结果
     results = []
     # 循环10次，生成10条排行榜记录
     for _ in range(10):
         # 生成一个9位的随机用户ID
-        random_number = ''.join([str(random.randint(0, 9)) for _ in range(9)])
+        random_number = ''.join([str(rng.randint(0, 9)) for _ in range(9)])
         # 生成一个500到1000之间的、步长为5的随机数字
-        number = random.choice(range(500, 1001, 5))
+        number = rng.choice(range(500, 1001, 5))
         # 将生成的记录添加到结果列表中
         results.append((random_number, number))
     # 按照 payout 数字从高到低对结果进行排序
@@ -142,26 +248,166 @@ async def broadcast_task(context: ContextTypes.DEFAULT_TYPE):
         leaderboard_en += f"👤user:{random_number}  payout  💰{number}\n"
         leaderboard_hi += f"👤user:{random_number}  payout  💰{number}\n"
 
-    # 再次遍历所有订阅用户
-    for user in subscribed_users:
-        # 检查这个用户是否在成功收到第一条消息的列表中
-        if user.get("user_id") in successfully_sent_user_ids:
-            # 获取聊天ID
-            chat_id = user.get("chat_id")
-            # 获取用户的偏好语言
-            language_code = user.get("language_code", "en")
-            # 如果聊天ID不存在，就跳过
-            if not chat_id: continue
+    return leaderboard_en, leaderboard_hi
 
+
+# 定义一个异步函数，发送一轮广播的排行榜
+@traced('broadcast_leaderboard')
+async def send_leaderboard_phase(engine: FanoutEngine, broadcast_round: BroadcastRound):
+    """只给成功收到倍率消息的用户发送排行榜"""
+    annotate(round_id=broadcast_round.round_id)
+    leaderboard_en, leaderboard_hi = build_leaderboards(broadcast_round.multiplier,
+                                                        broadcast_round.leaderboard_seed)
+
+    def build_leaderboard_jobs():
+        for language_code, chat_ids in broadcast_round.leaderboard_chat_ids.items():
             # 根据用户的偏好语言，选择要发送的排行榜版本
             leaderboard_to_send = leaderboard_hi if language_code == 'hi' else leaderboard_en
+            for chat_id in chat_ids:
+                yield SendJob(chat_id=chat_id, text=leaderboard_to_send)
+
+    # 并发发送排行榜
+    stats = await engine.run(build_leaderboard_jobs())
+    _record_phase_metrics('leaderboard', stats)
+    # 打印本轮排行榜的发送统计
+    logger.info(f"第 {broadcast_round.round_id} 轮排行榜发送完毕: {stats}")
 
-            # 尝试发送排行榜
-            try:
-                await app.bot.send_message(chat_id=chat_id, text=leaderboard_to_send)
-            # 如果发送失败，就打印一条错误日志
-            except Exception as e:
-                logger.error(f"向 {chat_id} 发送排行榜失败: {e}")
 
-    # 打印一条日志，表示所有任务已完成
-    logger.info("广播及排行榜发送完毕。")
+class BroadcastRoundScheduler:
+    """
+    广播轮次调度器。
+    - 定时任务到点时只做登记，真正的发送放到后台任务里，不阻塞 JobQueue
+    - 同一时间只有一轮倍率消息在发送；上一轮没发完时，新一轮按策略跳过或合并
+    - 排行榜作为独立的延时任务调度，不在任务里 sleep
+    - 所有轮次共用一个群发引擎，全局限速在轮次之间也成立
+    """
+
+    def __init__(self, overlap_policy: str = BROADCAST_OVERLAP_POLICY,
+                 max_pending_leaderboards: int = MAX_PENDING_LEADERBOARDS):
+        self.overlap_policy = overlap_policy
+        self.max_pending_leaderboards = max_pending_leaderboards
+        self.interval = None
+        self._anchor = None
+        self._engine: Optional[FanoutEngine] = None
+        self._in_flight = False
+        # 合并模式下，等待补发的那一轮原本应该开始的时间
+        self._coalesced_due: Optional[float] = None
+        self._next_round_id = 1
+        self.pending_leaderboards = 0
+        self.rounds_started = 0
+        self.rounds_completed = 0
+        self.rounds_failed = 0
+        self.rounds_skipped = 0
+        self.rounds_coalesced = 0
+        self.last_lag = 0.0
+        self.max_lag = 0.0
+
+    def setup(self, job_queue: JobQueue, interval: float, first: float = 10):
+        """把广播任务注册到 JobQueue"""
+        self.interval = interval
+        self._anchor = time.monotonic() + first
+        job_queue.run_repeating(self.on_tick, interval=interval, first=first, name="broadcast_round")
+
+    def _scheduled_time(self, now: float) -> float:
+        """推算当前这次触发原本应该发生的时间"""
+        if not self.interval or self._anchor is None:
+            return now
+        ticks = max(0, round((now - self._anchor) / self.interval))
+        return self._anchor + ticks * self.interval
+
+    def get_stats(self) -> Dict[str, float]:
+        """返回调度器的统计数据"""
+        return {
+            'in_flight': int(self._in_flight),
+            'pending_leaderboards': self.pending_leaderboards,
+            'rounds_started': self.rounds_started,
+            'rounds_completed': self.rounds_completed,
+            'rounds_failed': self.rounds_failed,
+            'rounds_skipped': self.rounds_skipped,
+            'rounds_coalesced': self.rounds_coalesced,
+            'last_lag_seconds': self.last_lag,
+            'max_lag_seconds': self.max_lag,
+        }
+
+    async def on_tick(self, context: ContextTypes.DEFAULT_TYPE):
+        """定时任务回调：决定这一轮是开始、跳过还是合并"""
+        now = time.monotonic()
+        due = self._scheduled_time(now)
+        if self.pending_leaderboards >= self.max_pending_leaderboards:
+            self.rounds_skipped += 1
+            logger.warning(f"已有 {self.pending_leaderboards} 个排行榜在排队，跳过本轮广播。")
+            return
+        if self._in_flight:
+            if self.overlap_policy == 'coalesce':
+                if self._coalesced_due is None:
+                    self._coalesced_due = due
+                self.rounds_coalesced += 1
+                logger.warning("上一轮广播仍在发送，本轮将在其结束后合并补发。")
+            else:
+                self.rounds_skipped += 1
+                logger.warning("上一轮广播仍在发送，跳过本轮。")
+            return
+        self._in_flight = True
+        context.application.create_task(self._run_rounds(context.application, due))
+
+    async def _run_rounds(self, app: Application, due: float):
+        """在后台发送倍率消息；如果期间有合并的轮次，结束后立即补发一轮"""
+        try:
+            while due is not None:
+                await self._run_one_round(app, due)
+                due, self._coalesced_due = self._coalesced_due, None
+        finally:
+            self._in_flight = False
+
+    async def _run_one_round(self, app: Application, due: float):
+        if self._engine is None:
+            self._engine = FanoutEngine(app.bot)
+        round_id = self._next_round_id
+        self._next_round_id += 1
+        self.rounds_started += 1
+        self.last_lag = time.monotonic() - due
+        self.max_lag = max(self.max_lag, self.last_lag)
+        # 打印一条日志，表示任务已开始
+        logger.info(f"开始执行第 {round_id} 轮广播 (延迟 {self.last_lag:.1f} 秒)...")
+        try:
+            broadcast_round = await send_multiplier_phase(self._engine, round_id)
+        except Exception as e:
+            self.rounds_failed += 1
+            logger.error(f"第 {round_id} 轮广播失败: {e}")
+            return
+        self.rounds_completed += 1
+        if broadcast_round is None:
+            return
+
+        # 生成一个60到120秒之间的随机延迟时间
+        delay = random.randint(60, 120)
+        # 打印日志，告知将在多久之后发送排行榜
+        logger.info(f"将在 {delay} 秒后发送第 {round_id} 轮排行榜...")
+        # 把排行榜调度成一个独立的一次性任务
+        self.pending_leaderboards += 1
+        app.job_queue.run_once(self.leaderboard_job, delay, data=broadcast_round,
+                               name=f"broadcast_leaderboard_{round_id}")
+
+    async def leaderboard_job(self, context: ContextTypes.DEFAULT_TYPE):
+        """排行榜的延时任务回调"""
+        broadcast_round: BroadcastRound = context.job.data
+        try:
+            if self._engine is None:
+                self._engine = FanoutEngine(context.bot)
+            await send_leaderboard_phase(self._engine, broadcast_round)
+        except Exception as e:
+            logger.error(f"第 {broadcast_round.round_id} 轮排行榜发送失败: {e}")
+        finally:
+            self.pending_leaderboards -= 1
+        # 打印一条日志，表示所有任务已完成
+        logger.info(f"第 {broadcast_round.round_id} 轮广播及排行榜发送完毕。")
+
+
+# 全局唯一的广播调度器
+round_scheduler = BroadcastRoundScheduler()
+
+
+# 定义一个异步函数，作为我们的定时广播任务
+async def broadcast_task(context: ContextTypes.DEFAULT_TYPE):
+    """定时广播任务的入口，交给调度器决定是否开始新的一轮。"""
+    await round_scheduler.on_tick(context)
@@ -0,0 +1,205 @@
+# tasks/sharded_broadcast.py
+
+# 导入 asyncio，用于在后台发送分片并定期汇报进度
+import asyncio
+# 导入 logging 模块，用于记录程序运行信息
+import logging
+# 导入 random 模块，用于生成排行榜的延迟
+import random
+# 导入 time 模块，用于从轮次的创建时间推算排行榜的发送时间
+import time
+from typing import Dict, Optional
+# 从 telegram.ext 库导入 ContextTypes、Application 和 JobQueue 类
+from telegram.ext import ContextTypes, Application, JobQueue
+
+# 导入我们自己写的配置文件
+from telegram_bot import config
+# 导入我们自己写的数据库服务中的函数
+from services.db_service import (create_broadcast_round, count_open_broadcast_shards, claim_broadcast_shard,
+                                 checkpoint_broadcast_shard, complete_broadcast_shard, prune_broadcast_rounds)
+# 导入主节点选举
+from services import leader_election
+# 导入并发限流的群发引擎
+from services.fanout import FanoutEngine
+# 复用单进程广播的发送逻辑
+from tasks.scheduled_broadcast import (send_multiplier_phase, send_leaderboard_phase, get_random_multiplier,
+                                       RoundBookkeeper, BroadcastRound, MAX_PENDING_LEADERBOARDS)
+
+# 获取一个日志记录器实例，用于在这个文件中打印日志
+logger = logging.getLogger(__name__)
+
+# 每一轮广播按 user_id 分成多少片；分片数多于进程数时，先发完的进程会去认领剩下的分片
+BROADCAST_SHARDS = getattr(config, 'BROADCAST_SHARDS', 16)
+# 每个进程同时发送几个分片；每个进程有自己的限速，BROADCAST_RATE_PER_SECOND 需要按进程数分摊
+BROADCAST_SHARDS_PER_PROCESS = getattr(config, 'BROADCAST_SHARDS_PER_PROCESS', 1)
+# 认领一个分片后多久没有汇报进度就算认领者挂掉，分片可以被其他进程重新认领（秒）
+BROADCAST_SHARD_CLAIM_TTL = getattr(config, 'BROADCAST_SHARD_CLAIM_TTL', 60)
+# 空闲进程多久查看一次有没有可认领的分片（秒）
+BROADCAST_SHARD_POLL_INTERVAL = getattr(config, 'BROADCAST_SHARD_POLL_INTERVAL', 2)
+# 创建超过这么久还没发完的轮次不再发送，也不再阻止新一轮开始（秒）
+BROADCAST_ROUND_MAX_AGE = getattr(config, 'BROADCAST_ROUND_MAX_AGE', 3600)
+# 轮次记录保留多久（秒）
+BROADCAST_ROUND_RETENTION = getattr(config, 'BROADCAST_ROUND_RETENTION', 7 * 24 * 3600)
+
+
+class ShardedBroadcastScheduler:
+    """
+    多进程部署下的广播调度。
+    - 主节点到点时在数据库里创建一轮广播和它的分片，上一轮还有分片没发完时跳过本轮
+    - 每个进程（包括主节点）定期认领分片，只发送 user_id % 分片数 == 分片号 的用户
+    - 发送过程中定期把断点写回数据库并续期；进程挂掉后，分片在认领期过后由其他进程从断点续发
+    - 同一轮的排行榜由各个分片自己发送，用轮次 ID 作种子，内容一致
+    """
+
+    def __init__(self, elector: leader_election.LeaderElector = None, shard_count: int = BROADCAST_SHARDS,
+                 shards_per_process: int = BROADCAST_SHARDS_PER_PROCESS,
+                 claim_ttl: float = BROADCAST_SHARD_CLAIM_TTL,
+                 max_pending_leaderboards: int = MAX_PENDING_LEADERBOARDS):
+        self.elector = elector or leader_election.elector
+        self.shard_count = shard_count
+        self.shards_per_process = shards_per_process
+        self.claim_ttl = claim_ttl
+        self.max_pending_leaderboards = max_pending_leaderboards
+        self._engine: Optional[FanoutEngine] = None
+        self.active_shards = 0
+        self.pending_leaderboards = 0
+        self.rounds_created = 0
+        self.rounds_skipped = 0
+        self.shards_completed = 0
+        self.shards_failed = 0
+        self.shards_lost = 0
+
+    @property
+    def owner(self) -> str:
+        return self.elector.holder
+
+    def setup(self, job_queue: JobQueue, interval: float, first: float = 10):
+        """注册两个重复任务：主节点创建轮次，所有进程认领分片"""
+        job_queue.run_repeating(self.on_tick, interval=interval, first=first, name="broadcast_round")
+        job_queue.run_repeating(self.claim_job, interval=BROADCAST_SHARD_POLL_INTERVAL, first=first,
+                                name="broadcast_shard_claim")
+
+    def get_stats(self) -> Dict[str, float]:
+        """返回调度器的统计数据"""
+        return {
+            'active_shards': self.active_shards,
+            'pending_leaderboards': self.pending_leaderboards,
+            'rounds_created': self.rounds_created,
+            'rounds_skipped': self.rounds_skipped,
+            'shards_completed': self.shards_completed,
+            'shards_failed': self.shards_failed,
+            'shards_lost': self.shards_lost,
+        }
+
+    async def on_tick(self, context: ContextTypes.DEFAULT_TYPE):
+        """定时任务回调：只有主节点创建新的一轮"""
+        if not self.elector.is_leader:
+            return
+        try:
+            open_shards = await count_open_broadcast_shards(BROADCAST_ROUND_MAX_AGE)
+            if open_shards:
+                self.rounds_skipped += 1
+                logger.warning(f"上一轮广播还有 {open_shards} 个分片没有发完，跳过本轮。")
+                return
+            round_id = await create_broadcast_round(get_random_multiplier(), self.shard_count)
+            self.rounds_created += 1
+            logger.info(f"已创建第 {round_id} 轮广播，共 {self.shard_count} 个分片。")
+            pruned = await prune_broadcast_rounds(BROADCAST_ROUND_RETENTION)
+            if pruned:
+                logger.info(f"已清理 {pruned} 轮过期的广播记录。")
+        except Exception as e:
+            logger.error(f"创建广播轮次失败: {e}")
+
+    async def claim_job(self, context: ContextTypes.DEFAULT_TYPE):
+        """定时任务回调：有空闲名额时认领一个分片，放到后台发送"""
+        if self.active_shards >= self.shards_per_process:
+            return
+        if self.pending_leaderboards >= self.max_pending_leaderboards:
+            return
+        try:
+            shard = await claim_broadcast_shard(self.owner, self.claim_ttl, BROADCAST_ROUND_MAX_AGE)
+        except Exception as e:
+            logger.error(f"认领广播分片失败: {e}")
+            return
+        if shard is None:
+            return
+        self.active_shards += 1
+        context.application.create_task(self._run_shard(context.application, shard))
+
+    async def _run_shard(self, app: Application, shard: Dict):
+        round_id, shard_index = shard['round_id'], shard['shard_index']
+        if self._engine is None:
+            self._engine = FanoutEngine(app.bot)
+        bookkeeper = RoundBookkeeper()
+        resume_from = shard.get('last_user_id')
+        logger.info(f"开始发送第 {round_id} 轮的分片 {shard_index}/{shard['shard_count']}"
+                    + (f"，从 user_id {resume_from} 之后续发" if resume_from is not None else "") + "...")
+        phase = asyncio.ensure_future(send_multiplier_phase(
+            self._engine, round_id, multiplier=shard['multiplier'], shard_count=shard['shard_count'],
+            shard_index=shard_index, after_user_id=resume_from, bookkeeper=bookkeeper))
+        try:
+            # 每隔三分之一个认领期汇报一次进度；分片已经被别人认领时停止发送
+            while True:
+                await asyncio.wait({phase}, timeout=self.claim_ttl / 3)
+                if phase.done():
+                    break
+                if not await self._checkpoint(round_id, shard_index, bookkeeper):
+                    self.shards_lost += 1
+                    logger.warning(f"第 {round_id} 轮的分片 {shard_index} 已被其他进程认领，停止发送。")
+                    phase.cancel()
+                    await asyncio.gather(phase, return_exceptions=True)
+                    return
+            try:
+                broadcast_round: Optional[BroadcastRound] = phase.result()
+            except Exception as e:
+                # 不标记完成，认领期过后由其他进程从断点重试
+                self.shards_failed += 1
+                logger.error(f"第 {round_id} 轮的分片 {shard_index} 发送失败: {e}")
+                return
+            await complete_broadcast_shard(round_id, shard_index, self.owner,
+                                           bookkeeper.sent_count, bookkeeper.failed_count)
+            self.shards_completed += 1
+        except Exception as e:
+            self.shards_failed += 1
+            logger.error(f"第 {round_id} 轮的分片 {shard_index} 记录进度失败: {e}")
+            return
+        finally:
+            if not phase.done():
+                phase.cancel()
+            self.active_shards -= 1
+
+        if broadcast_round is None:
+            return
+        # 同一轮的各个分片用同一个种子，排行榜内容一致；发送时间从轮次的创建时间算起，
+        # 各分片在同一时刻发送（误差是各台机器的时钟差），发完时已经过了这个时刻的分片立即发送
+        broadcast_round.leaderboard_seed = round_id
+        send_at = shard['created_at'] + random.Random(round_id).randint(60, 120)
+        delay = max(0.0, send_at - time.time())
+        logger.info(f"将在 {delay:.0f} 秒后发送第 {round_id} 轮分片 {shard_index} 的排行榜...")
+        self.pending_leaderboards += 1
+        app.job_queue.run_once(self.leaderboard_job, delay, data=broadcast_round,
+                               name=f"broadcast_leaderboard_{round_id}_{shard_index}")
+
+    async def _checkpoint(self, round_id: int, shard_index: int, bookkeeper: RoundBookkeeper) -> bool:
+        """写回断点并续期；数据库暂时不可用时继续发送，认领期过后才可能被别人接手"""
+        try:
+            return await checkpoint_broadcast_shard(round_id, shard_index, self.owner,
+                                                    bookkeeper.resume_after_user_id, bookkeeper.sent_count,
+                                                    self.claim_ttl)
+        except Exception as e:
+            logger.error(f"记录第 {round_id} 轮分片 {shard_index} 的进度失败: {e}")
+            return True
+
+    async def leaderboard_job(self, context: ContextTypes.DEFAULT_TYPE):
+        """排行榜的延时任务回调"""
+        broadcast_round: BroadcastRound = context.job.data
+        try:
+            await send_leaderboard_phase(self._engine or FanoutEngine(context.bot), broadcast_round)
+        except Exception as e:
+            logger.error(f"第 {broadcast_round.round_id} 轮排行榜发送失败: {e}")
+        finally:
+            self.pending_leaderboards -= 1
+
+
+# 全局唯一的分片广播调度器
+sharded_scheduler = ShardedBroadcastScheduler()
@@ -0,0 +1,36 @@
+# telegram_bot/instrumented_request.py
+
+import re
+from typing import Tuple
+
+from telegram.request import HTTPXRequest
+
+from utils import metrics, tracing
+
+# 每次 Bot API 调用的耗时，以及按 HTTP 状态码统计的响应数；网络错误和超时的状态记为 'error'
+TELEGRAM_API_LATENCY = metrics.histogram('telegram_api_duration_seconds', 'Telegram Bot API 调用耗时（秒）',
+                                         ['method'])
+TELEGRAM_API_RESPONSES = metrics.counter('telegram_api_responses_total', 'Telegram Bot API 响应数', ['method', 'status'])
+
+
+def _snake_case(api_method: str) -> str:
+    """sendChatAction -> send_chat_action，和 Bot 上的方法名保持一致"""
+    return re.sub(r'(?<!^)(?=[A-Z])', '_', api_method).lower()
+
+
+class InstrumentedHTTPXRequest(HTTPXRequest):
+    """
+    在 python-telegram-bot 默认的 HTTPXRequest 外面加上耗时和状态码统计，方法名取自 URL 的最后一段。
+    耗时同时算进当前追踪里以方法名命名的阶段（send_message、send_chat_action 等）。
+    """
+
+    async def do_request(self, url: str, method: str, *args, **kwargs) -> Tuple[int, bytes]:
+        api_method = url.rsplit('/', 1)[-1]
+        status = 'error'
+        try:
+            with tracing.span(_snake_case(api_method)), TELEGRAM_API_LATENCY.labels(method=api_method).time():
+                code, payload = await super().do_request(url, method, *args, **kwargs)
+            status = str(code)
+            return code, payload
+        finally:
+            TELEGRAM_API_RESPONSES.labels(method=api_method, status=status).inc()
@@ -4,17 +4,26 @@
 from dotenv import load_dotenv
 # 导入 logging 模块用于记录日志，os 模块用于读取环境变量
 import logging, os
+# 导入 functools，用于给启动函数绑定每个进程自己的参数
+import functools
 # 从 telegram.ext 库导入 Application 和各种处理器类
 from telegram.ext import Application, CommandHandler, MessageHandler, CallbackQueryHandler, filters
 
 # 导入我们自己写的配置文件
 from telegram_bot import config
+# 导入按聊天排序的并发更新处理器
+from telegram_bot.update_processor import ChatOrderedUpdateProcessor
+# 导入带耗时统计的 Bot API 请求类和指标接口
+from telegram_bot.instrumented_request import InstrumentedHTTPXRequest
+from telegram_bot import monitoring
+# 导入 Webhook 接入和多进程 worker
+from telegram_bot import webhook
 # 导入我们自己写的服务模块
-from services import db_service, ai_service
+from services import db_service, ai_service, leader_election
 # 导入我们自己写的处理器模块
 from handlers import command_handler, message_handler, callback_handler
 # 导入我们自己写的定时任务模块
-from tasks import scheduled_broadcast
+from tasks import scheduled_broadcast, sharded_broadcast, chat_history_maintenance, reminders
 
 # 执行函数，加载 .env 文件中的环境变量
 load_dotenv()
@@ -33,12 +42,23 @@ logging.getLogger("httpx").setLevel(logging.WARNING)
 # 获取一个日志记录器实例，用于在这个文件中打印日志
 logger = logging.getLogger(__name__)
 
+# 不同聊天之间最多同时处理多少条更新
+MAX_CONCURRENT_UPDATES = getattr(config, 'MAX_CONCURRENT_UPDATES', 256)
+# 接收更新的方式：'polling' 长轮询（单进程），'webhook' 由本地 HTTP 服务接收并分发给多个 worker 进程
+BOT_MODE = getattr(config, 'BOT_MODE', 'polling')
+# 调用 Bot API 的 HTTP 连接池大小，不应小于同时处理的更新数和群发并发数
+TELEGRAM_CONNECTION_POOL_SIZE = getattr(config, 'TELEGRAM_CONNECTION_POOL_SIZE', 256)
+
 
 # 定义一个异步函数，用于在机器人启动前执行初始化任务
-async def post_init_setup(application: Application) -> None:
+async def post_init_setup(application: Application, run_jobs: bool = True,
+                          metrics_port: int = monitoring.METRICS_PORT) -> None:
     """
     在机器人启动前，执行所有异步的初始化任务。
     这个函数会被 ApplicationBuilder 的 post_init 参数调用。
+    多进程部署时只有一个进程 run_jobs=True，定时广播和归档任务不会被重复执行；
+    开启 LEADER_ELECTION_ENABLED 后每个进程都注册定时任务，由选出的主节点创建广播轮次、执行归档，
+    广播按 user_id 分片后由所有进程一起发送。每个进程的指标接口使用不同的端口。
     """
     # 打印一条日志，表示设置已开始
     logger.info("正在执行启动前设置...")
@@ -46,51 +66,77 @@ async def post_init_setup(application: Application) -> None:
     # 1. 初始化数据库
     await db_service.initialize_database()
 
-    # 2. 初始化 Gemini AI 服务
+    # 2. 初始化 AI 服务（按配置使用 Gemini 或本地桩实现）
     # 检查 AI 服务是否初始化成功
-    if not ai_service.initialize_gemini(google_key):
+    if not ai_service.initialize_ai_backend(google_key):
         # 如果失败，就打印一条严重的错误日志
-        logger.critical("Gemini 初始化失败，机器人将无法正常工作。")
+        logger.critical("AI 后端初始化失败，机器人将无法正常工作。")
         # 在实际应用中可能需要更复杂的处理，但对于调试，这足够了
 
     # 3. 设置定时任务
     # 从 application 对象中获取任务队列
     job_queue = application.job_queue
     # 检查任务队列是否存在
-    if job_queue:
+    if not run_jobs and not leader_election.LEADER_ELECTION_ENABLED:
+        logger.info("这个进程不负责定时任务。")
+    elif job_queue:
         # 计算每日广播的间隔时间（秒）
         interval_seconds = (24 * 60 * 60) / config.DAILY_BROADCAST_COUNT
-        # 添加一个重复执行的任务
-        job_queue.run_repeating(scheduled_broadcast.broadcast_task, interval=interval_seconds, first=10)
+        if leader_election.LEADER_ELECTION_ENABLED:
+            # 参与主节点选举；主节点创建广播轮次，所有进程认领分片一起发送
+            leader_election.elector.setup(job_queue)
+            sharded_broadcast.sharded_scheduler.setup(job_queue, interval=interval_seconds, first=10)
+        else:
+            # 交给广播调度器注册重复任务，由它负责避免轮次重叠、调度排行榜
+            scheduled_broadcast.round_scheduler.setup(job_queue, interval=interval_seconds, first=10)
         # 打印一条成功日志
         logger.info(f"定时任务已添加，每 {interval_seconds:.2f} 秒执行一次。")
+        # 添加对话记录的归档维护任务
+        chat_history_maintenance.setup_chat_history_maintenance(job_queue)
+        # 添加提醒的清扫任务，按批发送到期的提醒
+        reminders.reminder_sweeper.setup(job_queue)
     else:
         # 如果任务队列不存在，就打印一条警告日志
         logger.warning("JobQueue 未启用，无法设置定时任务。")
 
+    # 4. 启动本地的指标接口（Prometheus 文本格式）
+    await monitoring.start_metrics_server(application, port=metrics_port)
 
-# 定义主函数，这是程序的入口
-def main() -> None:
-    """
-    主函数，用于配置和启动机器人。
-    这是一个同步函数，它将事件循环的管理完全交给 python-telegram-bot 库。
-    """
 
-    # 打印一条日志，表示正在构建应用
-    logger.info("正在构建机器人应用...")
+# 定义一个异步函数，在机器人停止时执行清理任务
+async def post_stop_cleanup(application: Application) -> None:
+    """停止指标接口，放弃主节点租约，然后优雅地关闭数据库连接"""
+    await monitoring.stop_metrics_server()
+    if leader_election.LEADER_ELECTION_ENABLED:
+        await leader_election.elector.release()
+    await db_service.close_pool(application)
 
+
+# 定义一个函数，构建并配置机器人应用
+def build_application(run_jobs: bool = True, metrics_port: int = monitoring.METRICS_PORT,
+                      with_updater: bool = True) -> Application:
+    """
+    构建机器人应用并注册所有处理器。
+    with_updater=False 用于 webhook 的 worker 进程：更新由接入进程转发过来，不需要自己去拉取。
+    """
     # 使用 ApplicationBuilder 来链式配置和构建机器人应用
-    application = (
+    builder = (
         Application.builder()
         # 设置机器人的 Token
         .token(telegram_token)
         # 注册一个在程序启动后、开始轮询前执行的函数
-        .post_init(post_init_setup)
-        # 注册一个在程序停止时执行的函数，用来优雅地关闭数据库连接
-        .post_stop(db_service.close_pool)
-        # 完成构建
-        .build()
+        .post_init(functools.partial(post_init_setup, run_jobs=run_jobs, metrics_port=metrics_port))
+        # 注册一个在程序停止时执行的函数，用来停止指标接口、优雅地关闭数据库连接
+        .post_stop(post_stop_cleanup)
+        # 调用 Bot API 时记录每个方法的耗时和状态码
+        .request(InstrumentedHTTPXRequest(connection_pool_size=TELEGRAM_CONNECTION_POOL_SIZE))
+        # 不同聊天的更新并发处理，同一聊天的更新仍按顺序处理
+        .concurrent_updates(ChatOrderedUpdateProcessor(MAX_CONCURRENT_UPDATES))
     )
+    if not with_updater:
+        builder = builder.updater(None)
+    # 完成构建
+    application = builder.build()
 
     # --- 注册消息处理器 ---
     # 添加一个命令处理器，将 /start 命令和 start_command 函数关联起来
@@ -99,6 +145,24 @@ def main() -> None:
     application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, message_handler.text_message_handler))
     # 添加一个回调查询处理器，处理所有内联按钮的点击
     application.add_handler(CallbackQueryHandler(callback_handler.button_handler))
+    return application
+
+
+# 定义主函数，这是程序的入口
+def main() -> None:
+    """
+    主函数，用于配置和启动机器人。
+    这是一个同步函数，它将事件循环的管理完全交给 python-telegram-bot 库。
+    """
+
+    # Webhook 模式：本进程只负责接收和分发更新，处理交给多个 worker 进程；没有配置 WEBHOOK_URL 时退回长轮询
+    if BOT_MODE == 'webhook' and webhook.run_webhook_cluster(telegram_token, build_application):
+        logger.info("机器人已停止。")
+        return
+
+    # 打印一条日志，表示正在构建应用
+    logger.info("正在构建机器人应用...")
+    application = build_application()
 
     # --- 启动机器人 ---
     # run_polling 是一个阻塞调用，它会启动所有东西并保持运行，直到你按 Ctrl-C
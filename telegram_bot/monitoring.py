@@ -0,0 +1,142 @@
+# telegram_bot/monitoring.py
+
+import json
+import logging
+from typing import Any, Optional
+
+from telegram.ext import Application
+
+from telegram_bot import config
+from services import db_service, ai_service, leader_election
+from services.media_assets import media_registry
+from handlers import message_handler
+from tasks import scheduled_broadcast, sharded_broadcast, chat_history_maintenance, reminders
+from utils import metrics, tracing
+from utils.profiler import profiler, ProfilerBusyError
+from utils.http_server import SimpleHTTPServer, HTTPRequest, HTTPResponse
+
+logger = logging.getLogger(__name__)
+
+# 指标接口监听的地址和端口；端口为 0 时不启动。默认只监听本机，由本机的 Prometheus 或 agent 抓取
+METRICS_HOST = getattr(config, 'METRICS_HOST', '127.0.0.1')
+METRICS_PORT = getattr(config, 'METRICS_PORT', 9102)
+
+# Prometheus 文本格式的 Content-Type
+PROMETHEUS_CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+_server: Optional[SimpleHTTPServer] = None
+
+
+def register_application_metrics(application: Application):
+    """把连接池、任务队列、更新处理器等运行状态，以及各模块已有的统计函数注册成 gauge"""
+    metrics.REGISTRY.register_stats('db_storage', '数据库连接状态', db_service.get_storage_stats)
+    metrics.REGISTRY.register_stats('db_user_cache', '用户行缓存', db_service.get_user_cache_stats)
+    metrics.REGISTRY.register_stats('db_history_buffer', '对话历史内存缓冲区',
+                                    db_service.get_chat_history_buffer_stats)
+    metrics.REGISTRY.register_stats('db_chat_writer', '对话记录写入队列', db_service.get_chat_writer_stats)
+    metrics.REGISTRY.register_stats('ai_intent', '意图判断', ai_service.get_intent_stats)
+    metrics.REGISTRY.register_stats('media_assets', '素材 file_id 缓存', media_registry.get_stats)
+    metrics.REGISTRY.register_stats('message_debounce', '连续消息合并', message_handler.get_debounce_stats)
+    metrics.REGISTRY.register_stats('broadcast_scheduler', '广播调度器',
+                                    scheduled_broadcast.round_scheduler.get_stats)
+    if leader_election.LEADER_ELECTION_ENABLED:
+        metrics.REGISTRY.register_stats('leader_election', '主节点选举', leader_election.elector.get_stats)
+        metrics.REGISTRY.register_stats('broadcast_shards', '分片广播', sharded_broadcast.sharded_scheduler.get_stats)
+    metrics.REGISTRY.register_stats('reminders', '提醒清扫任务', reminders.reminder_sweeper.get_stats)
+    metrics.REGISTRY.register_stats('chat_history_maintenance', '最近一次对话记录归档',
+                                    lambda: chat_history_maintenance.last_run_stats)
+
+    job_queue = application.job_queue
+    if job_queue:
+        metrics.gauge('job_queue_jobs', 'JobQueue 中已调度的任务数').set_function(lambda: len(job_queue.jobs()))
+
+    processor = application.update_processor
+    if hasattr(processor, 'get_stats'):
+        metrics.REGISTRY.register_stats('update_processor', '更新处理器', processor.get_stats)
+
+
+async def _metrics_endpoint(request: HTTPRequest) -> HTTPResponse:
+    return HTTPResponse.text(metrics.REGISTRY.render(), content_type=PROMETHEUS_CONTENT_TYPE)
+
+
+async def _health_endpoint(request: HTTPRequest) -> HTTPResponse:
+    return HTTPResponse.text('ok\n')
+
+
+def _json(data: Any, status: int = 200) -> HTTPResponse:
+    return HTTPResponse.text(json.dumps(data, ensure_ascii=False, default=str), status=status,
+                             content_type='application/json')
+
+
+async def _traces_endpoint(request: HTTPRequest) -> HTTPResponse:
+    """最近的追踪记录，可以用 ?name=text_message_handler&min_ms=2000&limit=50 过滤"""
+    try:
+        limit = int(request.query.get('limit', 100))
+        min_duration_ms = float(request.query.get('min_ms', 0))
+    except ValueError:
+        return _json({'error': 'limit 和 min_ms 必须是数字'}, status=400)
+    return _json(tracing.recent_traces(limit, request.query.get('name'), min_duration_ms))
+
+
+async def _profile_status_endpoint(request: HTTPRequest) -> HTTPResponse:
+    return _json(profiler.status())
+
+
+async def _profile_start_endpoint(request: HTTPRequest) -> HTTPResponse:
+    """开始一次限时分析：POST /debug/profile?mode=stack|cprofile&seconds=30"""
+    try:
+        status = profiler.start(request.query.get('mode', 'stack'), float(request.query.get('seconds', 30)))
+    except ProfilerBusyError as e:
+        return _json({'error': str(e)}, status=409)
+    except ValueError as e:
+        return _json({'error': str(e)}, status=400)
+    return _json(status)
+
+
+async def _profile_stop_endpoint(request: HTTPRequest) -> HTTPResponse:
+    """提前结束正在进行的分析，返回写出的文件"""
+    result = profiler.stop()
+    if result is None:
+        return _json({'error': '没有进行中的分析'}, status=409)
+    return _json(result)
+
+
+async def start_metrics_server(application: Application, host: str = METRICS_HOST,
+                               port: int = METRICS_PORT) -> Optional[SimpleHTTPServer]:
+    """注册运行状态指标，并启动 /metrics 接口；端口为 0 时只注册指标"""
+    global _server
+    register_application_metrics(application)
+    if not port:
+        logger.info("METRICS_PORT 为 0，不启动指标接口。")
+        return None
+    server = SimpleHTTPServer(host, port)
+    server.route('GET', '/metrics', _metrics_endpoint)
+    server.route('GET', '/healthz', _health_endpoint)
+    # 排查慢请求用的调试接口，和指标接口一样只监听本机
+    server.route('GET', '/debug/traces', _traces_endpoint)
+    server.route('GET', '/debug/profile', _profile_status_endpoint)
+    server.route('POST', '/debug/profile', _profile_start_endpoint)
+    server.route('POST', '/debug/profile/stop', _profile_stop_endpoint)
+    try:
+        await server.start()
+    except OSError as e:
+        # 端口被占用等问题不应该让机器人起不来
+        logger.error(f"指标接口启动失败 ({host}:{port}): {e}")
+        return None
+    _server = server
+    logger.info(f"指标接口已启动: http://{host}:{server.port}/metrics")
+    return server
+
+
+def get_metrics_server() -> Optional[SimpleHTTPServer]:
+    """返回正在运行的监控 HTTP 服务器，没有启动时返回 None"""
+    return _server
+
+
+async def stop_metrics_server():
+    global _server
+    # 停机时还在进行的分析也把结果写出来
+    profiler.stop()
+    if _server is not None:
+        await _server.stop()
+        _server = None
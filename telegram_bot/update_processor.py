@@ -0,0 +1,98 @@
+# telegram_bot/update_processor.py
+
+import asyncio
+import logging
+from typing import Any, Awaitable, Dict, Optional
+
+from telegram import Update
+from telegram.ext import BaseUpdateProcessor
+
+logger = logging.getLogger(__name__)
+
+
+class ChatOrderedUpdateProcessor(BaseUpdateProcessor):
+    """
+    按聊天分组的并发更新处理器。
+    - 不同聊天的更新并发处理，总并发数受 max_concurrent_updates 限制
+    - 同一个聊天的更新严格按到达顺序逐条处理，状态机不会出现竞争
+    - 先排队拿聊天锁，再占用全局并发名额，排队中的更新不会占着名额空等
+    """
+
+    def __init__(self, max_concurrent_updates: int):
+        super().__init__(max_concurrent_updates)
+        # chat_id -> 这个聊天的锁，只在有更新排队或处理中时存在
+        self._chat_locks: Dict[int, asyncio.Lock] = {}
+        # chat_id -> 这个聊天排队中和处理中的更新数
+        self._chat_pending: Dict[int, int] = {}
+        self.total_pending = 0
+        self.processed = 0
+
+    @staticmethod
+    def _chat_key(update: object) -> Optional[int]:
+        """找出更新所属的聊天，找不到时返回 None（这类更新不需要排序）"""
+        if not isinstance(update, Update):
+            return None
+        if update.effective_chat:
+            return update.effective_chat.id
+        if update.effective_user:
+            return update.effective_user.id
+        return None
+
+    async def process_update(self, update: object, coroutine: Awaitable[Any]) -> None:
+        chat_key = self._chat_key(update)
+        if chat_key is None:
+            await super().process_update(update, coroutine)
+            return
+        await self._process_in_chat_order(chat_key, update, coroutine)
+
+    async def run_ordered(self, chat_id: int, coroutine: Awaitable[Any]) -> None:
+        """
+        在某个聊天的顺序里执行一个不属于任何更新的协程（例如延迟处理的消息）。
+        它和这个聊天的更新一起排队，同样占用全局并发名额。
+        """
+        await self._process_in_chat_order(chat_id, None, coroutine)
+
+    async def _process_in_chat_order(self, chat_key: int, update: object, coroutine: Awaitable[Any]) -> None:
+        lock = self._chat_locks.get(chat_key)
+        if lock is None:
+            lock = self._chat_locks[chat_key] = asyncio.Lock()
+        self._chat_pending[chat_key] = self._chat_pending.get(chat_key, 0) + 1
+        self.total_pending += 1
+        try:
+            # asyncio.Lock 按等待顺序唤醒，所以同一聊天的更新按到达顺序执行
+            async with lock:
+                await super().process_update(update, coroutine)
+        finally:
+            self.total_pending -= 1
+            self.processed += 1
+            remaining = self._chat_pending[chat_key] - 1
+            if remaining:
+                self._chat_pending[chat_key] = remaining
+            else:
+                # 这个聊天没有更新了，释放锁，避免字典随用户数增长
+                del self._chat_pending[chat_key]
+                del self._chat_locks[chat_key]
+
+    async def do_process_update(self, update: object, coroutine: Awaitable[Any]) -> None:
+        await coroutine
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        if self.total_pending:
+            logger.info(f"关闭更新处理器时还有 {self.total_pending} 条更新未处理完。")
+
+    def queue_depth(self, chat_id: int) -> int:
+        """返回某个聊天排队中和处理中的更新数"""
+        return self._chat_pending.get(chat_id, 0)
+
+    def get_stats(self) -> Dict[str, int]:
+        """返回处理器的统计数据"""
+        return {
+            'total_pending': self.total_pending,
+            'active_chats': len(self._chat_pending),
+            'max_chat_depth': max(self._chat_pending.values(), default=0),
+            'processed': self.processed,
+            'max_concurrent_updates': self.max_concurrent_updates,
+        }
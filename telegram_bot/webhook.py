@@ -0,0 +1,269 @@
+# telegram_bot/webhook.py
+
+import asyncio
+import hmac
+import json
+import logging
+import multiprocessing
+import os
+import queue
+import secrets
+import signal
+from typing import Any, Callable, Dict, List, Optional
+
+from telegram import Bot, Update
+from telegram.ext import Application
+
+from telegram_bot import config
+from telegram_bot.monitoring import METRICS_HOST, METRICS_PORT, PROMETHEUS_CONTENT_TYPE
+from utils import metrics
+from utils.hashing import ConsistentHashRing
+from utils.http_server import SimpleHTTPServer, HTTPRequest, HTTPResponse
+
+logger = logging.getLogger(__name__)
+
+# Telegram 推送更新的公网 HTTPS 地址（例如 https://bot.example.com/telegram）；没有配置时退回长轮询。
+# TLS 由前面的反向代理终止，本进程只监听明文 HTTP
+WEBHOOK_URL = getattr(config, 'WEBHOOK_URL', None) or os.getenv("WEBHOOK_URL")
+# 本地监听的地址、端口和路径
+WEBHOOK_LISTEN = getattr(config, 'WEBHOOK_LISTEN', '127.0.0.1')
+WEBHOOK_PORT = getattr(config, 'WEBHOOK_PORT', 8080)
+WEBHOOK_PATH = getattr(config, 'WEBHOOK_PATH', '/telegram')
+# Telegram 每次推送都会在 X-Telegram-Bot-Api-Secret-Token 头里带上这个值；没有配置时每次启动随机生成
+WEBHOOK_SECRET_TOKEN = getattr(config, 'WEBHOOK_SECRET_TOKEN', None) or os.getenv("WEBHOOK_SECRET_TOKEN")
+# Telegram 同时向我们发起的最大连接数（1 到 100）
+WEBHOOK_MAX_CONNECTIONS = getattr(config, 'WEBHOOK_MAX_CONNECTIONS', 100)
+# worker 进程数，默认每个 CPU 核一个
+WEBHOOK_WORKERS = getattr(config, 'WEBHOOK_WORKERS', None) or os.cpu_count() or 1
+# 每个 worker 的待处理队列容量；满了之后返回 503，由 Telegram 稍后重试
+WEBHOOK_WORKER_QUEUE_SIZE = getattr(config, 'WEBHOOK_WORKER_QUEUE_SIZE', 10000)
+# 检查 worker 是否存活的间隔（秒），挂掉的 worker 会被重新拉起
+WEBHOOK_WORKER_CHECK_INTERVAL = getattr(config, 'WEBHOOK_WORKER_CHECK_INTERVAL', 5)
+# 创建 worker 进程的方式；spawn 不继承父进程的线程和事件循环，最稳妥
+WEBHOOK_START_METHOD = getattr(config, 'WEBHOOK_START_METHOD', 'spawn')
+
+SECRET_TOKEN_HEADER = 'x-telegram-bot-api-secret-token'
+
+WEBHOOK_UPDATES = metrics.counter('webhook_updates_total', '转发给各个 worker 的更新数', ['worker'])
+WEBHOOK_REJECTED = metrics.counter('webhook_rejected_total', '被拒绝的 webhook 请求数', ['reason'])
+WEBHOOK_WORKER_RESTARTS = metrics.counter('webhook_worker_restarts_total', '重新拉起的 worker 进程数')
+
+BuildApplication = Callable[..., Application]
+
+
+def routing_key(data: Dict[str, Any]) -> int:
+    """
+    从原始的更新 JSON 里找出聊天 ID，找不到时用用户 ID，和 ChatOrderedUpdateProcessor 的分组方式一致。
+    同一个聊天的更新总是交给同一个 worker，状态机和消息顺序不受多进程影响。
+    """
+    for key, value in data.items():
+        if key == 'update_id' or not isinstance(value, dict):
+            continue
+        chat = value.get('chat') or (value.get('message') or {}).get('chat')
+        if chat and 'id' in chat:
+            return chat['id']
+        user = value.get('from') or value.get('user')
+        if user and 'id' in user:
+            return user['id']
+    return data.get('update_id', 0)
+
+
+def _worker_metrics_port(index: int) -> int:
+    """接入进程使用 METRICS_PORT，第 i 个 worker 使用 METRICS_PORT + 1 + i"""
+    return METRICS_PORT + 1 + index if METRICS_PORT else 0
+
+
+def _worker_main(index: int, inbox, build_application: BuildApplication):
+    """worker 进程的入口：只有 0 号 worker 负责定时任务；开启主节点选举后每个 worker 都参与，由主节点协调"""
+    # Ctrl-C 只交给接入进程处理，worker 等接入进程发来结束信号后自己退出
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    application = build_application(run_jobs=index == 0, metrics_port=_worker_metrics_port(index),
+                                    with_updater=False)
+    asyncio.run(_run_worker(index, application, inbox))
+
+
+async def _run_worker(index: int, application: Application, inbox):
+    """把接入进程转发来的更新放进 application 的更新队列，直到收到 None"""
+    loop = asyncio.get_running_loop()
+    parent = multiprocessing.parent_process()
+    await application.initialize()
+    if application.post_init:
+        await application.post_init(application)
+    await application.start()
+    logger.info(f"worker {index} 已启动 (pid {os.getpid()})。")
+    try:
+        while True:
+            try:
+                data = await loop.run_in_executor(None, inbox.get, True, 1.0)
+            except queue.Empty:
+                # 接入进程意外退出时，worker 也跟着退出，不留下孤儿进程
+                if parent is not None and not parent.is_alive():
+                    logger.warning(f"worker {index} 发现接入进程已退出。")
+                    break
+                continue
+            if data is None:
+                break
+            try:
+                await application.update_queue.put(Update.de_json(data, application.bot))
+            except Exception as e:
+                logger.error(f"worker {index} 解析更新失败: {e}")
+    finally:
+        await application.stop()
+        if application.post_stop:
+            await application.post_stop(application)
+        await application.shutdown()
+        if application.post_shutdown:
+            await application.post_shutdown(application)
+        logger.info(f"worker {index} 已停止。")
+
+
+class WebhookIngress:
+    """
+    Webhook 接入进程。
+    - 本地 HTTP 服务接收 Telegram 的推送，校验密钥后按聊天 ID 一致性哈希分给 worker 进程
+    - 每个 worker 是一个完整的 Application（没有 Updater），各自有数据库连接和事件循环
+    - worker 挂掉时重新拉起，队列里还没处理的更新由新的 worker 接着处理
+    """
+
+    def __init__(self, token: str, build_application: BuildApplication, url: str,
+                 secret_token: Optional[str] = WEBHOOK_SECRET_TOKEN, workers: int = WEBHOOK_WORKERS,
+                 host: str = WEBHOOK_LISTEN, port: int = WEBHOOK_PORT, path: str = WEBHOOK_PATH,
+                 queue_size: int = WEBHOOK_WORKER_QUEUE_SIZE):
+        self.token = token
+        self.build_application = build_application
+        self.url = url
+        self.secret_token = secret_token or secrets.token_urlsafe(32)
+        self.worker_count = max(1, workers)
+        self.path = path
+        self._context = multiprocessing.get_context(WEBHOOK_START_METHOD)
+        self._inboxes = [self._context.Queue(maxsize=queue_size) for _ in range(self.worker_count)]
+        self._processes: List[Optional[multiprocessing.Process]] = [None] * self.worker_count
+        self._ring = ConsistentHashRing(range(self.worker_count))
+        self._server = SimpleHTTPServer(host, port)
+        self._server.route('POST', path, self._handle_update)
+        self._server.route('GET', '/healthz', self._handle_health)
+        self._metrics_server: Optional[SimpleHTTPServer] = None
+        self._stopping: Optional[asyncio.Event] = None
+
+    def _spawn(self, index: int):
+        process = self._context.Process(target=_worker_main, name=f"bot-worker-{index}",
+                                        args=(index, self._inboxes[index], self.build_application))
+        process.start()
+        self._processes[index] = process
+
+    def alive_workers(self) -> int:
+        return sum(1 for process in self._processes if process is not None and process.is_alive())
+
+    async def _handle_update(self, request: HTTPRequest) -> HTTPResponse:
+        provided = request.headers.get(SECRET_TOKEN_HEADER, '')
+        if not hmac.compare_digest(provided.encode(), self.secret_token.encode()):
+            WEBHOOK_REJECTED.labels(reason='secret_token').inc()
+            return HTTPResponse.text('forbidden', status=403)
+        try:
+            data = json.loads(request.body)
+        except ValueError:
+            WEBHOOK_REJECTED.labels(reason='bad_json').inc()
+            return HTTPResponse.text('bad request', status=400)
+        if not isinstance(data, dict):
+            WEBHOOK_REJECTED.labels(reason='bad_json').inc()
+            return HTTPResponse.text('bad request', status=400)
+        index = self._ring.get(routing_key(data))
+        try:
+            self._inboxes[index].put_nowait(data)
+        except queue.Full:
+            # 返回非 200 时 Telegram 会稍后重发，等于把积压留在 Telegram 那边
+            WEBHOOK_REJECTED.labels(reason='queue_full').inc()
+            return HTTPResponse.text('busy', status=503)
+        WEBHOOK_UPDATES.labels(worker=index).inc()
+        return HTTPResponse.text('ok')
+
+    async def _handle_health(self, request: HTTPRequest) -> HTTPResponse:
+        alive = self.alive_workers()
+        status = 200 if alive == self.worker_count else 503
+        return HTTPResponse.text(f"workers {alive}/{self.worker_count}\n", status=status)
+
+    async def _watch_workers(self):
+        while not self._stopping.is_set():
+            try:
+                await asyncio.wait_for(self._stopping.wait(), WEBHOOK_WORKER_CHECK_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            if self._stopping.is_set():
+                return
+            for index, process in enumerate(self._processes):
+                if process is not None and not process.is_alive():
+                    logger.error(f"worker {index} 已退出 (exitcode {process.exitcode})，正在重新拉起。")
+                    WEBHOOK_WORKER_RESTARTS.inc()
+                    self._spawn(index)
+
+    async def _start_metrics_server(self):
+        if not METRICS_PORT:
+            return
+        for index, inbox in enumerate(self._inboxes):
+            # 有的平台（macOS）不支持 Queue.qsize()，这时导出 NaN
+            metrics.gauge('webhook_worker_queue_depth', '各 worker 待处理的更新数', ['worker']).labels(
+                worker=index).set_function(inbox.qsize)
+        metrics.gauge('webhook_workers_alive', '存活的 worker 进程数').set_function(self.alive_workers)
+
+        async def render(request: HTTPRequest) -> HTTPResponse:
+            return HTTPResponse.text(metrics.REGISTRY.render(), content_type=PROMETHEUS_CONTENT_TYPE)
+
+        self._metrics_server = SimpleHTTPServer(METRICS_HOST, METRICS_PORT)
+        self._metrics_server.route('GET', '/metrics', render)
+        try:
+            await self._metrics_server.start()
+        except OSError as e:
+            logger.error(f"接入进程的指标接口启动失败: {e}")
+            self._metrics_server = None
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        self._stopping = asyncio.Event()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            try:
+                loop.add_signal_handler(sig, self._stopping.set)
+            except NotImplementedError:  # pragma: no cover - Windows 上没有 add_signal_handler
+                pass
+
+        for index in range(self.worker_count):
+            self._spawn(index)
+        await self._server.start()
+        await self._start_metrics_server()
+        # 服务已经在监听了，再让 Telegram 开始推送
+        async with Bot(self.token) as bot:
+            await bot.set_webhook(url=self.url, secret_token=self.secret_token, allowed_updates=Update.ALL_TYPES,
+                                  max_connections=WEBHOOK_MAX_CONNECTIONS)
+        logger.info(f"Webhook 已设置为 {self.url}，{self.worker_count} 个 worker 正在处理更新。")
+
+        watcher = asyncio.create_task(self._watch_workers())
+        try:
+            await self._stopping.wait()
+        finally:
+            logger.info("正在停止 webhook 接入...")
+            watcher.cancel()
+            # 先停止接收，Telegram 会把之后的更新留着重试；webhook 本身保留，重启后继续推送
+            await self._server.stop()
+            if self._metrics_server is not None:
+                await self._metrics_server.stop()
+            for inbox in self._inboxes:
+                inbox.put(None)
+            for process in self._processes:
+                if process is None:
+                    continue
+                await loop.run_in_executor(None, process.join, 30)
+                if process.is_alive():
+                    logger.warning(f"{process.name} 没有按时退出，强制结束。")
+                    process.terminate()
+
+
+def run_webhook_cluster(token: str, build_application: BuildApplication) -> bool:
+    """
+    以 webhook 模式运行，阻塞直到收到 SIGINT/SIGTERM。
+    没有配置 WEBHOOK_URL 时返回 False，由调用方改用长轮询。
+    """
+    if not WEBHOOK_URL:
+        logger.warning("没有配置 WEBHOOK_URL，改用长轮询。")
+        return False
+    ingress = WebhookIngress(token, build_application, WEBHOOK_URL)
+    asyncio.run(ingress.run())
+    return True
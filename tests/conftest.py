@@ -0,0 +1,7 @@
+# tests/conftest.py
+
+import os
+import sys
+
+# 测试从项目根目录导入 handlers、services 等包
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,46 @@
+# tests/test_chat_history_archive.py
+"""按每用户上限归档时分段检查用户：每次只检查一段，位置留给下一次，多次维护之后所有用户都不超过上限。"""
+
+import asyncio
+
+from services.storage.sqlite import SQLiteStorage
+
+CAP = 3
+# user_id -> 对话条数
+MESSAGE_COUNTS = {user_id: (7 if user_id % 3 == 0 else 2) for user_id in range(1, 21)}
+
+
+async def _history_counts(storage):
+    conn = await storage._reader()
+    async with conn.execute("SELECT user_id, COUNT(*) FROM chat_history GROUP BY user_id") as cur:
+        return dict(await cur.fetchall())
+
+
+def test_over_cap_archiving_walks_users_in_bounded_passes(tmp_path):
+    async def scenario():
+        storage = SQLiteStorage(str(tmp_path / 'archive.sqlite3'), read_connections=1)
+        try:
+            await storage.initialize()
+            await storage.insert_chat_messages([(user_id, 'user', f"message {n}")
+                                                for user_id, count in MESSAGE_COUNTS.items() for n in range(count)])
+
+            passes = []
+            cursor = None
+            while True:
+                moved, cursor = await storage.archive_chat_history_over_cap(
+                    CAP, batch_size=4, max_batches=2, after_user_id=cursor, max_users=8)
+                passes.append((moved, cursor))
+                if cursor is None:
+                    break
+
+            counts = await _history_counts(storage)
+            assert counts == {user_id: min(count, CAP) for user_id, count in MESSAGE_COUNTS.items()}
+            assert sum(moved for moved, _ in passes) == sum(max(0, c - CAP) for c in MESSAGE_COUNTS.values())
+            # 每次最多搬 2 批、检查 8 个用户，需要分好几次才能走完
+            assert len(passes) > 1
+            # 走完一遍之后再从头检查，不会再搬动任何记录
+            assert await storage.archive_chat_history_over_cap(CAP, 4, 2, None, 100) == (0, None)
+        finally:
+            await storage.close()
+
+    asyncio.run(scenario())
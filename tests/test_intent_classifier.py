@@ -0,0 +1,28 @@
+# tests/test_intent_classifier.py
+"""本地规则只在整条消息都能识别时跳过 AI；夹着没见过的词的回答交给 AI 判断。"""
+
+import pytest
+
+from services.ai_service import LOCAL_INTENT_CONFIDENCE_THRESHOLD
+from utils.intent_classifier import classify_intent_locally
+
+
+@pytest.mark.parametrize('state, message, intent', [
+    ('awaiting_service_confirmation', 'yes please!!', 'service_request'),
+    ('awaiting_experience_confirmation', 'naya hu', 'new_player'),
+    ('awaiting_registration_confirmation', 'ho gaya', 'registration_complete'),
+])
+def test_fully_recognized_reply_skips_ai(state, message, intent):
+    result = classify_intent_locally(state, message)
+    assert result['intent'] == intent
+    assert result['confidence'] >= LOCAL_INTENT_CONFIDENCE_THRESHOLD
+
+
+@pytest.mark.parametrize('state, message', [
+    ('awaiting_service_confirmation', 'ok what'),
+    ('awaiting_registration_confirmation', 'done?? where'),
+    ('awaiting_experience_confirmation', 'no idea'),
+])
+def test_reply_with_unrecognized_word_goes_to_ai(state, message):
+    result = classify_intent_locally(state, message)
+    assert result is None or result['confidence'] < LOCAL_INTENT_CONFIDENCE_THRESHOLD
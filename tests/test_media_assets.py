@@ -0,0 +1,59 @@
+# tests/test_media_assets.py
+"""数据库读不出素材的 file_id 时，注册教程的配图仍然要用网址发出去。"""
+
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+from services import media_assets
+from services.media_assets import MediaAsset, MediaAssetRegistry
+
+PHOTOS = [(MediaAsset('register', 'https://example.com/register.jpg'), "Step 1"),
+          (MediaAsset('recharge', 'https://example.com/recharge.jpg'), "Step 2")]
+
+
+class _FakeBot:
+    """记录每次发送用的参数，返回带 file_id 的消息"""
+
+    def __init__(self):
+        self.sent = []
+
+    async def send_media_group(self, chat_id=None, media=None, **kwargs):
+        self.sent.append([item.media for item in media])
+        return tuple(SimpleNamespace(photo=[SimpleNamespace(file_id=f"id-{index}")])
+                     for index, _ in enumerate(media))
+
+
+@pytest.fixture
+def storage(monkeypatch):
+    state = {'fail': True, 'saved': {}}
+
+    async def get_media_file_ids():
+        if state['fail']:
+            raise ConnectionError("database is down")
+        return {}
+
+    async def save_media_file_id(name, file_id):
+        state['saved'][name] = file_id
+
+    monkeypatch.setattr(media_assets, 'get_media_file_ids', get_media_file_ids)
+    monkeypatch.setattr(media_assets, 'save_media_file_id', save_media_file_id)
+    return state
+
+
+def test_send_falls_back_to_urls_when_file_ids_cannot_be_loaded(storage):
+    async def scenario():
+        registry = MediaAssetRegistry()
+        bot = _FakeBot()
+        await registry.send_photo_group(bot, 1, PHOTOS)
+        assert bot.sent == [[asset.url for asset, _ in PHOTOS]]
+        assert registry.get_stats()['load_failures'] == 1
+
+        # 数据库恢复后重新读取，本进程已经拿到的 file_id 不会被覆盖
+        storage['fail'] = False
+        await registry.send_photo_group(bot, 1, PHOTOS)
+        assert bot.sent[-1] == ["id-0", "id-1"]
+        assert storage['saved'] == {'register': "id-0", 'recharge': "id-1"}
+
+    asyncio.run(scenario())
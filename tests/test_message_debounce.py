@@ -0,0 +1,140 @@
+# tests/test_message_debounce.py
+"""防抖窗口里还没处理的消息，必须先于同一聊天之后到达的 /start 和按钮点击处理。"""
+
+import asyncio
+import itertools
+import time
+from types import SimpleNamespace
+
+import pytest
+from telegram import Update
+
+from handlers import message_handler, command_handler, callback_handler
+from telegram_bot.update_processor import ChatOrderedUpdateProcessor
+
+CHAT_ID = 424242
+_ids = itertools.count(1)
+
+
+class _FakeBot:
+    """记录发出的调用，不访问网络"""
+
+    def __init__(self, events):
+        self.events = events
+
+    async def send_message(self, chat_id=None, text=None, **kwargs):
+        self.events.append(('send_message', text))
+
+    async def answer_callback_query(self, callback_query_id=None, **kwargs):
+        pass
+
+    async def edit_message_text(self, text=None, **kwargs):
+        self.events.append(('button', text))
+
+
+class _FakeApplication:
+    def __init__(self, processor):
+        self.update_processor = processor
+        self.tasks = set()
+
+    def create_task(self, coroutine, update=None, name=None):
+        task = asyncio.get_running_loop().create_task(coroutine)
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+        return task
+
+
+def _message(text, bot):
+    message = {
+        "message_id": next(_ids),
+        "date": int(time.time()),
+        "chat": {"id": CHAT_ID, "type": "private"},
+        "from": {"id": CHAT_ID, "is_bot": False, "first_name": "Test"},
+        "text": text,
+    }
+    if text.startswith('/'):
+        message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text)}]
+    return Update.de_json({"update_id": next(_ids), "message": message}, bot)
+
+
+def _button(data, bot):
+    message = {
+        "message_id": next(_ids),
+        "date": int(time.time()),
+        "chat": {"id": CHAT_ID, "type": "private"},
+        "from": {"id": 1, "is_bot": True, "first_name": "Bot"},
+        "text": "请选择你的策略：",
+    }
+    query = {"id": str(next(_ids)), "from": {"id": CHAT_ID, "is_bot": False, "first_name": "Test"},
+             "chat_instance": str(CHAT_ID), "data": data, "message": message}
+    return Update.de_json({"update_id": next(_ids), "callback_query": query}, bot)
+
+
+@pytest.fixture
+def events(monkeypatch):
+    recorded = []
+
+    async def respond_to_messages(update, context, messages):
+        recorded.append(('burst', list(messages)))
+
+    async def get_user_data(user_id):
+        return {}
+
+    async def update_user_data(user_id, data):
+        recorded.append(('state', data.get('state')))
+
+    async def save_chat_message(user_id, role, text):
+        pass
+
+    monkeypatch.setattr(message_handler, 'MESSAGE_DEBOUNCE_MS', 200)
+    monkeypatch.setattr(message_handler, 'respond_to_messages', respond_to_messages)
+    monkeypatch.setattr(message_handler, 'save_chat_message', save_chat_message)
+    monkeypatch.setattr(command_handler, 'get_user_data', get_user_data)
+    monkeypatch.setattr(command_handler, 'update_user_data', update_user_data)
+    monkeypatch.setattr(command_handler, 'save_chat_message', save_chat_message)
+    message_handler._pending_bursts.clear()
+    yield recorded
+    message_handler._pending_bursts.clear()
+
+
+async def _run(events, make_second_update, handler):
+    bot = _FakeBot(events)
+    processor = ChatOrderedUpdateProcessor(16)
+    application = _FakeApplication(processor)
+    context = SimpleNamespace(bot=bot, application=application, job_queue=None)
+
+    texts = [_message(text, bot) for text in ("hi", "yes please")]
+    for update in texts:
+        await processor.process_update(update, message_handler.text_message_handler(update, context))
+    # 防抖窗口还没结束时，同一个聊天来了另一种更新
+    await asyncio.sleep(0.05)
+    second = make_second_update(bot)
+    await processor.process_update(second, handler(second, context))
+    while application.tasks:
+        await asyncio.gather(*list(application.tasks))
+
+
+def test_start_command_runs_after_pending_burst(events):
+    asyncio.run(_run(events, lambda bot: _message("/start", bot), command_handler.start_command))
+    assert events[0] == ('burst', ["hi", "yes please"])
+    assert ('state', 'awaiting_service_confirmation') in events[1:]
+    # 窗口结束时的后台任务不会再处理一遍
+    assert sum(1 for event in events if event[0] == 'burst') == 1
+
+
+def test_button_press_runs_after_pending_burst(events):
+    asyncio.run(_run(events, lambda bot: _button("strategy_1", bot), callback_handler.button_handler))
+    assert events == [('burst', ["hi", "yes please"]), ('button', "你已选择 strategy_1。祝你好运！")]
+
+
+def test_without_ordered_processor_messages_are_handled_immediately(events):
+    async def scenario():
+        bot = _FakeBot(events)
+        application = _FakeApplication(processor=object())
+        context = SimpleNamespace(bot=bot, application=application, job_queue=None)
+        for text in ("hi", "yes please"):
+            await message_handler.text_message_handler(_message(text, bot), context)
+        assert not application.tasks
+
+    asyncio.run(scenario())
+    assert events == [('burst', ["hi"]), ('burst', ["yes please"])]
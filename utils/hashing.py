@@ -0,0 +1,48 @@
+# utils/hashing.py
+
+import bisect
+import hashlib
+from typing import Dict, Generic, Iterable, List, TypeVar
+
+Node = TypeVar('Node')
+
+
+def stable_hash(key) -> int:
+    """与进程无关的 64 位哈希；内置的 hash() 对字符串每个进程都不一样，不能用来分片"""
+    return int.from_bytes(hashlib.md5(str(key).encode('utf-8')).digest()[:8], 'big')
+
+
+class ConsistentHashRing(Generic[Node]):
+    """
+    一致性哈希环：每个节点在环上放 replicas 个虚拟节点，键落在顺时针方向的第一个虚拟节点上。
+    增减节点时只有大约 1/N 的键会换节点，其余的键仍然落在原来的节点上。
+    """
+
+    def __init__(self, nodes: Iterable[Node] = (), replicas: int = 128):
+        self.replicas = replicas
+        self._ring: Dict[int, Node] = {}
+        self._sorted_keys: List[int] = []
+        for node in nodes:
+            self.add(node)
+
+    def add(self, node: Node):
+        for i in range(self.replicas):
+            self._ring[stable_hash(f"{node}#{i}")] = node
+        self._sorted_keys = sorted(self._ring)
+
+    def remove(self, node: Node):
+        for i in range(self.replicas):
+            self._ring.pop(stable_hash(f"{node}#{i}"), None)
+        self._sorted_keys = sorted(self._ring)
+
+    def get(self, key) -> Node:
+        """返回负责这个键的节点；环为空时抛出 LookupError"""
+        if not self._sorted_keys:
+            raise LookupError("一致性哈希环上没有节点")
+        index = bisect.bisect(self._sorted_keys, stable_hash(key))
+        if index == len(self._sorted_keys):
+            index = 0
+        return self._ring[self._sorted_keys[index]]
+
+    def __len__(self) -> int:
+        return len(set(self._ring.values()))
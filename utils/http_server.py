@@ -0,0 +1,130 @@
+# utils/http_server.py
+
+import asyncio
+import logging
+from dataclasses import dataclass, field
+from typing import Awaitable, Callable, Dict, Optional, Tuple
+from urllib.parse import parse_qs, urlsplit
+
+logger = logging.getLogger(__name__)
+
+# 请求体的最大字节数，超过时直接拒绝
+MAX_BODY_SIZE = 1024 * 1024
+
+_REASONS = {200: 'OK', 204: 'No Content', 400: 'Bad Request', 401: 'Unauthorized', 403: 'Forbidden',
+            404: 'Not Found', 405: 'Method Not Allowed', 409: 'Conflict', 413: 'Payload Too Large',
+            500: 'Internal Server Error', 503: 'Service Unavailable'}
+
+
+@dataclass
+class HTTPRequest:
+    method: str
+    path: str
+    query: Dict[str, str]
+    # 请求头的名称统一转成小写
+    headers: Dict[str, str]
+    body: bytes = b''
+
+
+@dataclass
+class HTTPResponse:
+    status: int = 200
+    body: bytes = b''
+    content_type: str = 'text/plain; charset=utf-8'
+    headers: Dict[str, str] = field(default_factory=dict)
+
+    @classmethod
+    def text(cls, text: str, status: int = 200, content_type: str = 'text/plain; charset=utf-8') -> 'HTTPResponse':
+        return cls(status=status, body=text.encode('utf-8'), content_type=content_type)
+
+
+Handler = Callable[[HTTPRequest], Awaitable[HTTPResponse]]
+
+
+class SimpleHTTPServer:
+    """
+    基于 asyncio 的极简 HTTP/1.1 服务器，只用于本地的监控和管理接口。
+    - 每个连接只处理一个请求，处理完就关闭
+    - 按 (方法, 路径) 精确匹配路由
+    """
+
+    def __init__(self, host: str = '127.0.0.1', port: int = 0):
+        self.host = host
+        self.port = port
+        self._routes: Dict[Tuple[str, str], Handler] = {}
+        self._server: Optional[asyncio.AbstractServer] = None
+
+    def route(self, method: str, path: str, handler: Handler):
+        self._routes[(method.upper(), path)] = handler
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._handle_connection, self.host, self.port)
+        # 端口为 0 时由系统分配，这里记下实际端口
+        self.port = self._server.sockets[0].getsockname()[1]
+        logger.info(f"HTTP 服务已启动: http://{self.host}:{self.port}")
+
+    async def stop(self):
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+            logger.info("HTTP 服务已停止。")
+
+    async def _read_request(self, reader: asyncio.StreamReader) -> Optional[HTTPRequest]:
+        request_line = await reader.readline()
+        if not request_line:
+            return None
+        parts = request_line.decode('latin-1').strip().split()
+        if len(parts) != 3:
+            raise ValueError("请求行格式不对")
+        method, target, _ = parts
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            name, _, value = line.decode('latin-1').partition(':')
+            headers[name.strip().lower()] = value.strip()
+        length = int(headers.get('content-length') or 0)
+        if length > MAX_BODY_SIZE:
+            raise OverflowError("请求体太大")
+        body = await reader.readexactly(length) if length else b''
+        url = urlsplit(target)
+        query = {key: values[-1] for key, values in parse_qs(url.query).items()}
+        return HTTPRequest(method=method.upper(), path=url.path, query=query, headers=headers, body=body)
+
+    async def _dispatch(self, request: HTTPRequest) -> HTTPResponse:
+        handler = self._routes.get((request.method, request.path))
+        if handler is None:
+            if any(path == request.path for _, path in self._routes):
+                return HTTPResponse.text("method not allowed\n", status=405)
+            return HTTPResponse.text("not found\n", status=404)
+        try:
+            return await handler(request)
+        except Exception as e:
+            logger.error(f"处理 HTTP 请求 {request.method} {request.path} 失败: {e}")
+            return HTTPResponse.text("internal error\n", status=500)
+
+    async def _handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            try:
+                request = await self._read_request(reader)
+            except OverflowError:
+                response = HTTPResponse.text("payload too large\n", status=413)
+            except (ValueError, asyncio.IncompleteReadError):
+                response = HTTPResponse.text("bad request\n", status=400)
+            else:
+                if request is None:
+                    return
+                response = await self._dispatch(request)
+            head = [f"HTTP/1.1 {response.status} {_REASONS.get(response.status, 'Unknown')}",
+                    f"Content-Type: {response.content_type}",
+                    f"Content-Length: {len(response.body)}",
+                    "Connection: close"]
+            head.extend(f"{name}: {value}" for name, value in response.headers.items())
+            writer.write(('\r\n'.join(head) + '\r\n\r\n').encode('latin-1') + response.body)
+            await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
@@ -0,0 +1,150 @@
+# utils/intent_classifier.py
+
+import re
+from typing import Dict, List, Optional, Tuple
+
+# --- 关键词词库：英语、印地文和罗马字母拼写的 Hinglish ---
+YES_PHRASES = [
+    "yes", "yeah", "yea", "yep", "yup", "ya", "yes please", "sure", "ok", "okay", "ok sure", "of course",
+    "definitely", "interested", "i am interested", "i want", "want", "need", "i need", "send", "send link",
+    "haan", "haa", "ha", "han", "hn", "haanji", "haan ji", "ji", "ji haan", "bilkul", "theek hai", "thik hai",
+    "chahiye", "haan chahiye", "zaroor", "jarur", "jaroor",
+    "हाँ", "हां", "हा", "जी", "जी हाँ", "जी हां", "बिल्कुल", "ठीक है", "चाहिए", "हाँ चाहिए", "ज़रूर", "जरूर",
+]
+NO_PHRASES = [
+    "no", "nope", "nah", "no thanks", "no thank you", "not interested", "not now", "dont want", "don't want",
+    "na", "nahi", "nahin", "nai", "nhi", "mat", "nahi chahiye", "nahi chaiye", "nhi chahiye", "rehne do",
+    "नहीं", "नही", "ना", "नहीं चाहिए", "रहने दो",
+]
+PLAYED_BEFORE_PHRASES = [
+    "played", "played before", "i have played", "already played", "old player", "existing player",
+    "khela hai", "khela tha", "khel chuka", "khel chuka hu", "khel chuka hoon", "purana player", "pehle khela",
+    "खेला है", "खेला था", "खेल चुका", "पहले खेला",
+]
+NEW_PLAYER_PHRASES = [
+    "new", "new player", "i am new", "first time", "never", "never played", "not played", "havent played",
+    "haven't played", "naya", "naya hu", "naya hoon", "pehli baar", "nahi khela", "nhi khela", "kabhi nahi khela",
+    "नया", "नया हूँ", "पहली बार", "नहीं खेला", "कभी नहीं खेला",
+]
+REGISTERED_PHRASES = [
+    "done", "registered", "i registered", "i have registered", "completed", "complete", "finished", "did it",
+    "ho gaya", "hogaya", "ho gya", "hogya", "kar liya", "kr liya", "ha kar liya", "haan kar liya",
+    "register kar liya", "ho gaya hai",
+    "हो गया", "कर लिया", "हाँ कर लिया", "रजिस्टर कर लिया", "पूरा हो गया",
+]
+NOT_REGISTERED_PHRASES = [
+    "not yet", "not done", "not registered", "not completed", "abhi nahi", "abhi nhi", "nahi hua", "nhi hua",
+    "nahi kiya", "nhi kiya", "baad mein", "baad me", "later",
+    "अभी नहीं", "नहीं हुआ", "नहीं किया", "बाद में",
+]
+
+# 每个对话状态下可以由本地规则判断的意图，以及对应的词库
+STATE_RULES: Dict[str, List[Tuple[str, List[str]]]] = {
+    'awaiting_service_confirmation': [
+        ('service_request', YES_PHRASES),
+        ('rejection', NO_PHRASES),
+    ],
+    'awaiting_experience_confirmation': [
+        ('played_before', YES_PHRASES + PLAYED_BEFORE_PHRASES),
+        ('new_player', NO_PHRASES + NEW_PLAYER_PHRASES),
+    ],
+    'awaiting_registration_confirmation': [
+        ('registration_complete', YES_PHRASES + REGISTERED_PHRASES),
+        ('registration_not_complete', NO_PHRASES + NOT_REGISTERED_PHRASES),
+    ],
+}
+
+# 需要回复用户的意图的固定回复：'hi' 用印地语，其他语言用 Hinglish
+CANNED_REPLIES: Dict[str, Dict[str, str]] = {
+    'rejection': {
+        'hi': "कोई बात नहीं! अगर कभी मन करे तो मुझे मैसेज कर दीजिए। 😊",
+        'en': "Koi baat nahi! Agar kabhi mann kare toh bas mujhe message kar dena. 😊",
+    },
+    'registration_not_complete': {
+        'hi': "कोई बात नहीं, आराम से रजिस्टर कर लीजिए। हो जाए तो मुझे 'done' भेज दीजिए!",
+        'en': "Koi baat nahi, aaram se register kar lo. Ho jaye toh mujhe 'done' bhej dena!",
+    },
+}
+
+# 超过这么多个词的消息通常不是简单的是/否回答，置信度会降低
+SHORT_MESSAGE_TOKENS = 4
+
+
+def normalize_message(text: str) -> str:
+    """统一大小写、去掉标点和表情、合并连续重复的字母（"yesss" -> "yes"）"""
+    text = text.lower().replace("’", "'")
+    # 保留字母、数字、撇号和梵文字符，其余都当作分隔符
+    text = re.sub(r"[^\w'\u0900-\u097F]+", " ", text)
+    text = re.sub(r"(.)\1+", r"\1", text)
+    return " ".join(text.split())
+
+
+def _compile(phrases: List[str]) -> List[Tuple[str, ...]]:
+    return sorted({tuple(normalize_message(p).split()) for p in phrases if normalize_message(p)}, key=len,
+                  reverse=True)
+
+
+# 预先把词库规范化并切成词组
+_COMPILED_RULES: Dict[str, List[Tuple[str, List[Tuple[str, ...]]]]] = {
+    state: [(intent, _compile(phrases)) for intent, phrases in rules]
+    for state, rules in STATE_RULES.items()
+}
+
+
+def _find_matches(tokens: List[str], phrases: List[Tuple[str, ...]]) -> List[Tuple[int, int]]:
+    """返回所有词组在消息中出现的位置 (起始, 结束)"""
+    spans = []
+    for phrase in phrases:
+        size = len(phrase)
+        for start in range(len(tokens) - size + 1):
+            if tuple(tokens[start:start + size]) == phrase:
+                spans.append((start, start + size))
+    return spans
+
+
+def classify_intent_locally(current_state: str, user_message: str,
+                            language_code: str = 'en') -> Optional[Dict[str, object]]:
+    """
+    用关键词规则判断引导流程中的简短回答。
+    返回 {"intent", "reply", "confidence"}；无法判断时返回 None。
+    """
+    rules = _COMPILED_RULES.get(current_state)
+    if not rules or not user_message:
+        return None
+    tokens = normalize_message(user_message).split()
+    if not tokens:
+        return None
+
+    # 找出每个意图匹配到的所有位置
+    matches = []
+    for intent, phrases in rules:
+        for span in _find_matches(tokens, phrases):
+            matches.append((span, intent))
+    if not matches:
+        return None
+
+    # 被更长词组完全包含的匹配不算（例如 "nahi khela" 里的 "khela"）
+    kept = [
+        (span, intent) for span, intent in matches
+        if not any(other[0] <= span[0] and span[1] <= other[1] and other != span for other, _ in matches)
+    ]
+    intents = {intent for _, intent in kept}
+    if len(intents) != 1:
+        # 同时出现肯定和否定，交给 AI 判断
+        return None
+    intent = intents.pop()
+
+    covered = set()
+    for (start, end), _ in kept:
+        covered.update(range(start, end))
+    if len(covered) == len(tokens):
+        # 整条消息都是词库里的说法
+        confidence = 0.95
+    else:
+        # 有未识别的词时最高 0.7，低于默认阈值 0.8，交给 AI 判断；消息越长、未识别的词越多，置信度越低
+        confidence = 0.75 - 0.1 * max(0, len(tokens) - SHORT_MESSAGE_TOKENS) - 0.05 * (len(tokens) - len(covered))
+        confidence = max(0.0, confidence)
+
+    replies = CANNED_REPLIES.get(intent, {})
+    reply = replies.get('hi' if language_code == 'hi' else 'en', "")
+    return {"intent": intent, "reply": reply, "confidence": round(confidence, 2)}
@@ -0,0 +1,303 @@
+# utils/metrics.py
+
+import functools
+import math
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterable, List, Optional, Sequence, Tuple
+
+# 默认的耗时分桶（秒）：覆盖从几毫秒的缓存命中到几十秒的 AI 重试
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+LabelValues = Tuple[str, ...]
+
+
+def _escape(value: str) -> str:
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str], extra: Optional[Tuple[str, str]] = None) -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(f'{extra[0]}="{_escape(extra[1])}"')
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _format_value(value: float) -> str:
+    if math.isinf(value):
+        return '+Inf' if value > 0 else '-Inf'
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+class _Metric:
+    """所有指标的基类：按标签值保存子序列"""
+
+    type_name = 'untyped'
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._children: Dict[LabelValues, object] = {}
+        self._lock = threading.Lock()
+
+    def _new_child(self):
+        raise NotImplementedError
+
+    def labels(self, *values, **kwargs):
+        """按标签取子序列，例如 HANDLER_LATENCY.labels(handler='start_command')"""
+        if kwargs:
+            values = tuple(str(kwargs[name]) for name in self.labelnames)
+        else:
+            values = tuple(str(v) for v in values)
+        if len(values) != len(self.labelnames):
+            raise ValueError(f"指标 {self.name} 需要标签 {self.labelnames}")
+        child = self._children.get(values)
+        if child is None:
+            with self._lock:
+                child = self._children.setdefault(values, self._new_child())
+        return child
+
+    def children(self) -> List[Tuple[LabelValues, object]]:
+        """返回已经出现过的 (标签值, 子序列)，供压测报告等直接读取数值"""
+        return list(self._children.items())
+
+    def _default(self):
+        """没有标签的指标直接使用唯一的子序列"""
+        if self.labelnames:
+            raise ValueError(f"指标 {self.name} 有标签，请先调用 labels()")
+        return self.labels()
+
+    def samples(self) -> Iterable[Tuple[str, str, float]]:
+        raise NotImplementedError
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type_name}"]
+        lines.extend(f"{name}{labels} {_format_value(value)}" for name, labels, value in self.samples())
+        return lines
+
+
+class _CounterChild:
+    def __init__(self):
+        self.value = 0.0
+
+    def inc(self, amount: float = 1.0):
+        self.value += amount
+
+
+class Counter(_Metric):
+    """只增不减的计数器，名称按惯例以 _total 结尾"""
+
+    type_name = 'counter'
+
+    def _new_child(self):
+        return _CounterChild()
+
+    def inc(self, amount: float = 1.0):
+        self._default().inc(amount)
+
+    def samples(self):
+        for values, child in list(self._children.items()):
+            yield self.name, _format_labels(self.labelnames, values), child.value
+
+
+class _GaugeChild:
+    def __init__(self):
+        self.value = 0.0
+        self._function: Optional[Callable[[], float]] = None
+
+    def set(self, value: float):
+        self.value = value
+
+    def inc(self, amount: float = 1.0):
+        self.value += amount
+
+    def dec(self, amount: float = 1.0):
+        self.value -= amount
+
+    def set_function(self, function: Callable[[], float]):
+        """导出时调用 function 取当前值，适合连接池大小、队列深度这类已有的状态"""
+        self._function = function
+
+    def get(self) -> float:
+        if self._function is not None:
+            try:
+                return float(self._function())
+            except Exception:
+                return float('nan')
+        return self.value
+
+
+class Gauge(_Metric):
+    """可增可减的瞬时值"""
+
+    type_name = 'gauge'
+
+    def _new_child(self):
+        return _GaugeChild()
+
+    def set(self, value: float):
+        self._default().set(value)
+
+    def inc(self, amount: float = 1.0):
+        self._default().inc(amount)
+
+    def dec(self, amount: float = 1.0):
+        self._default().dec(amount)
+
+    def set_function(self, function: Callable[[], float]):
+        self._default().set_function(function)
+
+    def samples(self):
+        for values, child in list(self._children.items()):
+            yield self.name, _format_labels(self.labelnames, values), child.get()
+
+
+class _HistogramChild:
+    def __init__(self, buckets: Sequence[float]):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.sum += value
+        self.count += 1
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+
+    @contextmanager
+    def time(self):
+        """计时的上下文管理器，同步和异步代码都可以用：with HISTOGRAM.labels(...).time(): ..."""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started)
+
+
+class Histogram(_Metric):
+    """按分桶统计的分布，用来算耗时的分位数"""
+
+    type_name = 'histogram'
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                 buckets: Sequence[float] = DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (float('inf'),)
+
+    def _new_child(self):
+        return _HistogramChild(self.buckets)
+
+    def observe(self, value: float):
+        self._default().observe(value)
+
+    def time(self):
+        return self._default().time()
+
+    def samples(self):
+        for values, child in list(self._children.items()):
+            cumulative = 0
+            for bound, count in zip(child.buckets, child.counts):
+                cumulative += count
+                yield (f"{self.name}_bucket",
+                       _format_labels(self.labelnames, values, ('le', _format_value(bound))), cumulative)
+            yield f"{self.name}_sum", _format_labels(self.labelnames, values), child.sum
+            yield f"{self.name}_count", _format_labels(self.labelnames, values), child.count
+
+
+class MetricsRegistry:
+    """保存所有指标，并按 Prometheus 文本格式导出"""
+
+    def __init__(self):
+        self._metrics: Dict[str, _Metric] = {}
+        # 导出时调用的统计函数：(前缀, 函数)，函数返回 {名称: 数值}
+        self._stats_sources: List[Tuple[str, str, Callable[[], Dict[str, float]]]] = []
+
+    def register(self, metric: _Metric) -> _Metric:
+        existing = self._metrics.get(metric.name)
+        if existing is not None:
+            # 模块被重复导入时复用已有的指标
+            return existing
+        self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> Counter:
+        return self.register(Counter(name, documentation, labelnames))
+
+    def gauge(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> Gauge:
+        return self.register(Gauge(name, documentation, labelnames))
+
+    def histogram(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                  buckets: Sequence[float] = DEFAULT_BUCKETS) -> Histogram:
+        return self.register(Histogram(name, documentation, labelnames, buckets))
+
+    def register_stats(self, prefix: str, documentation: str, function: Callable[[], Dict[str, float]]):
+        """把已有的 get_*_stats() 函数导出成一组 gauge，名称是 {prefix}_{键}"""
+        self._stats_sources = [source for source in self._stats_sources if source[0] != prefix]
+        self._stats_sources.append((prefix, documentation, function))
+
+    def render(self) -> str:
+        lines = []
+        for metric in list(self._metrics.values()):
+            lines.extend(metric.render())
+        for prefix, documentation, function in list(self._stats_sources):
+            try:
+                stats = function()
+            except Exception:
+                continue
+            for key, value in stats.items():
+                if isinstance(value, bool) or not isinstance(value, (int, float)):
+                    continue
+                name = f"{prefix}_{key}"
+                lines.append(f"# HELP {name} {documentation}")
+                lines.append(f"# TYPE {name} gauge")
+                lines.append(f"{name} {_format_value(value)}")
+        return '\n'.join(lines) + '\n'
+
+
+# 全局的指标注册表
+REGISTRY = MetricsRegistry()
+
+
+def counter(name: str, documentation: str, labelnames: Sequence[str] = ()) -> Counter:
+    return REGISTRY.counter(name, documentation, labelnames)
+
+
+def gauge(name: str, documentation: str, labelnames: Sequence[str] = ()) -> Gauge:
+    return REGISTRY.gauge(name, documentation, labelnames)
+
+
+def histogram(name: str, documentation: str, labelnames: Sequence[str] = (),
+              buckets: Sequence[float] = DEFAULT_BUCKETS) -> Histogram:
+    return REGISTRY.histogram(name, documentation, labelnames, buckets)
+
+
+@contextmanager
+def track(latency: Histogram, errors: Optional[Counter] = None, **labels):
+    """记录一段代码的耗时；抛出异常时错误计数加一（异常照常抛出）"""
+    started = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        if errors is not None:
+            errors.labels(**labels).inc()
+        raise
+    finally:
+        latency.labels(**labels).observe(time.perf_counter() - started)
+
+
+def timed(latency: Histogram, errors: Optional[Counter] = None, **labels):
+    """异步函数的装饰器版本的 track"""
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            with track(latency, errors, **labels):
+                return await func(*args, **kwargs)
+        return wrapper
+    return decorator
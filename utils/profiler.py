@@ -0,0 +1,162 @@
+# utils/profiler.py
+
+import asyncio
+import cProfile
+import io
+import logging
+import os
+import pstats
+import sys
+import threading
+import time
+from collections import Counter
+from typing import Any, Dict, Optional
+
+from telegram_bot import config
+
+logger = logging.getLogger(__name__)
+
+# 分析结果写到哪个目录
+PROFILE_OUTPUT_DIR = getattr(config, 'PROFILE_OUTPUT_DIR', 'profiles')
+# 一次分析最长多少秒，防止忘记关闭
+PROFILE_MAX_SECONDS = getattr(config, 'PROFILE_MAX_SECONDS', 300)
+# 栈采样的间隔（秒）
+PROFILE_SAMPLE_INTERVAL = getattr(config, 'PROFILE_SAMPLE_INTERVAL', 0.005)
+
+MODES = ('cprofile', 'stack')
+
+
+class ProfilerBusyError(RuntimeError):
+    """已经有一次分析在进行中"""
+
+
+class _StackSampler(threading.Thread):
+    """
+    后台线程定时抓取目标线程（事件循环所在线程）的调用栈，按栈计数。
+    输出折叠栈格式（每行“帧;帧;帧 次数”），可以直接交给 flamegraph.pl 或 speedscope 画火焰图。
+    """
+
+    def __init__(self, target_thread_id: int, interval: float):
+        super().__init__(name='stack-sampler', daemon=True)
+        self.target_thread_id = target_thread_id
+        self.interval = interval
+        self.samples: Counter = Counter()
+        self.sample_count = 0
+        self._stop_event = threading.Event()
+
+    def run(self):
+        while not self._stop_event.wait(self.interval):
+            frame = sys._current_frames().get(self.target_thread_id)
+            if frame is None:
+                continue
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{os.path.basename(code.co_filename)}:{code.co_name}:{frame.f_lineno}")
+                frame = frame.f_back
+            self.samples[';'.join(reversed(stack))] += 1
+            self.sample_count += 1
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+
+    def write(self, path: str):
+        with open(path, 'w', encoding='utf-8') as f:
+            for stack, count in self.samples.most_common():
+                f.write(f"{stack} {count}\n")
+
+
+class Profiler:
+    """
+    由运维手动开启的限时性能分析，同一时间只允许一次。
+    - cprofile：cProfile 记录事件循环线程上每个函数的调用次数和耗时，输出 .prof 和按累计耗时排序的文本摘要
+    - stack：采样线程定时抓取调用栈，开销很小，适合在线上流量下运行
+    时间到了自动停止并写文件，也可以提前手动停止。
+    """
+
+    def __init__(self, output_dir: str = PROFILE_OUTPUT_DIR, max_seconds: float = PROFILE_MAX_SECONDS,
+                 sample_interval: float = PROFILE_SAMPLE_INTERVAL):
+        self.output_dir = output_dir
+        self.max_seconds = max_seconds
+        self.sample_interval = sample_interval
+        self.mode: Optional[str] = None
+        self.started_at: Optional[float] = None
+        self.duration = 0.0
+        self._profile: Optional[cProfile.Profile] = None
+        self._sampler: Optional[_StackSampler] = None
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self.last_result: Optional[Dict[str, Any]] = None
+
+    @property
+    def running(self) -> bool:
+        return self.mode is not None
+
+    def start(self, mode: str = 'stack', seconds: float = 30) -> Dict[str, Any]:
+        """开始一次分析；必须在事件循环线程里调用"""
+        if mode not in MODES:
+            raise ValueError(f"未知的分析模式: {mode!r}，可选 {MODES}")
+        if self.running:
+            raise ProfilerBusyError(f"已有一次 {self.mode} 分析在进行中")
+        seconds = max(1.0, min(float(seconds), self.max_seconds))
+        if mode == 'cprofile':
+            self._profile = cProfile.Profile()
+            self._profile.enable()
+        else:
+            self._sampler = _StackSampler(threading.get_ident(), self.sample_interval)
+            self._sampler.start()
+        self.mode = mode
+        self.started_at = time.time()
+        self.duration = seconds
+        self._timer = asyncio.get_running_loop().call_later(seconds, self.stop)
+        logger.info(f"开始 {mode} 性能分析，持续 {seconds:.0f} 秒。")
+        return self.status()
+
+    def stop(self) -> Optional[Dict[str, Any]]:
+        """停止分析并写出结果文件，返回结果摘要；没有进行中的分析时返回 None"""
+        if not self.running:
+            return None
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        os.makedirs(self.output_dir, exist_ok=True)
+        stamp = time.strftime('%Y%m%d-%H%M%S', time.localtime(self.started_at))
+        elapsed = time.time() - self.started_at
+        result: Dict[str, Any] = {'mode': self.mode, 'started_at': self.started_at, 'seconds': round(elapsed, 1)}
+        try:
+            if self.mode == 'cprofile':
+                self._profile.disable()
+                path = os.path.join(self.output_dir, f"cprofile-{stamp}.prof")
+                self._profile.dump_stats(path)
+                summary = io.StringIO()
+                pstats.Stats(self._profile, stream=summary).sort_stats('cumulative').print_stats(50)
+                summary_path = os.path.join(self.output_dir, f"cprofile-{stamp}.txt")
+                with open(summary_path, 'w', encoding='utf-8') as f:
+                    f.write(summary.getvalue())
+                result.update(files=[path, summary_path])
+            else:
+                self._sampler.stop()
+                path = os.path.join(self.output_dir, f"stacks-{stamp}.folded")
+                self._sampler.write(path)
+                result.update(files=[path], samples=self._sampler.sample_count)
+        finally:
+            self.mode = None
+            self._profile = None
+            self._sampler = None
+        self.last_result = result
+        logger.info(f"性能分析结束: {result}")
+        return result
+
+    def status(self) -> Dict[str, Any]:
+        if not self.running:
+            return {'running': False, 'last_result': self.last_result}
+        return {
+            'running': True,
+            'mode': self.mode,
+            'elapsed_seconds': round(time.time() - self.started_at, 1),
+            'duration_seconds': self.duration,
+        }
+
+
+# 全局唯一的分析器
+profiler = Profiler()
@@ -0,0 +1,74 @@
+# utils/rate_limiter.py
+
+import asyncio
+import time
+
+
+class TokenBucket:
+    """
+    异步令牌桶限流器。
+    - rate: 每个 period 秒内补充的令牌数
+    - capacity: 桶容量，即允许的最大突发量
+    - pause(): 整体暂停一段时间（例如收到 Telegram 的 RetryAfter 时）
+    """
+
+    def __init__(self, rate: float, capacity: float = None, period: float = 1.0):
+        if rate <= 0:
+            raise ValueError("rate 必须大于 0")
+        self.rate = rate / period  # 每秒补充的令牌数
+        self.capacity = capacity if capacity is not None else max(1.0, rate)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        # 用锁保证等待者按先来后到的顺序拿到令牌
+        self._lock = asyncio.Lock()
+
+    def _refill(self, now: float):
+        elapsed = now - self._updated
+        if elapsed > 0:
+            self._tokens = min(self.capacity, self._tokens + elapsed * self.rate)
+            self._updated = now
+
+    @property
+    def paused_for(self) -> float:
+        """距离暂停结束还有多少秒，未暂停时为 0"""
+        return max(0.0, self._paused_until - time.monotonic())
+
+    def time_until_available(self, tokens: float = 1.0) -> float:
+        """估算还要等多少秒才能拿到指定数量的令牌（不消耗令牌）"""
+        now = time.monotonic()
+        self._refill(now)
+        wait = max(0.0, (tokens - self._tokens) / self.rate)
+        return max(wait, self._paused_until - now)
+
+    def try_acquire(self, tokens: float = 1.0) -> bool:
+        """立即尝试获取令牌，拿不到就返回 False，不等待"""
+        now = time.monotonic()
+        if now < self._paused_until or self._lock.locked():
+            return False
+        self._refill(now)
+        if self._tokens >= tokens:
+            self._tokens -= tokens
+            return True
+        return False
+
+    async def acquire(self, tokens: float = 1.0):
+        """等待直到拿到指定数量的令牌"""
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    await asyncio.sleep(self._paused_until - now)
+                    continue
+                self._refill(now)
+                if self._tokens >= tokens:
+                    self._tokens -= tokens
+                    return
+                await asyncio.sleep((tokens - self._tokens) / self.rate)
+
+    def pause(self, seconds: float):
+        """暂停发放令牌 seconds 秒，并清空桶，避免恢复后立刻出现突发"""
+        now = time.monotonic()
+        self._paused_until = max(self._paused_until, now + seconds)
+        self._tokens = 0.0
+        self._updated = self._paused_until
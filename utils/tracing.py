@@ -0,0 +1,189 @@
+# utils/tracing.py
+
+import functools
+import itertools
+import json
+import logging
+import random
+import time
+from collections import deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Deque, Dict, List, Optional
+
+from telegram_bot import config
+from utils import metrics
+
+logger = logging.getLogger(__name__)
+
+# 是否开启按更新的耗时追踪
+TRACING_ENABLED = getattr(config, 'TRACING_ENABLED', True)
+# 追踪的采样比例（0 到 1），流量大时可以调低
+TRACE_SAMPLE_RATE = getattr(config, 'TRACE_SAMPLE_RATE', 1.0)
+# 总耗时达到多少毫秒的记录才写日志；0 表示每条都写
+TRACE_LOG_THRESHOLD_MS = getattr(config, 'TRACE_LOG_THRESHOLD_MS', 0)
+# 内存里保留最近多少条记录，供 /debug/traces 查看
+TRACE_BUFFER_SIZE = getattr(config, 'TRACE_BUFFER_SIZE', 1000)
+
+# 每个阶段的耗时分布：trace 是入口名（处理函数或广播阶段），phase 是阶段名
+TRACE_PHASE_DURATION = metrics.histogram('trace_phase_duration_seconds', '一次更新处理中各阶段的耗时（秒）',
+                                         ['trace', 'phase'])
+
+# 当前正在记录的追踪，以及当前所在的阶段；asyncio 任务创建时会复制一份上下文，
+# 所以 create_task 出来的任务能看到父任务的追踪，但各自的“当前阶段”互不影响
+_current_trace: ContextVar[Optional['Trace']] = ContextVar('current_trace', default=None)
+_current_span: ContextVar[Optional['_Span']] = ContextVar('current_span', default=None)
+
+_trace_ids = itertools.count(1)
+# 最近完成的追踪记录
+_recent: Deque[Dict[str, Any]] = deque(maxlen=TRACE_BUFFER_SIZE)
+
+
+class _Span:
+    __slots__ = ('phase', 'started', 'child_seconds')
+
+    def __init__(self, phase: str):
+        self.phase = phase
+        self.started = time.perf_counter()
+        # 子阶段占用的时间，算自身耗时时要减掉
+        self.child_seconds = 0.0
+
+
+class Trace:
+    """
+    一次更新（或一个广播阶段）的耗时记录。
+    每个阶段只记自身耗时（不含嵌套的子阶段），所以各阶段加上 other 约等于总耗时；
+    并发任务里的阶段会累加，广播这类并发发送的记录里各阶段之和会大于总耗时。
+    """
+
+    def __init__(self, name: str, attributes: Optional[Dict[str, Any]] = None):
+        self.name = name
+        self.trace_id = next(_trace_ids)
+        self.attributes: Dict[str, Any] = dict(attributes or {})
+        self.started = time.perf_counter()
+        self.root = _Span('other')
+        # phase -> [累计秒数, 次数]
+        self.phases: Dict[str, List[float]] = {}
+        self.finished = False
+        self.error: Optional[str] = None
+
+    def add(self, phase: str, seconds: float):
+        entry = self.phases.get(phase)
+        if entry is None:
+            self.phases[phase] = [seconds, 1]
+        else:
+            entry[0] += seconds
+            entry[1] += 1
+
+    def finish(self) -> Dict[str, Any]:
+        self.finished = True
+        duration = time.perf_counter() - self.started
+        other = max(0.0, duration - self.root.child_seconds)
+        record = {
+            'trace': self.name,
+            'trace_id': self.trace_id,
+            **self.attributes,
+            'duration_ms': round(duration * 1000, 1),
+            'phases': {phase: {'ms': round(seconds * 1000, 1), 'count': int(count)}
+                       for phase, (seconds, count) in sorted(self.phases.items(), key=lambda i: -i[1][0])},
+            'other_ms': round(other * 1000, 1),
+        }
+        if self.error:
+            record['error'] = self.error
+        for phase, (seconds, _) in self.phases.items():
+            TRACE_PHASE_DURATION.labels(trace=self.name, phase=phase).observe(seconds)
+        TRACE_PHASE_DURATION.labels(trace=self.name, phase='other').observe(other)
+        return record
+
+
+def current_trace() -> Optional[Trace]:
+    trace = _current_trace.get()
+    return trace if trace is not None and not trace.finished else None
+
+
+def annotate(**attributes):
+    """给当前追踪加上属性（例如用户状态、广播轮次），没有追踪时什么都不做"""
+    trace = current_trace()
+    if trace is not None:
+        trace.attributes.update(attributes)
+
+
+@contextmanager
+def span(phase: str):
+    """记录一个阶段的耗时；不在追踪中时几乎没有开销"""
+    trace = current_trace()
+    if trace is None:
+        yield
+        return
+    parent = _current_span.get() or trace.root
+    current = _Span(phase)
+    token = _current_span.set(current)
+    try:
+        yield
+    finally:
+        _current_span.reset(token)
+        elapsed = time.perf_counter() - current.started
+        parent.child_seconds += elapsed
+        trace.add(phase, max(0.0, elapsed - current.child_seconds))
+
+
+def _update_attributes(args) -> Dict[str, Any]:
+    """从处理函数的参数里找出更新，取出 update_id、用户和聊天"""
+    update = args[0] if args else None
+    attributes = {}
+    if getattr(update, 'update_id', None) is not None:
+        attributes['update_id'] = update.update_id
+    user = getattr(update, 'effective_user', None)
+    if user is not None:
+        attributes['user_id'] = user.id
+    chat = getattr(update, 'effective_chat', None)
+    if chat is not None:
+        attributes['chat_id'] = chat.id
+    return attributes
+
+
+def _emit(record: Dict[str, Any]):
+    _recent.append(record)
+    if record['duration_ms'] >= TRACE_LOG_THRESHOLD_MS:
+        logger.info(json.dumps(record, ensure_ascii=False, default=str))
+
+
+def traced(name: str):
+    """
+    异步处理函数的装饰器：为每次调用开始一条追踪，结束时输出一条结构化记录。
+    已经在一条进行中的追踪里被调用时（例如 start_command 转给 text_message_handler），
+    不再新开追踪，耗时算进外层的记录。
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            if not TRACING_ENABLED or current_trace() is not None or random.random() >= TRACE_SAMPLE_RATE:
+                return await func(*args, **kwargs)
+            trace = Trace(name, _update_attributes(args))
+            trace_token = _current_trace.set(trace)
+            span_token = _current_span.set(None)
+            try:
+                return await func(*args, **kwargs)
+            except Exception as e:
+                trace.error = f"{type(e).__name__}: {e}"
+                raise
+            finally:
+                _current_span.reset(span_token)
+                _current_trace.reset(trace_token)
+                _emit(trace.finish())
+        return wrapper
+    return decorator
+
+
+def recent_traces(limit: int = 100, name: Optional[str] = None, min_duration_ms: float = 0) -> List[Dict[str, Any]]:
+    """返回最近的追踪记录，最新的在前"""
+    records = []
+    for record in reversed(_recent):
+        if name and record['trace'] != name:
+            continue
+        if record['duration_ms'] < min_duration_ms:
+            continue
+        records.append(record)
+        if len(records) >= limit:
+            break
+    return records